@@ -0,0 +1,432 @@
+from __future__ import print_function, division, absolute_import#, unicode_literals # not casa compatible
+from builtins import bytes, dict, object, range, map, input#, str # not casa compatible
+from future.utils import itervalues, viewitems, iteritems, listvalues, listitems, with_metaclass
+from io import open
+
+import re
+from abc import ABCMeta, abstractmethod
+import copy
+import fnmatch
+import json
+import threading
+from collections import OrderedDict
+from elasticsearch import Elasticsearch, helpers, NotFoundError, ConflictError
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(20)
+
+
+class IndexBackend(with_metaclass(ABCMeta, object)):
+    """ Document index used by realfast.elastic.
+    Methods follow the Elasticsearch client (index, create, get, mget,
+    exists, update, delete, update_by_query, ping, indices) and helpers
+    (bulk, scan), so responses and exceptions are those of Elasticsearch.
+    """
+
+    @abstractmethod
+    def index(self, index, doc_type, body, id=None, **kwargs):
+        pass
+
+    @abstractmethod
+    def create(self, index, doc_type, id, body, **kwargs):
+        pass
+
+    @abstractmethod
+    def get(self, index, doc_type, id, **kwargs):
+        pass
+
+    @abstractmethod
+    def mget(self, body, index=None, doc_type=None, **kwargs):
+        pass
+
+    @abstractmethod
+    def exists(self, index, doc_type, id, **kwargs):
+        pass
+
+    @abstractmethod
+    def update(self, index, doc_type, id, body=None, **kwargs):
+        pass
+
+    @abstractmethod
+    def delete(self, index, doc_type, id, **kwargs):
+        pass
+
+    @abstractmethod
+    def update_by_query(self, index, doc_type=None, body=None, **kwargs):
+        pass
+
+    @abstractmethod
+    def bulk(self, actions, **kwargs):
+        pass
+
+    @abstractmethod
+    def scan(self, index=None, doc_type=None, query=None, **kwargs):
+        pass
+
+    @abstractmethod
+    def ping(self, **kwargs):
+        pass
+
+
+class ElasticsearchBackend(IndexBackend):
+    """ Elasticsearch cluster at hosts. Client is created on first use.
+    """
+
+    def __init__(self, hosts, **kwargs):
+        self.hosts = hosts
+        self.kwargs = kwargs
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = Elasticsearch(self.hosts, **self.kwargs)
+        return self._client
+
+    @property
+    def indices(self):
+        return self.client.indices
+
+    def index(self, *args, **kwargs):
+        return self.client.index(*args, **kwargs)
+
+    def create(self, *args, **kwargs):
+        return self.client.create(*args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        return self.client.get(*args, **kwargs)
+
+    def mget(self, *args, **kwargs):
+        return self.client.mget(*args, **kwargs)
+
+    def exists(self, *args, **kwargs):
+        return self.client.exists(*args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        return self.client.update(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self.client.delete(*args, **kwargs)
+
+    def update_by_query(self, *args, **kwargs):
+        return self.client.update_by_query(*args, **kwargs)
+
+    def bulk(self, actions, **kwargs):
+        return helpers.bulk(self.client, actions, **kwargs)
+
+    def scan(self, **kwargs):
+        return helpers.scan(self.client, **kwargs)
+
+    def ping(self, **kwargs):
+        return self.client.ping(**kwargs)
+
+
+class MemoryBackend(IndexBackend):
+    """ Index held in memory, for tests and benchmarks without a cluster.
+    Text is analyzed as by elasticsearch: whitespace tokens for indices
+    created with a whitespace default analyzer (as by
+    elastic.create_indices), else like the standard analyzer (lowercase
+    words, with "." breaking letters from digits).
+    Queries support match_all, match, term (exact value, also of
+    field.keyword), bool/must or filter of those, and query_string with
+    field:value terms and * or ? wildcards. Update scripts support
+    assignment, +=, -=, and ctx._source.remove of fields.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._docs = {}  # index: OrderedDict of id: source
+        self._analyzers = {}  # index: 'whitespace' (default is 'standard')
+        self.indices = _MemoryIndices(self)
+
+    def _shards(self):
+        return {'total': 1, 'successful': 1, 'failed': 0}
+
+    def _response(self, index, doc_type, id, result):
+        return {'_index': index, '_type': doc_type, '_id': id,
+                'result': result, '_shards': self._shards()}
+
+    def _source(self, index, doc_type, id):
+        try:
+            return self._docs[index][id]
+        except KeyError:
+            raise NotFoundError(404, 'not_found', {'_index': index, '_type': doc_type,
+                                                   '_id': id, 'found': False})
+
+    def index(self, index, doc_type, body, id=None, **kwargs):
+        with self._lock:
+            docs = self._docs.setdefault(index, OrderedDict())
+            if id is None:
+                id = str(len(docs))
+            result = 'updated' if id in docs else 'created'
+            docs[id] = copy.deepcopy(body)
+        return self._response(index, doc_type, id, result)
+
+    def create(self, index, doc_type, id, body, **kwargs):
+        with self._lock:
+            if self.exists(index, doc_type, id):
+                raise ConflictError(409, 'version_conflict_engine_exception',
+                                    {'_index': index, '_id': id})
+            return self.index(index, doc_type, body, id=id)
+
+    def get(self, index, doc_type, id, **kwargs):
+        with self._lock:
+            source = copy.deepcopy(self._source(index, doc_type, id))
+        return {'_index': index, '_type': doc_type, '_id': id, 'found': True,
+                '_source': source}
+
+    def mget(self, body, index=None, doc_type=None, **kwargs):
+        if 'ids' in body:
+            keys = [(index, doc_type, id) for id in body['ids']]
+        else:
+            keys = [(doc.get('_index', index), doc.get('_type', doc_type), doc['_id'])
+                    for doc in body['docs']]
+
+        docs = []
+        for (index, doc_type, id) in keys:
+            try:
+                docs.append(self.get(index, doc_type, id))
+            except NotFoundError:
+                docs.append({'_index': index, '_type': doc_type, '_id': id,
+                             'found': False})
+        return {'docs': docs}
+
+    def exists(self, index, doc_type, id, **kwargs):
+        with self._lock:
+            return id in self._docs.get(index, {})
+
+    def update(self, index, doc_type, id, body=None, **kwargs):
+        with self._lock:
+            source = self._source(index, doc_type, id)
+            if 'doc' in body:
+                source.update(copy.deepcopy(body['doc']))
+            if 'script' in body:
+                _run_script(source, body['script'])
+        return self._response(index, doc_type, id, 'updated')
+
+    def delete(self, index, doc_type, id, **kwargs):
+        with self._lock:
+            _ = self._source(index, doc_type, id)
+            _ = self._docs[index].pop(id)
+        return self._response(index, doc_type, id, 'deleted')
+
+    def update_by_query(self, index, doc_type=None, body=None, **kwargs):
+        with self._lock:
+            hits = list(self.scan(index=index, doc_type=doc_type, query=body))
+            for hit in hits:
+                _run_script(self._docs[index][hit['_id']], body['script'])
+        return {'updated': len(hits), 'total': len(hits), '_shards': self._shards()}
+
+    def bulk(self, actions, raise_on_error=True, stats_only=False, **kwargs):
+        """ Runs bulk actions as helpers.bulk. Returns (number of
+        successes, list of errors) or (successes, number of errors) if
+        stats_only.
+        """
+
+        success = 0
+        errors = []
+        for action in actions:
+            action = dict(action)
+            op_type = action.pop('_op_type', 'index')
+            index = action.pop('_index')
+            doc_type = action.pop('_type', None)
+            id = action.pop('_id', None)
+            try:
+                if op_type == 'index':
+                    self.index(index, doc_type, action.get('_source', action), id=id)
+                elif op_type == 'create':
+                    self.create(index, doc_type, id, action.get('_source', action))
+                elif op_type == 'update':
+                    self.update(index, doc_type, id, body=action)
+                elif op_type == 'delete':
+                    self.delete(index, doc_type, id)
+                else:
+                    raise NotImplementedError("op_type {0} not supported".format(op_type))
+                success += 1
+            except (NotFoundError, ConflictError) as exc:
+                errors.append({op_type: {'_index': index, '_type': doc_type,
+                                         '_id': id, 'status': exc.status_code,
+                                         'error': exc.error}})
+            except NotImplementedError as exc:
+                errors.append({op_type: {'_index': index, '_type': doc_type,
+                                         '_id': id, 'status': 400,
+                                         'error': str(exc)}})
+
+        if errors and raise_on_error:
+            raise helpers.BulkIndexError('{0} document(s) failed to index.'
+                                         .format(len(errors)), errors)
+
+        return success, len(errors) if stats_only else errors
+
+    def scan(self, index=None, doc_type=None, query=None, **kwargs):
+        """ Yields hits (dicts of _index, _type, _id, _source) that match
+        query["query"].
+        """
+
+        if query is None:
+            query = {}
+        clause = query.get('query', {'match_all': {}})
+        with self._lock:
+            indices = [index] if index is not None else list(self._docs)
+            hits = [{'_index': ind, '_type': doc_type, '_id': id,
+                     '_source': copy.deepcopy(source)}
+                    for ind in indices
+                    for id, source in iteritems(self._docs.get(ind, {}))
+                    if _matches(source, clause, self._analyzers.get(ind, 'standard'))]
+
+        for hit in hits:
+            yield hit
+
+    def ping(self, **kwargs):
+        return True
+
+
+class _MemoryIndices(object):
+    """ Index management calls (client.indices) for MemoryBackend.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def exists(self, index, **kwargs):
+        return index in self.backend._docs
+
+    def create(self, index, body=None, **kwargs):
+        analysis = (body or {}).get('settings', {}).get('analysis', {})
+        tokenizer = analysis.get('analyzer', {}).get('default', {}).get('tokenizer')
+        with self.backend._lock:
+            _ = self.backend._docs.setdefault(index, OrderedDict())
+            if tokenizer == 'whitespace':
+                self.backend._analyzers[index] = 'whitespace'
+        return {'acknowledged': True, 'index': index}
+
+    def delete(self, index, **kwargs):
+        with self.backend._lock:
+            _ = self.backend._docs.pop(index, None)
+            _ = self.backend._analyzers.pop(index, None)
+        return {'acknowledged': True}
+
+
+_word_re = re.compile(r"\w+(?:[.']\w+)*", re.UNICODE)
+_break_re = re.compile(r"(?<=[^\W\d_])[.'](?=\d)|(?<=\d)[.'](?=[^\W\d_])", re.UNICODE)
+
+
+def _tokens(value, analyzer='standard'):
+    """ Tokens of field value (or list of values) as strings.
+    Text is split on whitespace or, for standard analyzer, into lowercase
+    words (e.g., "test.1.1" gives "test" and "1.1").
+    """
+
+    if isinstance(value, list):
+        return [token for val in value for token in _tokens(val, analyzer)]
+    elif isinstance(value, bool):
+        return [str(value).lower()]
+    elif isinstance(value, float) and value.is_integer():
+        return [str(int(value)), str(value)]
+    elif isinstance(value, (int, float)):
+        return [str(value)]
+    elif analyzer == 'whitespace':
+        return str(value).split()
+    else:
+        return [token.lower() for word in _word_re.findall(str(value))
+                for token in _break_re.split(word)]
+
+
+def _matches(source, clause, analyzer='standard'):
+    """ Does doc source match query clause?
+    """
+
+    if 'match_all' in clause:
+        return True
+    elif 'match' in clause:
+        return all(key in source and
+                   set(_tokens(value, analyzer)) & set(_tokens(source[key], analyzer))
+                   for key, value in iteritems(clause['match']))
+    elif 'term' in clause:
+        return all(_term_matches(source.get(key.rsplit('.keyword', 1)[0]), value)
+                   for key, value in iteritems(clause['term']))
+    elif 'bool' in clause:
+        must = []
+        for occur in ['must', 'filter']:
+            subs = clause['bool'].get(occur, [])
+            must += subs if isinstance(subs, list) else [subs]
+        return all(_matches(source, sub, analyzer) for sub in must)
+    elif 'query_string' in clause:
+        return _query_string(source, clause['query_string']['query'], analyzer)
+    else:
+        raise NotImplementedError("Query {0} not supported".format(clause))
+
+
+def _term_matches(value, term):
+    """ Does field value (or any in list of values) equal term?
+    """
+
+    values = value if isinstance(value, list) else [value]
+    return term in values
+
+
+def _query_string(source, query, analyzer='standard'):
+    """ Match whitespace-separated terms of query (OR by default, AND if
+    joined by AND). Terms are pattern or field:pattern. Patterns with
+    wildcards match tokens, others are analyzed and match any token.
+    """
+
+    terms = query.split()
+    operator = all if 'AND' in terms else any
+    terms = [term for term in terms if term not in ['AND', 'OR']]
+
+    def term_matches(term):
+        if ':' in term and term.split(':', 1)[0] in source:
+            field, pattern = term.split(':', 1)
+            values = _tokens(source[field], analyzer)
+        else:
+            pattern = term
+            values = _tokens(listvalues(source), analyzer)
+        pattern = pattern.strip('"')
+        if '*' in pattern or '?' in pattern:
+            if analyzer != 'whitespace':
+                pattern = pattern.lower()
+            return any(fnmatch.fnmatchcase(value, pattern) for value in values)
+        else:
+            return bool(set(_tokens(pattern, analyzer)) & set(values))
+
+    return operator(term_matches(term) for term in terms)
+
+
+_remove_re = re.compile(r'''^ctx\._source\.remove\(["'](\w+)["']\)$''')
+_assign_re = re.compile(r'^ctx\._source\.(\w+)\s*(\+=|-=|=)\s*(.+)$')
+
+
+def _run_script(source, script):
+    """ Run simple painless script on doc source in place.
+    """
+
+    if isinstance(script, dict):
+        script = script.get('source', script.get('inline'))
+
+    for statement in script.split(';'):
+        statement = statement.strip()
+        if not statement:
+            continue
+
+        remove = _remove_re.match(statement)
+        assign = _assign_re.match(statement)
+        if remove:
+            _ = source.pop(remove.group(1), None)
+        elif assign:
+            field, op, value = assign.groups()
+            value = value.strip()
+            if value[0] in ['"', "'"]:
+                value = value[1:-1]
+            else:
+                value = json.loads(value)
+
+            if op == '=':
+                source[field] = value
+            elif op == '+=':
+                source[field] = source.get(field, 0) + value
+            else:
+                source[field] = source.get(field, 0) - value
+        else:
+            raise NotImplementedError("Script statement {0} not supported".format(statement))
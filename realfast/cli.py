@@ -274,8 +274,19 @@ def archive_local(confirm, mode):
 
 
 @click.group('realfast_portal')
-def cli2():
-    pass
+@click.option('--backend', type=click.Choice(['elasticsearch', 'memory']),
+              default='elasticsearch')
+def cli2(backend):
+    """ Manage realfast portal index. backend 'memory' uses an empty index
+    in this process, so commands run without an elasticsearch cluster.
+    """
+
+    from realfast import elastic, backends
+
+    if backend == 'memory':
+        elastic.set_backend(backends.MemoryBackend())
+    else:
+        elastic.set_backend(None)
 
 
 @cli2.command()
@@ -486,3 +497,28 @@ def reset_indices(prefix):
     from realfast import elastic
 
     elastic.reset_indices(prefix)
+
+
+@cli2.command()
+@click.argument('prefix')
+@click.option('--scanid', default=None)
+@click.option('--delete', is_flag=True)
+def migrate_noises(prefix, scanid, delete):
+    """ Rewrite noise docs of single integrations as one doc per segment
+    """
+
+    from realfast import elastic
+
+    elastic.migrate_noises(prefix, scanId=scanid, delete=delete)
+
+
+@cli2.command()
+@click.option('--spooldir', default=None)
+def drain_spools(spooldir):
+    """ Replay index writes spooled while elasticsearch was down
+    """
+
+    from realfast import elastic
+
+    count = elastic.drain_spools(spooldir)
+    logger.info("Replayed {0} spooled index actions".format(count))
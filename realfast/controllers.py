@@ -3,17 +3,22 @@ from builtins import bytes, dict, object, range, map, input#, str # not casa com
 from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
 from io import open
 
+import atexit
+import copy
 import pickle
 import os.path
-from datetime import timezone, datetime
 import gc
 import random
+import sys
+import threading
+from collections import OrderedDict
 from functools import partial
 import distributed
+from dask.utils import key_split
 from time import sleep
 from astropy import time
 from evla_mcast.controller import Controller
-from realfast import pipeline, elastic, heuristics, util
+from realfast import pipeline, elastic, heuristics, util, scheduling, telcal
 
 import logging
 import matplotlib
@@ -32,6 +37,15 @@ _preffile = '/lustre/evla/test/realfast/realfast.yml'
 #_distributed_host = '192.168.201.101'  # for ib0 on cbe-node-01
 _distributed_host = '10.80.200.201:8786'  # for ib0 on rfnode021
 _default_daskdir = '/lustre/evla/test/realfast/dask-worker-space'
+_capacity_timeout = 1.  # max wait (s) between submission checks without an event
+_cleanup_interval = 5.  # min time (s) between cleanups triggered by completions
+_cleanup_period = 20.  # max time (s) between cleanups while segments are in flight
+_shm_sweep_interval = 600.  # min time (s) between sweeps of stale segment buffers
+_shm_maxage = 3600.  # age (s) of segment buffer that is considered stale
+_retry_tasks = ['timed_read', 'segment_data', 'read_segment', 'prep_and_search']  # key names retried by cleanup_retry
+_submit_window = 3.  # max delay (s) after segment start to submit realtime read
+_status_interval = 5.  # time (s) between flushes of scan status to index
+_status_retries = 10  # failed flushes before status of removed scan is dropped
 
 
 # to parse tuples in yaml
@@ -63,7 +77,7 @@ class realfast_controller(Controller):
         - createproducts, boolean defining generation of mini-sdm,
         - indexresults, boolean defining push (meta)data to search index,
         - classify, run fetch classifier on its own gpu,
-        - throttle, integer defining slowing pipeline submission relative to realtime,
+        - throttle, float fraction of realtime to pace sdm segment submission at first, relaxed as segments complete and limited by a window of segments in flight adapted to cluster (AIMD). 0 or None disables,
         - read_overhead, throttle param requires multiple of vismem in a READERs memory,
         - read_totfrac, throttle param requires fraction of total READER memory be available,
         - searchintents, a list of intent names to search,
@@ -72,6 +86,10 @@ class realfast_controller(Controller):
         - index_with_fetch, boolean to force index onto fetchworkers,
         - index_with_reader, boolean to require index jobs to use a READER resource (avoiding read jobs).
         - max_cc, an integer that sets the maximum number of candidates in a segment that will be pushed to portal.
+        - shm_transport, boolean to pass segment data in /dev/shm when read and search share a node.
+        - subsegments, integer number of shorter segments to split each segment of realtime scans into (see pipeline.subsegment_state).
+        - overlap_cache, boolean to reuse integrations read for previous segment on same reader.
+        - merge_segments, boolean to hold segments until neighbours finish and merge boundary candidates.
         """
 
         super(realfast_controller, self).__init__()
@@ -88,14 +106,16 @@ class realfast_controller(Controller):
         else:
             self.client = distributed.Client(host)
 
+        # cached scheduler state shared by heuristics and properties
+        self.cluster = heuristics.ClusterView(self.client)
         self.states = {}
 
         # set futures from stored dataset, if it exists
         if 'futures' in self.client.list_datasets():
-            self.futures = self.client.get_dataset('futures')
+            self.futures = scheduling.SegmentRegistry.from_dict(self.client.get_dataset('futures'))
         else:
-            self.futures = {}
-            self.client.publish_dataset(futures=self.futures)
+            self.futures = scheduling.SegmentRegistry()
+            self.client.publish_dataset(futures=self.futures.to_dict())
 
         if 'finished' in self.client.list_datasets():
             self.finished = self.client.get_dataset('finished')
@@ -110,7 +130,40 @@ class realfast_controller(Controller):
             self.client.publish_dataset(errors=self.errors)
 
         self.futures_removed = {}
-        self.known_segments = {}
+        self.otf = {}  # scanId: OTFTracker
+        self.bytes_moved = {}  # scanId: bytes sent between hosts for search
+        self.stagestats = {}  # scanId: {stage: summed statistics}
+
+        # concurrent scan submissions take turns by read deadline
+        self.admission = scheduling.AdmissionController(
+            load=lambda scanId: (self.futures.count('pending', scanId=scanId)
+                                 if scanId in self.futures else 0))
+        self._submitters = {}  # scanId: submission thread
+        self._subqueue = {}  # scanId: list of (cfile, segments) for its thread
+        self._submit_lock = threading.Lock()
+        self._scan_lock = threading.Lock()  # first submission initializes scan
+
+        # sdm segments in flight adapt to completions and congestion
+        self.sdmthrottle = scheduling.AdaptiveThrottle()
+
+        # segment buffers shared on reader host are released after last use
+        self.shared = scheduling.ReleaseTracker()
+        self._lastsweep = 0
+
+        # finished segments wait for neighbours to merge boundary candidates
+        self.merger = scheduling.SegmentMerger()
+
+        # telcal files are parsed in background and wake waiting submission
+        self.telcal = telcal.TelcalWatcher(onready=self.admission.notify)
+        self.telcal.start()
+
+        # completed segments wake background cleanup thread
+        self._cleanup_request = threading.Event()
+        self._counts_lock = threading.Lock()  # finished and errors counts
+        self._cleanup_lock = threading.RLock()
+        self._submitting = []  # scanIds with ongoing submission
+        for record in self.futures.records():
+            self.watch(record.futures)
 
         # define attributes from yaml file
         self.preffile = preffile if preffile is not None else _preffile
@@ -138,13 +191,17 @@ class realfast_controller(Controller):
                     'atnf_radius', 'nvss_radius',
                     'read_overhead', 'read_totfrac', 'indexprefix', 'daskdir',
                     'requirecalibration', 'data_logging', 'index_with_fetch',
-                    'index_with_reader', 'max_cc']
+                    'index_with_reader', 'max_cc', 'shm_transport',
+                    'subsegments', 'overlap_cache', 'merge_segments',
+                    'gpu_per_search', 'search_depth']
 
         for attr in allattrs:
             if attr == 'indexprefix':
                 setattr(self, attr, 'new')
             elif attr == 'throttle':
                 setattr(self, attr, 0.8)  # submit relative to realtime
+            elif attr in ['gpu_per_search', 'search_depth']:
+                setattr(self, attr, 2)  # searches queued per set of GPUs
             elif 'index_with' in attr:
                 setattr(self, attr, False)
             elif attr == 'voevent':
@@ -166,10 +223,25 @@ class realfast_controller(Controller):
         # TODO: set defaults for these
         assert self.read_overhead and self.read_totfrac
 
+        self.statecache = StateCache(preffile=self.preffile, inprefs=self.inprefs,
+                                     subsegments=self.subsegments)
+
         self.who_has_count = 999  # initialize to ensure it is tested in submission loop
+
+        # scan status is coalesced and pushed in bulk from one thread
+        self.statuswriter = ScanStatusWriter(indexprefix=self.indexprefix)
+        if self.indexresults:
+            self.statuswriter.start()
+            elastic.get_spool().start()  # replay writes spooled before restart
+
         logger.info("Initialized controller with attributes {0} and inprefs {1}"
                     .format([(attr, getattr(self, attr)) for attr in allattrs], self.inprefs))
 
+        self._cleaner = threading.Thread(target=self.cleanup_worker,
+                                         name='realfast_cleanup')
+        self._cleaner.daemon = True
+        self._cleaner.start()
+
     def __repr__(self):
         return ('realfast controller with {0} jobs'
                 .format(self.nsegment))
@@ -179,59 +251,57 @@ class realfast_controller(Controller):
         """ Total number of segments submitted but not yet cleaned up
         """
 
-        return len([seg for (scanId, futurelist) in iteritems(self.futures)
-                    for seg, data, cc, acc in futurelist])
+        return self.futures.count()
 
     @property
     def statuses(self):
-        for (scanId, futurelist) in iteritems(self.futures):
-            for seg, data, cc, acc in futurelist:
-                if len(self.client.who_has()[data.key]):
-                    try:
-                        dataloc = self.workernames[self.client.who_has()[data.key][0]]
-                    except KeyError:
-                        dataloc = '[key lost]'
-                    logger.info('{0}, {1}: {2}, {3}, {4}. Data on {5}.'
-                                .format(scanId, seg, data.status, cc.status,
-                                        acc.status, dataloc))
-                else:
-                    logger.info('{0}, {1}: {2}, {3}, {4}.'
-                                .format(scanId, seg, data.status, cc.status,
-                                        acc.status))
+        who_has = self.cluster.who_has()
+        for record in self.futures.records():
+            scanId, seg, data, cc, acc = (record.scanId, record.segment,
+                                          record.data, record.cc, record.acc)
+            if len(who_has.get(data.key, ())):
+                try:
+                    dataloc = self.workernames[who_has[data.key][0]]
+                except KeyError:
+                    dataloc = '[key lost]'
+                logger.info('{0}, {1}: {2}, {3}, {4}. Data on {5}.'
+                            .format(scanId, seg, data.status, cc.status,
+                                    acc.status, dataloc))
+            else:
+                logger.info('{0}, {1}: {2}, {3}, {4}.'
+                            .format(scanId, seg, data.status, cc.status,
+                                    acc.status))
 
     @property
     def ncands(self):
-        for (scanId, futurelist) in iteritems(self.futures):
-            for seg, data, cc, acc in futurelist:
-                if acc.status == 'finished':
-                    ncands, mocks = acc.result()
-                    logger.info('{0}, {1}: {2} candidates'
-                                .format(scanId, seg, ncands))
-                else:
-                    logger.info('{0}, {1}: search not complete'
-                                .format(scanId, seg))
+        for record in self.futures.bucket('finished'):
+            ncands, mocks, stages = record.acc.result()
+            logger.info('{0}, {1}: {2} candidates'
+                        .format(record.scanId, record.segment, ncands))
+        for record in self.futures.bucket('pending'):
+            logger.info('{0}, {1}: search not complete'
+                        .format(record.scanId, record.segment))
 
     @property
     def exceptions(self):
-        return ['{0}, {1}: {2}, {3}'.format(scanId, seg, data.exception(),
-                                            cc.exception())
-                for (scanId, futurelist) in iteritems(self.futures)
-                for seg, data, cc, acc in futurelist
-                if data.status == 'error' or cc.status == 'error']
+        return ['{0}, {1}: {2}, {3}'.format(rec.scanId, rec.segment,
+                                            rec.data.exception(),
+                                            rec.cc.exception())
+                for rec in self.futures.bucket('error')
+                if rec.data.status == 'error' or rec.cc.status == 'error']
 
     @property
     def processing(self):
         return dict((self.workernames[k], v)
-                    for k, v in iteritems(self.client.processing()) if v)
+                    for k, v in iteritems(self.cluster.processing()) if v)
 
     @property
     def workernames(self):
-        return dict((k, v['id'])
-                    for k, v in iteritems(self.client.scheduler_info()['workers']))
+        return self.cluster.workernames
 
     @property
     def fetchworkers(self):
-        workers = [w for w in itervalues(self.workernames) if 'fetch' in w]
+        workers = self.cluster.fetchworkers
         if self.classify:
             if len(workers):
                 return workers
@@ -242,11 +312,13 @@ class realfast_controller(Controller):
 
     @property
     def reader_memory_available(self):
-        return heuristics.reader_memory_available(self.client)
+        return heuristics.reader_memory_available(self.cluster,
+                                                  shm=self.shared.nbytes())
 
     @property
     def reader_memory_used(self):
-        return heuristics.reader_memory_used(self.client)
+        return heuristics.reader_memory_used(self.cluster,
+                                             shm=self.shared.nbytes())
 
     @property
     def spilled_memory(self):
@@ -259,13 +331,30 @@ class realfast_controller(Controller):
         """ Show number of segments in scanId that are still pending
         """
 
-        return dict([(scanId,
-                      len(list(filter(lambda x: x[3].status == 'pending',
-                                      futurelist))))
-                     for scanId, futurelist in iteritems(self.futures)])
+        return dict([(scanId, self.futures.count('pending', scanId=scanId))
+                     for scanId in self.futures])
+
+    def nsdmpending(self):
+        """ Number of pending segments of sdm scans
+        """
+
+        return sum([self.futures.count('pending', scanId=scanId)
+                    for scanId in self.futures
+                    if scanId in self.states and
+                    self.states[scanId].metadata.datasource == 'sdm'])
+
+    @property
+    def nsearching(self):
+        """ Number of segments whose search has not completed
+        """
+
+        return len([rec for rec in self.futures.bucket('pending')
+                    if rec.cc.status == 'pending'])
 
     def initialize(self, timeout=200):
-        """ Check versions and run imports on workers to set them up for work.
+        """ Check versions and register WarmupPlugin to set up workers.
+        Plugin preloads imports, mock state, and FFTW wisdom (cached in
+        daskdir) at start of every worker, including workers that join later.
         timeout is time to wait in seconds for initialization of workers.
         """
 
@@ -273,18 +362,28 @@ class realfast_controller(Controller):
             logger.info("Waiting for workers to start...")
             sleep(5)
 
-        logger.info("Initializing workers: {0}".format(list(self.workernames.values())))
-#        logger.info("This should complete in about one minute, but sometimes fails. Use ctrl-c if it takes too long.")
-#        _ = self.client.run(util.initialize_worker)
-        jobs = [self.client.submit(util.initialize_worker, workers=w, pure=False) for w in list(self.workernames.values())]
-        starttime = time.Time.now().unix
+        rfpipeprefs = {}
+        if os.path.exists(self.preffile):
+            with open(self.preffile, 'r') as fp:
+                rfpipeprefs = yaml.load(fp, Loader=PrettySafeLoader).get('rfpipe', {})
+        plugin = util.WarmupPlugin(shapes=util.wisdom_shapes(rfpipeprefs),
+                                   wisdomdir=self.daskdir)
+        logger.info("Initializing workers {0} with wisdom for shapes {1}"
+                    .format(list(self.workernames.values()), plugin.shapes))
+
+        # registration returns when plugin setup has run on all workers
+        register = getattr(self.client, 'register_worker_plugin', None)
+        if register is None:
+            register = self.client.register_plugin
+        registration = threading.Thread(target=register, args=(plugin,),
+                                        name='realfast_initialize')
+        registration.daemon = True
+        registration.start()
         try:
-            while True:
-                if all([job.status=='finished' for job in jobs]) or time.Time.now().unix-starttime > timeout:
-                    break
-                else:
-                    logger.info("Waiting for workers to initialize...")
-                    sleep(5)
+            registration.join(timeout)
+            if registration.is_alive():
+                logger.warn("Worker initialization not done after {0}s. "
+                            "Continuing.".format(timeout))
         except KeyboardInterrupt:
             logger.warn("Exiting worker initialization. Some workers may still take time to start up.")
 
@@ -299,9 +398,11 @@ class realfast_controller(Controller):
         self.client.restart()
         sleep(5)
         self.states = {}
+        self.statecache = StateCache(preffile=self.preffile, inprefs=self.inprefs,
+                                     subsegments=self.subsegments)
         self.client.unpublish_dataset('futures')
-        self.futures = {}
-        self.client.publish_dataset(futures=self.futures)
+        self.futures = scheduling.SegmentRegistry()
+        self.client.publish_dataset(futures=self.futures.to_dict())
 
         self.client.unpublish_dataset('finished')
         self.finished = {}
@@ -312,13 +413,17 @@ class realfast_controller(Controller):
         self.client.publish_dataset(errors=self.errors)
 
         self.futures_removed = {}
-        self.known_segments = {}
+        self.otf = {}  # scanId: OTFTracker
+        self.bytes_moved = {}  # scanId: bytes sent between hosts for search
+        self.stagestats = {}  # scanId: {stage: summed statistics}
 
     def handle_config(self, config, cfile=_vys_cfile_prod, segments=None):
         """ Triggered when obs comes in.
         Downstream logic starts here.
         Default vys config file uses production parameters.
         segments arg can be used to submit a subset of all segments.
+        Segments are submitted in a background thread, so this returns
+        once the state is set.
 
         """
 
@@ -327,7 +432,9 @@ class realfast_controller(Controller):
         if search_config(config, preffile=self.preffile, inprefs=self.inprefs,
                          nameincludes=self.nameincludes,
                          searchintents=self.searchintents,
-                         ignoreintents=self.ignoreintents):
+                         ignoreintents=self.ignoreintents,
+                         inmeta={'datasource': 'vys'},
+                         statecache=self.statecache):
 
             # starting config of an OTF row will trigger subscan logic
             if config.otf:
@@ -339,13 +446,13 @@ class realfast_controller(Controller):
                 self.set_state(config.scanId, config=config,
                                inmeta={'datasource': 'vys'})
 
-                self.start_pipeline(config.scanId, cfile=cfile,
-                                    segments=segments)
+                self.submit_scan(config.scanId, cfile=cfile,
+                                 segments=segments)
 
         else:
             logger.info("Config not suitable for realfast. Skipping scan.")
 
-        self.cleanup()
+        self.request_cleanup()
 
     def handle_subscan(self, config, cfile=_vys_cfile_prod):
         """ Triggered when subscan info is updated (e.g., OTF mode).
@@ -366,74 +473,59 @@ class realfast_controller(Controller):
         if search_config(config, preffile=self.preffile, inprefs=self.inprefs,
                          nameincludes=self.nameincludes,
                          searchintents=self.searchintents,
-                         ignoreintents=self.ignoreintents):
+                         ignoreintents=self.ignoreintents,
+                         inmeta={'datasource': 'vys'},
+                         statecache=self.statecache):
             logger.warn("Config not suitable for realfast. Skipping subscan.")
             return
         else:
             logger.info("Config for subscan is searchable.")
 
-        # set up OTF info
-        # search pipeline needs [(startmjd, stopmjd, l1, m1), ...]
-        phasecenters = []
-        endtime_mjd_ = 0
-        for ss in config.subscans:
-            if ss.stopTime is not None:
-                if ss.stopTime > endtime_mjd_:
-                    endtime_mjd_ = ss.stopTime
-                phasecenters.append((ss.startTime, ss.stopTime,
-                                     ss.ra_deg, ss.dec_deg))
-        t0 = min([startTime for (startTime, _, _, _) in phasecenters])
-        t1 = max([stopTime for (_, stopTime, _, _) in phasecenters])
-        logger.info("Calculated {0} phasecenters from {1} to {2}"
-                    .format(len(phasecenters), t0, t1))
-
         # pass in first subscan and overload end time
         config0 = config.subscans[0]  # all tracked by first config of scan
+        scanId = config0.scanId
+        if scanId not in self.otf:
+            self.otf[scanId] = OTFTracker(scanId)
+        tracker = self.otf[scanId]
+
+        # search pipeline needs [(startmjd, stopmjd, l1, m1), ...]
+        nnew = tracker.update(config.subscans)
+        if not tracker.phasecenters:
+            logger.info("No complete subscans yet for scanId {0}".format(scanId))
+            return
+        elif nnew:
+            logger.info("Added {0} phasecenters for scanId {1} ({2} total to {3})"
+                        .format(nnew, scanId, len(tracker.phasecenters),
+                                tracker.endtime_mjd_))
+        elif scanId in self.states:
+            logger.info("No new subscans for scanId {0}".format(scanId))
+            return
+
         if config0.is_complete:
-            if config0.scanId in self.known_segments:
-                logger.info("Already submitted {0} segments for scanId {1}. "
-                            "Fast state calculation."
-                            .format(len(self.known_segments[config0.scanId]),
-                                    config0.scanId))
-                self.set_state(config0.scanId, config=config0, validate=False,
-                               showsummary=False,
-                               inmeta={'datasource': 'vys',
-                                       'endtime_mjd_': endtime_mjd_,
-                                       'nints_': None,
-                                       'phasecenters': phasecenters})
+            st = self.states.get(scanId)
+            st2 = tracker.extend(st) if st is not None else None
+            if st2 is not None:
+                self.states[scanId] = st2
+                logger.info("Extended state for scanId {0} to {1} segments"
+                            .format(scanId, st2.nsegment))
             else:
-                logger.info("No submitted segments for scanId {0}. Submitting "
-                            "Slow state calculation.".format(config0.scanId))
-                self.set_state(config0.scanId, config=config0,
-                               inmeta={'datasource': 'vys',
-                                       'endtime_mjd_': endtime_mjd_,
-                                       'nints_': None,
-                                       'phasecenters': phasecenters})
-
-            allsegments = list(range(self.states[config0.scanId].nsegment))
-            if config0.scanId not in self.known_segments:
-                logger.debug("Initializing known_segments with scanId {0}"
-                             .format(config0.scanId))
-                self.known_segments[config0.scanId] = []
+                logger.info("Setting state for scanId {0}".format(scanId))
+                self.set_state(scanId, config=config0,
+                               validate=st is None, showsummary=st is None,
+                               inmeta=tracker.inmeta)
 
             # get new segments
-            segments = [seg for seg in allsegments
-                        if seg not in self.known_segments[config0.scanId]]
+            segments = tracker.new_segments(self.states[scanId].nsegment)
 
             # TODO: this may not actually submit if telcal not ready
-            # should not update known_segments automatically?
+            # should not mark segments as known automatically?
             if len(segments):
                 logger.info("Starting pipeline for {0} with segments {1}"
-                            .format(config0.scanId, segments))
-                self.start_pipeline(config0.scanId, cfile=cfile,
-                                    segments=segments)
-                # now all (currently known segments) have been started
-                logger.info("Updating known_segments for {0} to {1}"
-                            .format(config0.scanId, allsegments))
-                self.known_segments[config0.scanId] = allsegments
+                            .format(scanId, segments))
+                self.submit_scan(scanId, cfile=cfile, segments=segments)
             else:
                 logger.info("No new segments to submit for {0}"
-                            .format(config0.scanId))
+                            .format(scanId))
         else:
             logger.info("First subscan config is not complete. Continuing.")
 
@@ -452,7 +544,7 @@ class realfast_controller(Controller):
 
         self.start_pipeline(scanId, segments=segments)
 
-        self.cleanup()
+        self.request_cleanup()
 
     def handle_meta(self, inmeta, cfile=_vys_cfile_test, segments=None):
         """ Parallel to handle_config, but allows metadata dict to be passed in.
@@ -469,28 +561,59 @@ class realfast_controller(Controller):
 
         self.start_pipeline(scanId, cfile=cfile, segments=segments)
 
-        self.cleanup()
+        self.request_cleanup()
+
+    def submit_scan(self, scanId, cfile=None, segments=None):
+        """ Run start_pipeline for scanId in its own thread and return.
+        Segments submitted while that thread is running are queued for it.
+        Concurrent scans share cluster via admission controller.
+        """
+
+        def run():
+            while True:
+                with self._submit_lock:
+                    if not self._subqueue[scanId]:
+                        _ = self._subqueue.pop(scanId)
+                        _ = self._submitters.pop(scanId)
+                        return
+                    cfile0, segments0 = self._subqueue[scanId].pop(0)
+
+                try:
+                    self.start_pipeline(scanId, cfile=cfile0, segments=segments0)
+                except Exception as exc:
+                    logger.exception("Submission failed for scanId {0}: {1}"
+                                     .format(scanId, exc))
+
+        with self._submit_lock:
+            if scanId in self._submitters:
+                self._subqueue[scanId].append((cfile, segments))
+                logger.info("Queued segments {0} for running submission of scanId {1}"
+                            .format(segments, scanId))
+                return self._submitters[scanId]
+
+            self._subqueue[scanId] = [(cfile, segments)]
+            thread = threading.Thread(target=run, name='submit_{0}'.format(scanId))
+            thread.daemon = True
+            self._submitters[scanId] = thread
+            thread.start()
+            logger.info("Started submission thread for scanId {0} ({1} active)"
+                        .format(scanId, len(self._submitters)))
+
+        return thread
 
     def set_state(self, scanId, config=None, inmeta=None, sdmfile=None,
                   sdmscan=None, bdfdir=None, validate=True, showsummary=True):
         """ Given metadata source, define state for a scanId.
         Uses metadata to set preferences used in preffile (prefsname).
         Preferences are then overloaded with self.inprefs.
+        State, prefsname, and preferences are reused from statecache.
         Will inject mock transient based on mockprob and other parameters.
         """
 
-        from rfpipe import preferences, state
-
-        prefsname = get_prefsname(inmeta=inmeta, config=config,
-                                  sdmfile=sdmfile, sdmscan=sdmscan,
-                                  bdfdir=bdfdir)
-
-        inprefs = preferences.parsepreffile(self.preffile, name=prefsname,
-                                            inprefs=self.inprefs)
-
-        st = state.State(inmeta=inmeta, config=config, inprefs=inprefs,
-                         sdmfile=sdmfile, sdmscan=sdmscan,
-                         bdfdir=bdfdir, validate=validate, showsummary=showsummary)
+        st = self.statecache.state(scanId, config=config, inmeta=inmeta,
+                                   sdmfile=sdmfile, sdmscan=sdmscan,
+                                   bdfdir=bdfdir, validate=validate,
+                                   showsummary=showsummary)
 
         logger.info('State set for scanId {0}. Requires {1:.1f} GB read and'
                     ' {2:.1f} GPU-sec to search.'
@@ -533,159 +656,301 @@ class realfast_controller(Controller):
             timeout = st.metadata.inttime*st.metadata.nints  # bit shorter than scan
         else:
             timeout = 0
-        throttletime = self.throttle*st.metadata.inttime*st.metadata.nints/st.nsegment
+        throttletime = (self.throttle or 0)*st.metadata.inttime*st.metadata.nints/st.nsegment
         logger.info('Submitting {0} segments for scanId {1}'.format(len(segments), scanId))
         logger.debug('Read_overhead {0}, read_totfrac {1}, and '
                      'with timeout {2}s'
                      .format(self.read_overhead, self.read_totfrac, timeout))
 
         try:
-            tot_memlim = self.read_totfrac*sum([v['resources']['MEMORY']
-                                                for v in itervalues(self.client.scheduler_info()['workers'])
-                                                if 'READER' in v['resources']])
+            tot_memlim = self.read_totfrac*self.cluster.reader_memory_total
         except KeyError:
             tot_memlim = 5.6e11
 
+        # queue segments by read deadline for admission across scans
+        if st.metadata.datasource in ['vys', 'sim']:
+            deadlines = dict((seg, time.Time(st.segmenttimes[seg][0],
+                                             format='mjd').unix + _submit_window)
+                             for seg in segments)
+        else:
+            deadlines = dict((seg, None) for seg in segments)
+        self.admission.enqueue(scanId, deadlines)
+
         # submit segments
         nsubmitted = 0  # count number submitted from list segments
-        justran = 0  # track if function just ran
         segments = iter(segments)
         segment = next(segments)
         telcalset = self.set_telcalfile(scanId)
         t0 = time.Time.now().unix
-        while True:
-            segsubtime = time.Time.now().unix
-            elapsedtime = segsubtime - t0
-            if (elapsedtime > timeout) and timeout:
-                logger.info("Submission timed out. Submitted {0}/{1} segments "
-                            "in ScanId {2}".format(nsubmitted, st.nsegment,
-                                                   scanId))
-                break
+        lastlog = 0  # time of last "not ready" report
+        lastreader = None  # consecutive segments reuse overlap on same reader
+        sthandle = None  # st published to cluster at first submission
+        sthandle_gainfile = None  # published again if telcal sets gainfile
+        self._submitting.append(scanId)  # cleanup must not remove this scanId
+        ready = partial(self.cluster_ready, w_memlim, tot_memlim)
+        try:
+            while True:
+                segsubtime = time.Time.now().unix
+                elapsedtime = segsubtime - t0
+                if (elapsedtime > timeout) and timeout:
+                    logger.info("Submission timed out. Submitted {0}/{1} segments "
+                                "in ScanId {2}".format(nsubmitted, st.nsegment,
+                                                       scanId))
+                    break
+
+                starttime, endtime = time.Time(st.segmenttimes[segment],
+                                               format='mjd').unix
+                if st.metadata.datasource in ['vys', 'sim']:
+                    # TODO: define buffer delay better
+                    if segsubtime > starttime+_submit_window:
+                        logger.warning("Segment {0} time window has passed ({1} > {2}). Skipping."
+                                       .format(segment, segsubtime, starttime+_submit_window))
+                        self.admission.dequeue(scanId, [segment])
+                        try:
+                            segment = next(segments)
+                            continue
+                        except StopIteration:
+                            logger.debug("No more segments for scanId {0}"
+                                         .format(scanId))
+                            break
+                    elif segsubtime < starttime-10:
+                        logger.info("Waiting {0:.1f}s to submit segment."
+                                    .format((starttime-10)-segsubtime))
+                        sleep((starttime-10)-segsubtime)
+                elif st.metadata.datasource == 'sdm' and self.throttle:
+                    if not self.sdmthrottle.wait(self.nsdmpending,
+                                                 timeout=_capacity_timeout,
+                                                 interval=throttletime):
+                        continue
+
+                # telcal parsed by watcher thread, so this is cheap
+                if not telcalset and self.requirecalibration:
+                    telcalset = self.set_telcalfile(scanId)
+                    if telcalset:
+                        logger.info("Set calibration for scanId {0}".format(scanId))
+
+                # submit if telcal available and admitted when cluster ready
+                telcal_ok = telcalset if self.requirecalibration else True
+                admitted = telcal_ok and self.admission.admit(scanId, segment, ready,
+                                                              timeout=_capacity_timeout)
+                self.admission.report_misses()
+                if admitted:
+
+                    # first time initialize scan
+                    with self._scan_lock:
+                        if scanId not in self.futures:
+                            self.futures.add_scan(scanId)
+                            with self._counts_lock:
+                                self.errors[scanId] = 0
+                                self.finished[scanId] = 0
+
+                            if self.indexresults:
+                                elastic.indexscan(inmeta=self.states[scanId].metadata,
+                                                  preferences=self.states[scanId].prefs,
+                                                  indexprefix=self.indexprefix)
+                            else:
+                                logger.info("Not indexing scan or prefs.")
+
+                    placement = heuristics.colocated_workers(self.cluster,
+                                                             w_memlim, segment,
+                                                             prefer=lastreader,
+                                                             shm=self.shared.nbytes())
+                    lastreader = placement[0] if self.overlap_cache else None
+                    shmdir = util._shmdir if self.shm_transport else None
+                    if sthandle is None or st.gainfile != sthandle_gainfile:
+                        sthandle = pipeline.scatter_state(self.client, st)
+                        sthandle_gainfile = st.gainfile
+                    futures = pipeline.pipeline_seg(st, segment, cl=self.client,
+                                                    cluster=self.cluster,
+                                                    cfile=cfile,
+                                                    vys_timeout=vys_timeout,
+                                                    mem_read=w_memlim,
+                                                    mem_search=2*st.vismem*1e9,
+                                                    mockseg=mockseg,
+                                                    placement=placement,
+                                                    shmdir=shmdir,
+                                                    overlap=bool(self.overlap_cache),
+                                                    sthandle=sthandle)
+                    self.futures.add(scanId, futures)
+                    self.watch(futures)
+                    if st.metadata.datasource == 'sdm':
+                        self.sdmthrottle.submitted()
+                        futures[3].add_done_callback(self.sdmthrottle.completed)
+                    nsubmitted += 1
+
+                    segment, data, cc, acc = futures
+
+                    # shared buffer lives on reader host until search and products are done
+                    logkwargs = {}
+                    if pipeline.shares_segment(placement, shmdir):
+                        reader = placement[0]
+                        self.shared.hold((scanId, segment),
+                                         partial(self.release_segment, data, reader),
+                                         location=reader, nbytes=st.vismem*1e9)
+                        self.shared.use((scanId, segment), cc)
+                        logkwargs = {'workers': [self.cluster.host(reader)],
+                                     'allow_other_workers': False}
+
+                    if self.data_logging:
+                        fut = self.client.submit(util.data_logger, sthandle, segment,
+                                                 data, retries=1, **logkwargs)
+                        self.shared.use((scanId, segment), fut)
+                        distributed.fire_and_forget(fut)
+
+                    if self.indexresults:
+                        self.statuswriter.update(scanId,
+                                                 pending=self.futures.count('pending', scanId=scanId),
+                                                 finished=self.finished[scanId],
+                                                 errors=self.errors[scanId],
+                                                 nsegment=st.nsegment)
 
-            starttime, endtime = time.Time(st.segmenttimes[segment],
-                                           format='mjd').unix
-            if st.metadata.datasource in ['vys', 'sim']:
-                # TODO: define buffer delay better
-                if segsubtime > starttime+3:
-                    logger.warning("Segment {0} time window has passed ({1} > {2}). Skipping."
-                                   .format(segment, segsubtime, starttime+3))
                     try:
                         segment = next(segments)
-                        continue
                     except StopIteration:
-                        logger.debug("No more segments for scanId {0}"
-                                     .format(scanId))
+                        logger.info("No more segments for scanId {0}".format(scanId))
                         break
-                elif segsubtime < starttime-10:
-                    logger.info("Waiting {0:.1f}s to submit segment."
-                                .format((starttime-10)-segsubtime))
-                    sleep((starttime-10)-segsubtime)
-            elif st.metadata.datasource == 'sdm':
-                sleep(throttletime)
-
-            # try setting telcal
-            if not telcalset and self.requirecalibration:
-                telcalset = self.set_telcalfile(scanId)
-                if telcalset:
-                    logger.info("Set calibration for scanId {0}".format(scanId))
+
                 else:
-                    logger.info("Telcal not ready. Waiting {0:.1f} s...".format(throttletime))
-                    sleep(throttletime)
+                    shm = self.shared.nbytes()
+                    memory_ok = heuristics.reader_memory_ok(self.cluster, w_memlim,
+                                                            shm=shm)
+                    totalmemory_ok = heuristics.readertotal_memory_ok(self.cluster,
+                                                                      tot_memlim,
+                                                                      shm=shm)
+                    if not (memory_ok and totalmemory_ok) and st.metadata.datasource == 'sdm':
+                        self.sdmthrottle.congested()
+                    if segsubtime - lastlog > 20:  # report every 20 sec
+                        if not memory_ok:
+                            logger.info("System not ready. No reader available with required memory {0}"
+                                        .format(w_memlim))
+                        elif not totalmemory_ok:
+                            logger.info("System not ready. Total reader memory exceeds limit of {0}"
+                                        .format(tot_memlim))
+                        elif not telcal_ok:
+                            logger.info("System not ready. No telcalfile available for {0}"
+                                        .format(scanId))
+                        elif not self.gpu_ok():
+                            logger.info("System not ready. GPUs busy with {0} searches"
+                                        .format(self.nsearching))
+                        else:
+                            logger.info("Waiting for turn to submit {0}, segment {1} "
+                                        "({2} segments waiting)"
+                                        .format(scanId, segment, len(self.admission.waiting)))
+                        if not (memory_ok and totalmemory_ok):
+                            self.client.run(gc.collect)
+                            self.request_cleanup()
+                        lastlog = segsubtime
+
+                    if not telcal_ok:
+                        self.telcal.wait(scanId, timeout=_capacity_timeout)
+        finally:
+            self._submitting.remove(scanId)
+            self.admission.dequeue(scanId, list(deadlines))
+
+            # cleanup only finds scans with futures, so stop watching others here
+            with self._scan_lock:
+                if scanId not in self.futures and scanId not in self._submitting:
+                    self.telcal.unwatch(scanId)
+            self.request_cleanup()  # release segments held for unsubmitted neighbours
+
+    def submit_products(self, scanId, segment, cc, data):
+        """ Submit createproducts for cc and data of segment. Shared buffer
+        of segment is kept on its reader host until products are made.
+        """
 
-            # submit if cluster ready and telcal available
-            if (heuristics.reader_memory_ok(self.client, w_memlim) and
-                heuristics.readertotal_memory_ok(self.client, tot_memlim) and
-                (telcalset if self.requirecalibration else True)):
+        cpkwargs = {}
+        reader = self.shared.location((scanId, segment))
+        if reader is not None:
+            cpkwargs = {'workers': [self.cluster.host(reader)],
+                        'allow_other_workers': False}
+        fut_cp = self.client.submit(util.createproducts, cc, data,
+                                    indexprefix=self.indexprefix,
+                                    nvss_radius=self.nvss_radius,
+                                    retries=1, **cpkwargs)
+        self.shared.use((scanId, segment), fut_cp)
+        distributed.fire_and_forget(fut_cp)
+
+    def cluster_ready(self, w_memlim, tot_memlim):
+        """ Test whether a READER has w_memlim, total use is below tot_memlim,
+        and GPUs can take another search.
+        """
 
-                # first time initialize scan
-                if scanId not in self.futures:
-                    self.futures[scanId] = []
-                    self.errors[scanId] = 0
-                    self.finished[scanId] = 0
+        shm = self.shared.nbytes()
+        return (heuristics.reader_memory_ok(self.cluster, w_memlim, shm=shm) and
+                heuristics.readertotal_memory_ok(self.cluster, tot_memlim, shm=shm) and
+                self.gpu_ok())
 
-                    if self.indexresults:
-                        elastic.indexscan(inmeta=self.states[scanId].metadata,
-                                          preferences=self.states[scanId].prefs,
-                                          indexprefix=self.indexprefix)
-                    else:
-                        logger.info("Not indexing scan or prefs.")
-
-                futures = pipeline.pipeline_seg(st, segment, cl=self.client,
-                                                cfile=cfile,
-                                                vys_timeout=vys_timeout,
-                                                mem_read=w_memlim,
-                                                mem_search=2*st.vismem*1e9,
-                                                mockseg=mockseg)
-                self.futures[scanId].append(futures)
-                nsubmitted += 1
-
-                segment, data, cc, acc = futures
-
-                if self.data_logging:
-                    distributed.fire_and_forget(self.client.submit(util.data_logger,
-                                                                   st, segment,
-                                                                   data,
-                                                                   retries=1))
+    def gpu_ok(self):
+        """ Test whether GPUs can take another search, given configured
+        gpu_per_search and search_depth.
+        """
 
-                if self.indexresults:
-                    distributed.fire_and_forget(self.client.submit(elastic.indexscanstatus,
-                                                                   scanId,
-                                                                   indexprefix=self.indexprefix,
-                                                                   pending=self.pending[scanId],
-                                                                   finished=self.finished[scanId],
-                                                                   errors=self.errors[scanId],
-                                                                   nsegment=st.nsegment,
-                                                                   retries=1))
+        return heuristics.gpu_ok(self.cluster, self.nsearching,
+                                 gpu_per_search=self.gpu_per_search,
+                                 depth=self.search_depth)
 
-                try:
-                    segment = next(segments)
-                except StopIteration:
-                    logger.info("No more segments for scanId {0}".format(scanId))
-                    break
+    def watch(self, futures):
+        """ Register completion callbacks on a segment's futures.
+        Completed work frees cluster memory, so it wakes waiting submission.
+        Completion also asks cleanup thread to run.
+        """
 
-            else:
-                if not heuristics.reader_memory_ok(self.client, w_memlim):
-                    if not (int(segsubtime-t0) % 20) and not justran:  # every 20 sec
-                        logger.info("System not ready. No reader available with required memory {0}"
-                                    .format(w_memlim))
-                        self.client.run(gc.collect)
-                        self.cleanup(keep=scanId)  # do not remove keys of ongoing submission
-                        justran = 1
-                    elif (int(segsubtime-t0) % 20):
-                        justran = 0
-                elif not heuristics.readertotal_memory_ok(self.client,
-                                                          tot_memlim):
-                    if not (int(segsubtime-t0) % 20) and not justran:  # every 20 sec
-                        logger.info("System not ready. Total reader memory exceeds limit of {0}"
-                                    .format(tot_memlim))
-                        self.client.run(gc.collect)
-                        self.cleanup(keep=scanId)  # do not remove keys of ongoing submission
-                        justran = 1
-                    elif (int(segsubtime-t0) % 20):
-                        justran = 0
-                elif not (telcalset if self.requirecalibration else True):
-                    if not (int(segsubtime-t0) % 5) and not justran:  # every 5 sec
-                        logger.info("System not ready. No telcalfile available for {0}"
-                                    .format(scanId))
-                        self.cleanup(keep=scanId)  # do not remove keys of ongoing submission
-                        justran = 1
-                    elif (int(segsubtime-t0) % 5):
-                        justran = 0
-
-            # periodically check on submissions
-            if not (int(segsubtime-t0) % 5) and not justran:
-                self.cleanup(keep=scanId)  # do not remove keys of ongoing submission
-                justran = 1
-            elif (int(segsubtime-t0) % 5):
-                justran = 0
+        for fut in futures[1:]:
+            fut.add_done_callback(self._segment_done)
+
+    def _segment_done(self, fut):
+        """ Callback run by client when a segment future completes.
+        """
+
+        self.admission.notify()
+        self._cleanup_request.set()
+
+    def request_cleanup(self):
+        """ Ask cleanup thread to run soon. Does not block.
+        """
+
+        self._cleanup_request.set()
+
+    def cleanup_worker(self):
+        """ Runs cleanup in background as segments complete.
+        Completion callbacks request a cleanup. Cleanup also runs
+        periodically while segments are pending (e.g., to find lost keys).
+        """
+
+        lastcleanup = 0
+        while True:
+            requested = self._cleanup_request.wait(timeout=_cleanup_period)
+            self._cleanup_request.clear()
+
+            if not (requested or self.futures.count('pending')):
+                continue
+
+            now = time.Time.now().unix
+            if now - lastcleanup < _cleanup_interval:
+                sleep(_cleanup_interval - (now - lastcleanup))  # gather more
+
+            try:
+                self.cleanup()
+            except Exception as exc:
+                logger.exception("Cleanup failed: {0}".format(exc))
+            lastcleanup = time.Time.now().unix
 
     def cleanup(self, badstatuslist=['cancelled', 'error', 'lost'], keep=None):
         """ Clean up job list.
         Scans futures, removes finished jobs, and pushes results to relevant indices.
         badstatuslist can include 'cancelled', 'error', 'lost'.
         keep defines a scanId (string) key that should not be removed from dicts.
+        scanIds with ongoing submission are always kept.
+        Thread safe. Normally run by cleanup_worker.
         """
 
+        keep = set([keep] if isinstance(keep, str) else keep or [])
+        with self._cleanup_lock:
+            self._cleanup(badstatuslist=badstatuslist,
+                          keep=keep.union(set(self._submitting)))
+
+    def _cleanup(self, badstatuslist, keep):
+
         # update shared list of futures
         removed = 0
 
@@ -704,16 +969,22 @@ class realfast_controller(Controller):
                                 ','.join(scanIds)))
 
         # run memory logging
+        workers = self.cluster.workers
         try:
-            memory_summary = ','.join(['({0}, {1})'.format(v['id'], v['metrics']['memory']/1e9) for k, v in iteritems(self.client.scheduler_info()['workers']) if v['metrics']['memory']/1e9 > 14])
+            memory_summary = ','.join(['({0}, {1})'.format(v['id'], v['metrics']['memory']/1e9) for k, v in iteritems(workers) if v['metrics']['memory']/1e9 > 14])
         except KeyError:
             memory_summary = '(KeyError)'
         if memory_summary:
             logger.info("High memory usage on cluster: {0}".format(memory_summary))
-            workers_highmem = [k for k, v in iteritems(self.client.scheduler_info()['workers']) if v['metrics']['memory']/1e9 > 14]
+            workers_highmem = [k for k, v in iteritems(workers) if v['metrics']['memory']/1e9 > 14]
             for w in workers_highmem:
                 distributed.fire_and_forget(self.client.submit(logging_statement, memory_summary, workers=workers_highmem, pure=False))
 
+        # shared buffers cannot be searched without GPU worker on their host
+        if self.shm_transport:
+            self.cancel_stranded()
+            self.sweep_segments()
+
         # clean futures and get finished jobs
         removed = self.removefutures(badstatuslist)
         for scanId in self.futures:
@@ -722,20 +993,17 @@ class realfast_controller(Controller):
             workdir = self.states[scanId].prefs.workdir if scanId in self.states else '/lustre/evla/test/realfast'
 
             # check on finished
-            finishedlist = [(seg, data, cc, acc)
-                            for (scanId0, futurelist) in iteritems(self.futures)
-                            for seg, data, cc, acc in futurelist
-                            if (acc.status == 'finished') and
-                               (scanId0 == scanId)]
-            self.finished[scanId] += len(finishedlist)
+            finishedlist = [rec.futures for rec in
+                            self.futures.bucket('finished', scanId=scanId)]
+            with self._counts_lock:
+                self.finished[scanId] += len(finishedlist)
+            if finishedlist:
+                self.record_stages(scanId, finishedlist)
             if self.indexresults:
-                distributed.fire_and_forget(self.client.submit(elastic.indexscanstatus,
-                                            scanId,
-                                            indexprefix=self.indexprefix,
-                                            pending=self.pending[scanId],
-                                            finished=self.finished[scanId],
-                                            errors=self.errors[scanId],
-                                            retries=1))
+                self.statuswriter.update(scanId,
+                                         pending=self.futures.count('pending', scanId=scanId),
+                                         finished=self.finished[scanId],
+                                         errors=self.errors[scanId])
 
             # index mocks from special workers
             if self.indexresults:
@@ -747,14 +1015,37 @@ class realfast_controller(Controller):
                                                                    indexprefix=self.indexprefix,
                                                                    retries=1))
 
+            # remove job from list (merger holds cc of unreleased segments)
+            for (seg, data, cc, acc) in finishedlist:
+                self.futures.remove(scanId, seg)
+                removed += 1
+
+            # merge candidates at boundaries with neighbouring segments
+            if self.merge_segments:
+                # products are made now, so data is not held while merging
+                if self.createproducts:
+                    for (seg, data, cc, acc) in finishedlist:
+                        self.submit_products(scanId, seg, cc, data)
+                for (seg, data, cc, acc) in finishedlist:
+                    self.merger.add(scanId, seg, cc)
+                pending = [rec.segment for rec in self.futures.records(scanId)]
+                nsegment = self.states[scanId].nsegment if scanId in self.states else None
+                readylist = self.merger.release(scanId, pending, nsegment=nsegment,
+                                                final=scanId not in self._submitting)
+                ccs = [self.client.submit(pipeline.merge_candidates, cc, *neighbours,
+                                          retries=1)
+                       for (seg, cc, neighbours) in readylist]
+            else:
+                ccs = [cc for (seg, data, cc, acc) in finishedlist]
+
+            if self.indexresults:
                 # returns cc from each future
                 partial_icp = partial(util.indexcands_and_plots, scanId=scanId, tags=self.tags,
                                       nvss_radius=self.nvss_radius, atnf_radius=self.atnf_radius,
                                       indexprefix=self.indexprefix, workdir=workdir, max_cc=self.max_cc)
-                fut_icp = self.client.map(partial_icp, [cc for (seg, data, cc, acc) in finishedlist],
-                                          **indexkwargs)
+                fut_icp = self.client.map(partial_icp, ccs, **indexkwargs)
             else:
-                fut_icp = [cc for (seg, data, cc, acc) in finishedlist]
+                fut_icp = ccs
 
             # classify cands on special workers
             if self.classify:
@@ -765,15 +1056,12 @@ class realfast_controller(Controller):
                                                             resources={'GPU': 1}))
 
             # optionally save and archive sdm/bdfs for segment
-            if self.createproducts:
+            if self.createproducts and not self.merge_segments:
 # this fails with "indexprefix argument appears twice" kind of error. some issue with using partial.
 #                fdlist = [(fut, data) for (fut, (seg, data, cc, acc)) in zip(fut_icp, finishedlist)]
 #                partial_cp = partial(util.createproducts, indexprefix=self.indexprefix)
                 for (fut, (seg, data, cc, acc)) in zip(fut_icp, finishedlist):
-                    distributed.fire_and_forget(self.client.submit(util.createproducts, fut, data,
-                                                                   indexprefix=self.indexprefix,
-                                                                   nvss_radius=self.nvss_radius,
-                                                                   retries=1))
+                    self.submit_products(scanId, seg, fut, data)
 
             if self.voevent is not False:
                 partial_sv = partial(util.send_voevent, dm=self.voevent,
@@ -784,44 +1072,56 @@ class realfast_controller(Controller):
                 distributed.fire_and_forget(self.client.map(partial_sv, fut_icp,
                                                             retries=1))
 
-            # remove job from list
-            for futures in finishedlist:
-                self.futures[scanId].remove(futures)
-                removed += 1
+            for (seg, data, cc, acc) in finishedlist:
+                self.shared.drop((scanId, seg))
 
-            del fut_icp  # to avoid mixing references?
+            del fut_icp, ccs  # to avoid mixing references?
 
         # clean up self.futures
         removeids = [scanId for scanId in self.futures
-                     if (len(self.futures[scanId]) == 0) and (scanId != keep)]
+                     if (self.futures.count(scanId=scanId) == 0) and (scanId not in keep)]
         if removeids:
             logstr = ("No jobs left for scanIds: {0}."
                       .format(', '.join(removeids)))
-            if keep is not None:
+            if keep:
                 logstr += (". Cleaning state and futures dicts (keeping {0})"
-                           .format(keep))
+                           .format(', '.join(keep)))
             else:
                 logstr += ". Cleaning state and futures dicts."
             logger.info(logstr)
 
             for scanId in removeids:
-                _ = self.futures.pop(scanId)
-                _ = self.finished.pop(scanId)
-                _ = self.errors.pop(scanId)
+                self.futures.remove_scan(scanId)
+                self.merger.remove_scan(scanId)
+                self.statuswriter.remove(scanId)
+                self.statecache.evict(scanId)
+                self.telcal.unwatch(scanId)
+                if self.overlap_cache:
+                    self.client.run(pipeline.clear_overlap, scanId,
+                                    workers=self.cluster.readers)
+                with self._counts_lock:
+                    _ = self.finished.pop(scanId)
+                    _ = self.errors.pop(scanId)
+                _ = self.bytes_moved.pop(scanId, None)
+                if scanId in self.stagestats:
+                    logger.info("Stage summary for scanId {0}: {1}"
+                                .format(scanId, self.stage_summary(scanId)))
+                    _ = self.stagestats.pop(scanId)
                 try:
                     _ = self.states.pop(scanId)
                 except KeyError:
                     pass
                 try:
-                    _ = self.known_segments.pop(scanId)
+                    _ = self.otf.pop(scanId)
                 except KeyError:
                     pass
 
         # hack to clean up residual jobs in bokeh
-        if not len(self.processing) and len(self.client.who_has()) and (len(self.client.who_has()) != self.who_has_count):
-            self.who_has_count = len(self.client.who_has())
+        who_has = self.cluster.who_has()
+        if not len(self.processing) and len(who_has) and (len(who_has) != self.who_has_count):
+            self.who_has_count = len(who_has)
             logger.info("Retrying {0} scheduler jobs without futures."
-                        .format(len(self.client.who_has())))
+                        .format(len(who_has)))
             self.cleanup_retry()
             sleep(5)
             self.client.run(gc.collect)
@@ -835,9 +1135,11 @@ class realfast_controller(Controller):
         self.client.unpublish_dataset('futures')
         self.client.unpublish_dataset('finished')
         self.client.unpublish_dataset('errors')
-        self.client.publish_dataset(futures = self.futures)
-        self.client.publish_dataset(finished = self.finished)
-        self.client.publish_dataset(errors = self.errors)
+        self.client.publish_dataset(futures = self.futures.to_dict())
+        with self._counts_lock:
+            finished, errors = dict(self.finished), dict(self.errors)
+        self.client.publish_dataset(finished = finished)
+        self.client.publish_dataset(errors = errors)
 
     def cleanup_retry(self, timeout=30):
         """ Get futures from client who_has and retry them.
@@ -848,8 +1150,8 @@ class realfast_controller(Controller):
         t0 = time.Time.now().unix
 
         futs = []
-        for k in self.client.who_has():
-            if 'read' in k or 'prep' in k:
+        for k in self.cluster.who_has():
+            if key_split(k) in _retry_tasks:
                 logger.info("Retrying {0}".format(k))
                 fut = distributed.Future(k)
                 fut.retry()
@@ -897,32 +1199,99 @@ class realfast_controller(Controller):
             sleep(5)
 
     def set_telcalfile(self, scanId):
-        """ Find and set telcalfile in state prefs, if not set already.
-        Returns True if set, False if not available.
+        """ Watch for telcalfile of scanId. Watcher sets it in state prefs.
+        Returns True if good solutions are available, False if not.
         """
 
-        from rfpipe.calibration import getsols
+        self.telcal.watch(scanId, self.states[scanId])
+        return self.telcal.ready(scanId)
 
-        st = self.states[scanId]
+    def release_segment(self, data, reader):
+        """ Remove shared buffer of data on host of its reader.
+        """
 
-        # try to find file
-        if st.gainfile is None:
-            gainfile = ''
-            today = datetime.now(timezone.utc)
-            directory = '/home/mchammer/evladata/telcal/{0}/{1:02}'.format(today.year, today.month)
-            name = '{0}.GN'.format(st.metadata.datasetId)
-            gainfile = os.path.join(directory, name)
-            if os.path.exists(gainfile) and os.path.isfile(gainfile):
-                logger.debug("Found telcalfile {0} for scanId {1}."
-                             .format(gainfile, scanId))
-                st.prefs.gainfile = gainfile
-
-        # parse sols to test whether good ones exist
-        sols = getsols(st)
-        if len(sols) and not all(sols['flagged']):
-            return True
-        else:
-            return False
+        distributed.fire_and_forget(self.client.submit(util.release_segment, data,
+                                                       workers=[self.cluster.host(reader)],
+                                                       allow_other_workers=False,
+                                                       pure=False))
+
+    def cancel_stranded(self):
+        """ Cancel pending segments with shared buffer on a host that has no
+        GPU worker left to search it (or no READER left to read it).
+        Cancelled segments are removed by cleanup, which releases the buffer.
+        """
+
+        gpuhosts = self.cluster.by_host('GPU')
+        readerhosts = self.cluster.by_host('READER')
+        for record in self.futures.bucket('pending'):
+            reader = self.shared.location(record.key)
+            if reader is None:
+                continue
+
+            host = self.cluster.host(reader)
+            if host in gpuhosts and (host in readerhosts or record.data.status != 'pending'):
+                continue
+
+            logger.warn("No worker left on host {0} for segment {1} of scanId {2}. "
+                        "Cancelling it.".format(host, record.segment, record.scanId))
+            self.client.cancel([record.data, record.cc, record.acc])
+
+    def sweep_segments(self):
+        """ Remove segment buffers left in shared memory of READERs (e.g.,
+        by a worker or controller restart). Runs at most every
+        _shm_sweep_interval seconds.
+        """
+
+        now = time.Time.now().unix
+        if now - self._lastsweep < _shm_sweep_interval:
+            return
+
+        self._lastsweep = now
+        removed = self.client.run(util.sweep_segments, util._shmdir,
+                                  _shm_maxage, workers=self.cluster.readers)
+        nremoved = sum([len(paths) for paths in itervalues(removed)])
+        if nremoved:
+            logger.info("Removed {0} stale segment buffers from READERs"
+                        .format(nremoved))
+
+    def record_stages(self, scanId, futurelist):
+        """ Add stage statistics of finished segments to stagestats.
+        Sums all statistics over segments, except maxrss and maxrss_delta
+        which are maximum.
+        Also adds bytes of segment data moved between hosts from read to
+        search to bytes_moved.
+        """
+
+        accs = self.client.gather([acc for (seg, data, cc, acc) in futurelist])
+        totals = self.stagestats.setdefault(scanId, {})
+        for (seg, data, cc, acc), (ncands, mocks, stages) in zip(futurelist, accs):
+            moved = heuristics.bytes_moved(stages)
+            self.bytes_moved[scanId] = self.bytes_moved.get(scanId, 0) + moved
+            if moved:
+                logger.info("Segment {0} of scanId {1} moved {2:.2f} GB between hosts"
+                            .format(seg, scanId, moved/1e9))
+
+            for name, stats in iteritems(stages):
+                total = totals.setdefault(name, {'n': 0, 'wall': 0., 'cpu': 0.,
+                                                 'bytes_in': 0, 'bytes_out': 0,
+                                                 'maxrss': 0, 'maxrss_delta': 0})
+                total['n'] += 1
+                for key in ['wall', 'cpu', 'bytes_in', 'bytes_out']:
+                    total[key] += stats[key]
+                for key in ['maxrss', 'maxrss_delta']:
+                    total[key] = max(total[key], stats.get(key, 0))
+
+    def stage_summary(self, scanId):
+        """ String with mean time and peak memory per stage for scanId.
+        Peak memory is of worker process, with largest increase in stage.
+        """
+
+        return ', '.join(['{0}: {1:.1f}s wall, {2:.1f}s cpu, {3:.2f} GB process peak '
+                          '(+{4:.2f} GB)'
+                          .format(name, total['wall']/total['n'],
+                                  total['cpu']/total['n'], total['maxrss']/1e9,
+                                  total['maxrss_delta']/1e9)
+                          for name, total in iteritems(self.stagestats.get(scanId, {}))])
 
     def removefutures(self, badstatuslist=['cancelled', 'error', 'lost'],
                       keep=False):
@@ -934,22 +1303,33 @@ class realfast_controller(Controller):
         if isinstance(badstatuslist, str):
             badstatuslist = [badstatuslist]
 
+        if 'lost' in badstatuslist:
+            self.futures.refresh()  # lost futures do not trigger callbacks
+
+        # map future statuses to registry buckets
+        buckets = [status for status in scheduling.statuses
+                   if status in badstatuslist]
+        if 'cancelled' in badstatuslist and 'error' not in buckets:
+            buckets.append('error')
+
         removed = 0
+        who_has = None
         for scanId in self.futures:
             # create list of futures (a dict per segment) that are cancelled
+            removelist = [rec.futures for status in buckets
+                          for rec in self.futures.bucket(status, scanId=scanId)
+                          if status != 'error' or
+                          any([fut.status in badstatuslist
+                               for fut in (rec.data, rec.cc, rec.acc)])]
+            if not removelist:
+                continue
 
-            removelist = [(seg, data, cc, acc)
-                          for (scanId0, futurelist) in iteritems(self.futures)
-                          for seg, data, cc, acc in futurelist
-                          if ((data.status in badstatuslist) or
-                              (cc.status in badstatuslist) or
-                              (acc.status in badstatuslist)) and
-                             (scanId0 == scanId)]
-
-            self.errors[scanId] += len(removelist)
+            with self._counts_lock:
+                self.errors[scanId] += len(removelist)
 
             # print status
-            who_has = self.client.who_has()
+            if who_has is None:
+                who_has = self.cluster.who_has()
             for removefuts in removelist:
                 (seg, data, cc, acc) = removefuts
                 if data.key in who_has:
@@ -968,17 +1348,16 @@ class realfast_controller(Controller):
                                 .format(scanId, seg, data.status, cc.status,
                                         acc.status, dataloc))
 
-            # first, clean up dropped keys
+            # first, report dropped keys
             lostjobs = [fut for futs in removelist for fut in futs[1:] if fut.key not in who_has]
             if len(lostjobs):
                 logger.warn("Some futures in removelist have no key in client.")
             for futures in removelist:
-                if any([fut in lostjobs for fut in futures]):
+                if any([fut in lostjobs for fut in futures[1:]]):
                     logger.warn("Removing scanId {0} and futures {1}".format(scanId, futures))
-                    self.futures[scanId].remove(futures)
 
             # next, clean up errors
-            errworkers = [(fut, self.client.who_has(fut))
+            errworkers = [(fut, self.cluster.who_has(fut))
                           for futs in removelist
                           for fut in futs[1:] if fut.status == 'error']
             errworkerids = [(fut, self.workernames[worker[0][0]])
@@ -990,7 +1369,8 @@ class realfast_controller(Controller):
                             .format(worker, fut.exception()))
 
             for futures in removelist:
-                self.futures[scanId].remove(futures)
+                self.futures.remove(scanId, futures[0])
+                self.shared.drop((scanId, futures[0]))
                 removed += 1
 
                 if keep:
@@ -1018,10 +1398,355 @@ def logging_statement(statement):
     logger.info("{0}".format(statement))
 
 
+class ScanStatusWriter(object):
+    """ Coalesces scan status (pending, finished, errors, nsegment) for index.
+    Keeps latest status per scanId and pushes scans that changed since
+    last flush in one bulk partial update every interval (s).
+    Failed updates (including scans not yet in index) are kept for next
+    flush. Removed scans are dropped after their final status is pushed
+    or after maxretries failed flushes. Stopping (or exiting) flushes once
+    more.
+    """
+
+    allowed = ['nsegment', 'pending', 'finished', 'errors']
+
+    def __init__(self, indexprefix='new', interval=_status_interval,
+                 update=None, maxretries=_status_retries):
+        self.indexprefix = indexprefix
+        self.interval = interval
+        self.maxretries = maxretries
+        self._update = update if update is not None else elastic.bulkupdate
+        self._lock = threading.Lock()
+        self._latest = {}  # scanId: status dict
+        self._written = {}  # scanId: status dict last pushed
+        self._removed = set()
+        self._retries = {}  # scanId: failed flushes after removal
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name='scanstatus')
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as exc:
+                logger.exception("Scan status flush failed: {0}".format(exc))
+
+    def stop(self, timeout=None):
+        """ Stop writer thread and push remaining changes.
+        """
+
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        try:
+            return self.flush()
+        except Exception as exc:
+            logger.exception("Final scan status flush failed: {0}".format(exc))
+            return 0
+
+    def update(self, scanId, **kwargs):
+        """ Set latest status fields for scanId. Does not block on index.
+        """
+
+        with self._lock:
+            status = self._latest.setdefault(scanId, {})
+            status.update((field, int(value)) for (field, value) in iteritems(kwargs)
+                          if field in self.allowed)
+
+    def changed(self):
+        """ Dict of scanId: status for scans changed since last push.
+        """
+
+        with self._lock:
+            return dict((scanId, dict(status)) for (scanId, status) in iteritems(self._latest)
+                        if status != self._written.get(scanId))
+
+    def flush(self):
+        """ Push changed scans in one request. Returns number updated.
+        """
+
+        changed = self.changed()
+        if changed:
+            scanIds = list(changed)
+            res, failed = self._update(self.indexprefix+'scans', scanIds,
+                                       [changed[scanId] for scanId in scanIds])
+            logger.debug("Updated processing status for {0} scans".format(res))
+        else:
+            res, failed = 0, []
+
+        with self._lock:
+            for scanId in changed:
+                if scanId not in failed:
+                    self._written[scanId] = changed[scanId]
+                elif scanId in self._removed:
+                    self._retries[scanId] = self._retries.get(scanId, 0) + 1
+            for scanId in list(self._removed):
+                if self._latest.get(scanId) != self._written.get(scanId):
+                    if self._retries.get(scanId, 0) < self.maxretries:
+                        continue
+                    logger.warn("Dropping status of scanId {0} after {1} failed updates"
+                                .format(scanId, self._retries[scanId]))
+                _ = self._latest.pop(scanId, None)
+                _ = self._written.pop(scanId, None)
+                _ = self._retries.pop(scanId, None)
+                self._removed.remove(scanId)
+
+        return res
+
+    def remove(self, scanId):
+        """ Forget scanId after its latest status is pushed.
+        """
+
+        with self._lock:
+            if scanId in self._latest:
+                self._removed.add(scanId)
+
+    def __contains__(self, scanId):
+        return scanId in self._latest
+
+
+class StateCache(object):
+    """ Memoizes state construction for scans.
+    Keeps prefsname per scan source (configId, sdm scan, or metadata scanId),
+    parsed preferences per (prefsname, preffile mtime), and State per
+    (source, prefsname, preffile mtime, inmeta). Editing preffile makes
+    new entries. States are evicted when the scan is cleaned up.
+    If subsegments is set, States of realtime scans have segments split
+    by pipeline.subsegment_state.
+    """
+
+    def __init__(self, preffile=None, inprefs={}, maxstates=16,
+                 subsegments=None):
+        self.preffile = preffile
+        self.inprefs = inprefs
+        self.maxstates = maxstates
+        self.subsegments = subsegments
+        self._lock = threading.RLock()
+        self._prefsnames = {}  # source: prefsname
+        self._prefs = {}  # (prefsname, mtime): parsed preferences
+        self._states = OrderedDict()  # key: (scanId, State, validated)
+        self._invalid = {}  # key: scanId
+
+    @property
+    def mtime(self):
+        if self.preffile is not None and os.path.exists(self.preffile):
+            return os.path.getmtime(self.preffile)
+        else:
+            return None
+
+    @staticmethod
+    def source(config=None, inmeta=None, sdmfile=None, sdmscan=None):
+        """ Hashable identifier for the source of scan metadata.
+        """
+
+        if config is not None:
+            return ('config', config.configId)
+        elif sdmfile is not None:
+            return ('sdm', sdmfile, sdmscan)
+        else:
+            return ('meta', inmeta.get('datasetId'), inmeta.get('scan'),
+                    inmeta.get('subscan'))
+
+    def prefsname(self, config=None, inmeta=None, sdmfile=None, sdmscan=None,
+                  bdfdir=None):
+        """ Memoized get_prefsname.
+        """
+
+        source = self.source(config=config, inmeta=inmeta, sdmfile=sdmfile,
+                             sdmscan=sdmscan)
+        with self._lock:
+            if source not in self._prefsnames:
+                self._prefsnames[source] = get_prefsname(inmeta=inmeta,
+                                                         config=config,
+                                                         sdmfile=sdmfile,
+                                                         sdmscan=sdmscan,
+                                                         bdfdir=bdfdir)
+            return self._prefsnames[source]
+
+    def prefs(self, prefsname):
+        """ Memoized parse of preffile for prefsname (with inprefs overload).
+        Returns a copy.
+        """
+
+        from rfpipe import preferences
+
+        key = (prefsname, self.mtime)
+        with self._lock:
+            if key not in self._prefs:
+                self._prefs[key] = preferences.parsepreffile(self.preffile,
+                                                             name=prefsname,
+                                                             inprefs=self.inprefs)
+            return dict(self._prefs[key])
+
+    def key(self, config=None, inmeta=None, sdmfile=None, sdmscan=None,
+            bdfdir=None):
+        source = self.source(config=config, inmeta=inmeta, sdmfile=sdmfile,
+                             sdmscan=sdmscan)
+        prefsname = self.prefsname(config=config, inmeta=inmeta,
+                                   sdmfile=sdmfile, sdmscan=sdmscan,
+                                   bdfdir=bdfdir)
+        metakey = repr(sorted(inmeta.items())) if inmeta else None
+        return (source, prefsname, self.mtime, metakey)
+
+    def state(self, scanId, config=None, inmeta=None, sdmfile=None,
+              sdmscan=None, bdfdir=None, validate=True, showsummary=True):
+        """ Return State for scanId, reusing a cached one if possible.
+        A State built with validate=False is not reused when validation
+        is requested.
+        """
+
+        from rfpipe import state
+
+        key = self.key(config=config, inmeta=inmeta, sdmfile=sdmfile,
+                       sdmscan=sdmscan, bdfdir=bdfdir)
+        with self._lock:
+            if key in self._states:
+                scanId0, st, validated = self._states.pop(key)
+                self._states[key] = (scanId0, st, validated)  # most recent
+                if validated or not validate:
+                    logger.debug("Reusing state for scanId {0}".format(scanId))
+                    return st
+
+        st = state.State(inmeta=inmeta, config=config,
+                         inprefs=self.prefs(key[1]), sdmfile=sdmfile,
+                         sdmscan=sdmscan, bdfdir=bdfdir, validate=validate,
+                         showsummary=showsummary)
+
+        if self.subsegments and st.metadata.datasource in ['vys', 'sim']:
+            st = pipeline.subsegment_state(st, self.subsegments)
+            logger.info("Split segments of scanId {0} in {1} subsegments"
+                        .format(scanId, self.subsegments))
+
+        with self._lock:
+            self._states[key] = (scanId, st, validate)
+            while len(self._states) > self.maxstates:
+                _ = self._states.popitem(last=False)
+
+        return st
+
+    def validates(self, config, inmeta=None):
+        """ Try to compile state for config. Result is cached.
+        """
+
+        key = None
+        try:
+            key = self.key(config=config, inmeta=inmeta)
+            if key in self._invalid:
+                logger.warn("State did not validate (cached)")
+                return False
+            self.state(config.scanId, config=config, inmeta=inmeta,
+                       validate=True, showsummary=False)
+            return True
+        except:
+            import traceback
+            traceback.print_tb(sys.exc_info()[2])
+            logger.warn("State did not validate")
+            if key is not None:
+                self._invalid[key] = config.scanId
+            return False
+
+    def evict(self, scanId):
+        """ Remove cached states for scanId.
+        """
+
+        with self._lock:
+            for key in [key for key, (scanId0, _, _) in iteritems(self._states)
+                        if scanId0 == scanId]:
+                _ = self._states.pop(key)
+            for key in [key for key, scanId0 in iteritems(self._invalid)
+                        if scanId0 == scanId]:
+                _ = self._invalid.pop(key)
+
+
+class OTFTracker(object):
+    """ Incremental phase centers and segments of an OTF scan.
+    Each subscan is read once, so an update costs only the new subscans.
+    """
+
+    def __init__(self, scanId):
+        self.scanId = scanId
+        self.phasecenters = []  # [(startmjd, stopmjd, ra_deg, dec_deg), ...]
+        self.endtime_mjd_ = 0
+        self.nsubscan = 0  # subscans read into phasecenters
+        self.nsegment = 0  # segments already emitted for submission
+
+    @property
+    def inmeta(self):
+        return {'datasource': 'vys', 'endtime_mjd_': self.endtime_mjd_,
+                'nints_': None, 'phasecenters': list(self.phasecenters)}
+
+    def update(self, subscans):
+        """ Append phase centers of newly completed subscans.
+        Returns number of new phase centers.
+        """
+
+        nnew = 0
+        while self.nsubscan < len(subscans):
+            ss = subscans[self.nsubscan]
+            if ss.stopTime is None:
+                break
+            if ss.stopTime > self.endtime_mjd_:
+                self.endtime_mjd_ = ss.stopTime
+            self.phasecenters.append((ss.startTime, ss.stopTime,
+                                      ss.ra_deg, ss.dec_deg))
+            self.nsubscan += 1
+            nnew += 1
+
+        return nnew
+
+    def extend(self, st):
+        """ New state with segment plan of st extended to current end time.
+        st is not modified, so it can be swapped for the new state.
+        Returns None if state cannot be extended.
+        """
+
+        if getattr(st.prefs, 'segmenttimes', None) is not None:
+            return None  # fixed segments (e.g., subsegmented state)
+
+        try:
+            metadata = copy.copy(st.metadata)
+            metadata.phasecenters = list(self.phasecenters)
+            metadata.endtime_mjd_ = self.endtime_mjd_
+            metadata.nints_ = None
+        except AttributeError:
+            return None
+
+        # new state drops values derived from scan length
+        st2 = copy.copy(st)
+        st2.metadata = metadata
+        for attr in ('_nints', '_segmenttimes', '_nsegment'):
+            if attr in st2.__dict__:
+                setattr(st2, attr, None)
+
+        if st2.nsegment < self.nsegment:
+            return None
+
+        return st2
+
+    def new_segments(self, nsegment):
+        """ List of segments not emitted yet. They are marked as emitted.
+        """
+
+        segments = list(range(self.nsegment, nsegment))
+        self.nsegment = max(self.nsegment, nsegment)
+        return segments
+
+
 def search_config(config, preffile=None, inprefs={},
-                  nameincludes=None, searchintents=None, ignoreintents=None):
+                  nameincludes=None, searchintents=None, ignoreintents=None,
+                  inmeta=None, statecache=None):
     """ Test whether configuration specifies a scan config that realfast should
     search
+    statecache (a StateCache) will validate state with inmeta and keep it to
+    be reused when setting state.
     """
 
     # find config properties of interest
@@ -1090,9 +1815,15 @@ def search_config(config, preffile=None, inprefs={},
         return False
 
     # 8) only if state validates
-    prefsname = get_prefsname(config=config)
-    if not heuristics.state_validates(config=config, preffile=preffile,
-                                      prefsname=prefsname, inprefs=inprefs):
+    if statecache is not None:
+        validates = statecache.validates(config, inmeta=inmeta)
+    else:
+        prefsname = get_prefsname(config=config)
+        validates = heuristics.state_validates(config=config, inmeta=inmeta,
+                                               preffile=preffile,
+                                               prefsname=prefsname,
+                                               inprefs=inprefs)
+    if not validates:
         logger.warn("State not valid for scanId {0}"
                     .format(config.scanId))
         return False
@@ -4,17 +4,53 @@ from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
 from io import open
 
 import os.path
+import glob
+import fcntl
+import json
+import socket
 import subprocess
 import shutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from time import sleep
-from elasticsearch import Elasticsearch, RequestError, TransportError, helpers, NotFoundError, ConnectionError
+from elasticsearch import RequestError, TransportError, NotFoundError, ConnectionError
+from realfast import backends
 import logging
 logging.getLogger('elasticsearch').setLevel(30)
 logger = logging.getLogger(__name__)
 logger.setLevel(20)
 
 # eventually should be updated to search.realfast.io/api with auth
-es = Elasticsearch(['realfast-vml-new.aoc.nrao.edu:9200'], timeout=60, max_retries=1, retry_on_timeout=True)
+_es_hosts = ['realfast-vml-new.aoc.nrao.edu:9200']
+_backend = None  # backends.IndexBackend, set on first use
+
+# index writes that fail while elasticsearch is down are spooled here
+_spool_dir = '/lustre/evla/test/realfast/spool'
+_spool = None
+
+
+def get_backend():
+    """ Index backend used by all functions in this module.
+    Defaults to Elasticsearch at _es_hosts, connected on first use.
+    """
+
+    global _backend
+
+    if _backend is None:
+        _backend = backends.ElasticsearchBackend(_es_hosts, timeout=60, max_retries=1,
+                                                 retry_on_timeout=True)
+    return _backend
+
+
+def set_backend(backend):
+    """ Use backend (backends.IndexBackend, e.g. MemoryBackend) for index.
+    None resets to Elasticsearch default.
+    """
+
+    global _backend
+
+    _backend = backend
 
 
 ###
@@ -126,7 +162,7 @@ def indexprefs(preferences, indexprefix='new'):
 
 
 def indexcands(candcollection, scanId, tags=None, url_prefix=None,
-               indexprefix='new'):
+               indexprefix='new', bulk=True):
     """ Takes candidate collection and pushes to index
     Connects to preferences via hashed name
     scanId is added to associate cand to a give scan.
@@ -135,10 +171,12 @@ def indexcands(candcollection, scanId, tags=None, url_prefix=None,
     tags is a comma-delimited string used to fill tag field in index.
     indexprefix allows specification of set of indices ('test', 'new').
     Use indexprefix='new' for production.
+    bulk pushes all cands in one bulk request that only creates new Ids
+    (see bulkreport). Otherwise, each cand is pushed separately.
+    Returns report of status per candId ('pushed', 'conflict', 'failed',
+    or 'spooled').
     """
 
-    from numpy import degrees, cos, radians
-
     if tags is None:
         tags = ''
 
@@ -149,64 +187,94 @@ def indexcands(candcollection, scanId, tags=None, url_prefix=None,
                     "mock"]
     tagstr = ','.join([tag for tag in tags.split(',') if tag in allowed_tags])
 
+    canddicts = canddocs(candcollection, scanId, tagstr, url_prefix,
+                         indexprefix)
+    Ids = [canddict['candId'] for canddict in canddicts]
+
+    if bulk:
+        report = bulkreport(canddicts, index=index, Ids=Ids)
+    else:
+        report = OrderedDict()
+        for canddict, Id in zip(canddicts, Ids):
+            res = pushdata(canddict, index=index, Id=Id, command='index')
+            if res is None:
+                report[Id] = 'spooled'
+            elif res >= 1:
+                report[Id] = 'pushed'
+            elif get_backend().exists(index=index, doc_type=index.rstrip('s'), id=Id):
+                report[Id] = 'conflict'
+            else:
+                report[Id] = 'failed'
+
+    statuses = listvalues(report)
+    if statuses.count('conflict'):
+        logger.warn('{0} cands for {1} already exist in {2}'
+                    .format(statuses.count('conflict'), scanId, index))
+    if statuses.count('pushed'):
+        logger.debug('Indexed {0} cands for {1} to {2}'
+                     .format(statuses.count('pushed'), scanId, index))
+    else:
+        logger.debug('No cands indexed for {0}'.format(scanId))
+
+    return report
+
+
+def canddocs(candcollection, scanId, tagstr='', url_prefix=None,
+             indexprefix='new'):
+    """ List of cand dicts for index, built column by column.
+    Reference position is calculated once per segment.
+    """
+
+    from numpy import degrees, cos, unique, zeros
+
     candarr = candcollection.array
     prefs = candcollection.prefs
-    candmjd = candcollection.candmjd
-    canddm = candcollection.canddm
-    canddt = candcollection.canddt
-    cluster = candcollection.cluster
-    clustersize = candcollection.clustersize
-    snrtot = candcollection.snrtot
     st = candcollection.state
+    ncand = len(candarr)
 
-    res = 0
-    for i in range(len(candarr)):
-        # get features. use .item() to cast to default types
-        canddict = dict(list(zip(candarr.dtype.names, candarr[i].item())))
+    # get features. use tolist() to cast to default types
+    columns = dict((name, candarr[name].tolist()) for name in candarr.dtype.names)
 
-        # get reference ra, dec
-        segment = canddict['segment']
+    # get reference ra, dec per segment
+    segments = candarr['segment']
+    ra_ctr = zeros(ncand)
+    dec_ctr = zeros(ncand)
+    for segment in unique(segments):
         pc0 = st.get_pc(segment)
-        ra_ctr, dec_ctr = st.get_radec(pc=pc0)
-
-        # fill optional fields
-        canddict['scanId'] = scanId
-        datasetId, scan, subscan = scanId.rsplit('.', 2)
-        canddict['datasetId'] = datasetId
-        canddict['scan'] = int(scan)
-        canddict['subscan'] = int(subscan)
-        canddict['source'] = candcollection.metadata.source
-        canddict['tags'] = tagstr
-        canddict['tagcount'] = 0
-        canddict['candmjd'] = float(candmjd[i])
-        canddict['canddm'] = float(canddm[i])
-        canddict['canddt'] = float(canddt[i])
-        canddict['cluster'] = int(cluster[i])
-        canddict['clustersize'] = int(clustersize[i])
-        canddict['snrtot'] = float(snrtot[i])
-        canddict['ra'] = degrees(ra_ctr + canddict['l1']/cos(dec_ctr))
-        canddict['dec'] = degrees(dec_ctr + canddict['m1'])
-        canddict['png_url'] = ''
-        if prefs.name:
-            canddict['prefsname'] = prefs.name
+        ra_ctr[segments == segment], dec_ctr[segments == segment] = st.get_radec(pc=pc0)
+    columns['ra'] = degrees(ra_ctr + candarr['l1']/cos(dec_ctr)).tolist()
+    columns['dec'] = degrees(dec_ctr + candarr['m1']).tolist()
+
+    columns['candmjd'] = candcollection.candmjd.astype(float).tolist()
+    columns['canddm'] = candcollection.canddm.astype(float).tolist()
+    columns['canddt'] = candcollection.canddt.astype(float).tolist()
+    columns['cluster'] = candcollection.cluster.astype(int).tolist()
+    columns['clustersize'] = candcollection.clustersize.astype(int).tolist()
+    columns['snrtot'] = candcollection.snrtot.astype(float).tolist()
+
+    # fill constant fields
+    datasetId, scan, subscan = scanId.rsplit('.', 2)
+    constants = {'scanId': scanId, 'datasetId': datasetId, 'scan': int(scan),
+                 'subscan': int(subscan),
+                 'source': candcollection.metadata.source, 'tags': tagstr,
+                 'tagcount': 0}
+    if prefs.name:
+        constants['prefsname'] = prefs.name
+
+    names = list(columns)
+    canddicts = []
+    for values in zip(*[columns[name] for name in names]):
+        canddict = dict(constants)
+        canddict.update(zip(names, values))
 
         # create id
         uniqueid = candid(datadict=canddict)
         canddict['candId'] = uniqueid
         candidate_png = 'cands_{0}.png'.format(uniqueid)
         canddict['png_url'] = os.path.join(url_prefix, indexprefix, candidate_png)
+        canddicts.append(canddict)
 
-#        assert os.path.exists(os.path.join(prefs.workdir, candidate_png)), "Expected png {0} for candidate.".format(candidate_png)
-        res += pushdata(canddict, index=index,
-                        Id=uniqueid, command='index')
-
-    if res >= 1:
-        logger.debug('Indexed {0} cands for {1} to {2}'.format(res, scanId,
-                                                               index))
-    else:
-        logger.debug('No cands indexed for {0}'.format(scanId))
-
-    return res
+    return canddicts
 
 
 def indexmock(scanId, mocks=None, acc=None, indexprefix='new'):
@@ -222,9 +290,8 @@ def indexmock(scanId, mocks=None, acc=None, indexprefix='new'):
     # for realtime use
     if mocks is None and acc is not None:
         if isinstance(acc, Future):
-            ncands, mocks = acc.result()
-        else:
-            ncands, mocks = acc
+            acc = acc.result()
+        ncands, mocks = acc[:2]  # (ncands, mocks, stages)
 
     if mocks is not None:
         if len(mocks[0]) != 7:
@@ -254,10 +321,13 @@ def indexmock(scanId, mocks=None, acc=None, indexprefix='new'):
         logger.info('No mocks indexed for {0}'.format(scanId))
 
 
-def indexnoises(scanId, noises=None, noisefile=None, indexprefix='new'):
+def indexnoises(scanId, noises=None, noisefile=None, indexprefix='new',
+                compact=True):
     """ Takes noises as list or from noisefile and pushes to index.
     scanId is added to associate cand to a give scan.
     indexprefix allows specification of set of indices ('test', 'new').
+    compact pushes one doc per segment with arrays over integrations
+    (see noisedoc) in a bulk request. Otherwise, one doc per integration.
     """
 
     index = indexprefix+'noises'
@@ -272,24 +342,36 @@ def indexnoises(scanId, noises=None, noisefile=None, indexprefix='new'):
     assert isinstance(noises, list)
 
     count = 0
-    for noise in noises:
-        startmjd, deltamjd, segment, integration, noiseperbl, zerofrac, imstd = noise
-        Id = '{0}.{1}.{2}'.format(scanId, segment, integration)
-        if not es.exists(index=index, doc_type=doc_type, id=Id):
-            noisedict = {}
-            noisedict['scanId'] = str(scanId)
-            noisedict['startmjd'] = float(startmjd)
-            noisedict['deltamjd'] = float(deltamjd)
-            noisedict['segment'] = int(segment)
-            noisedict['integration'] = int(integration)
-            noisedict['noiseperbl'] = float(noiseperbl)
-            noisedict['zerofrac'] = float(zerofrac)
-            noisedict['imstd'] = float(imstd)
-
-            count += pushdata(noisedict, Id=Id, index=index,
-                              command='index')
-        else:
-            logger.warn("noise index {0} already exists".format(Id))
+    if compact:
+        bysegment = {}
+        for noise in noises:
+            bysegment.setdefault(int(noise[2]), []).append(noise)
+        noisedicts = [noisedoc(scanId, segment, segnoises)
+                      for segment, segnoises in sorted(iteritems(bysegment))]
+        Ids = [noiseid(scanId, noisedict['segment']) for noisedict in noisedicts]
+        res, conflicts = bulkpush(noisedicts, index=index, Ids=Ids)
+        if conflicts:
+            logger.warn("{0} noise docs for {1} already exist".format(conflicts, scanId))
+        count = sum([noisedict['nint'] for noisedict in noisedicts]) if res else 0
+    else:
+        for noise in noises:
+            startmjd, deltamjd, segment, integration, noiseperbl, zerofrac, imstd = noise
+            Id = noiseid(scanId, segment, integration)
+            if not get_backend().exists(index=index, doc_type=doc_type, id=Id):
+                noisedict = {}
+                noisedict['scanId'] = str(scanId)
+                noisedict['startmjd'] = float(startmjd)
+                noisedict['deltamjd'] = float(deltamjd)
+                noisedict['segment'] = int(segment)
+                noisedict['integration'] = int(integration)
+                noisedict['noiseperbl'] = float(noiseperbl)
+                noisedict['zerofrac'] = float(zerofrac)
+                noisedict['imstd'] = float(imstd)
+
+                count += pushdata(noisedict, Id=Id, index=index,
+                                  command='index')
+            else:
+                logger.warn("noise index {0} already exists".format(Id))
 
     if count:
         logger.info('Indexed {0} noises for {1} to {2}'
@@ -299,6 +381,174 @@ def indexnoises(scanId, noises=None, noisefile=None, indexprefix='new'):
         logger.info('No noises indexed for {0}'.format(scanId))
 
 
+def noiseid(scanId, segment, integration=None):
+    """ Id of noise doc for segment or (legacy) single integration.
+    """
+
+    if integration is None:
+        return '{0}.{1}'.format(scanId, segment)
+    else:
+        return '{0}.{1}.{2}'.format(scanId, segment, integration)
+
+
+def noisedoc(scanId, segment, noises):
+    """ Compact noise doc for segment with fields of arrays over integrations
+    and summary statistics. noises is list of tuples as from calc_noise.
+    """
+
+    from numpy import array, median
+
+    noises = sorted(noises, key=lambda noise: noise[3])
+    startmjd, deltamjd, _, integration, noiseperbl, zerofrac, imstd = \
+        [array(col) for col in zip(*noises)]
+
+    noisedict = {}
+    noisedict['scanId'] = str(scanId)
+    noisedict['segment'] = int(segment)
+    noisedict['nint'] = len(noises)
+    noisedict['startmjd'] = startmjd.astype(float).tolist()
+    noisedict['deltamjd'] = deltamjd.astype(float).tolist()
+    noisedict['integration'] = integration.astype(int).tolist()
+    noisedict['noiseperbl'] = noiseperbl.astype(float).tolist()
+    noisedict['zerofrac'] = zerofrac.astype(float).tolist()
+    noisedict['imstd'] = imstd.astype(float).tolist()
+    noisedict['startmjd_min'] = float(startmjd.min())
+    noisedict['startmjd_max'] = float(startmjd.max())
+    noisedict['noiseperbl_median'] = float(median(noiseperbl))
+    noisedict['zerofrac_median'] = float(median(zerofrac))
+    noisedict['imstd_median'] = float(median(imstd))
+    noisedict['imstd_max'] = float(imstd.max())
+
+    return noisedict
+
+
+def get_noisedocs(indexprefix, scanId, segment=None):
+    """ Compact noise docs (see noisedoc) for scanId, optionally one segment.
+    Legacy docs of single integrations are combined per segment.
+    """
+
+    index = indexprefix+'noises'
+    doc_type = index.rstrip('s')
+    terms = [{"term": {"scanId.keyword": scanId}}]  # exact, not analyzed
+    if segment is not None:
+        terms.append({"term": {"segment": int(segment)}})
+    query = {"query": {"bool": {"filter": terms}}}
+
+    try:
+        hits = list(get_backend().scan(index=index, doc_type=doc_type, query=query))
+    except ConnectionError:
+        logger.warn("ConnectionError during scan. Elasticsearch down?")
+        return []
+
+    return compact_noisedocs([hit['_source'] for hit in hits])
+
+
+def compact_noisedocs(sources):
+    """ Returns compact noise docs, combining legacy single integration
+    docs per (scanId, segment).
+    """
+
+    docs = []
+    legacy = {}
+    for source in sources:
+        if isinstance(source['noiseperbl'], list):
+            docs.append(source)
+        else:
+            noise = (source['startmjd'], source['deltamjd'], source['segment'],
+                     source['integration'], source['noiseperbl'],
+                     source['zerofrac'], source['imstd'])
+            legacy.setdefault((source['scanId'], source['segment']), []).append(noise)
+
+    docs += [noisedoc(scanId, segment, noises)
+             for (scanId, segment), noises in sorted(iteritems(legacy))]
+
+    return sorted(docs, key=lambda doc: (doc['scanId'], doc['segment']))
+
+
+def expand_noises(noisedicts):
+    """ List of noise tuples (startmjd, deltamjd, segment, integration,
+    noiseperbl, zerofrac, imstd) from compact noise docs.
+    """
+
+    return [(startmjd, deltamjd, noisedict['segment'], integration,
+             noiseperbl, zerofrac, imstd)
+            for noisedict in noisedicts
+            for (startmjd, deltamjd, integration, noiseperbl, zerofrac, imstd)
+            in zip(noisedict['startmjd'], noisedict['deltamjd'],
+                   noisedict['integration'], noisedict['noiseperbl'],
+                   noisedict['zerofrac'], noisedict['imstd'])]
+
+
+def get_noises(indexprefix, scanId, segment=None):
+    """ Noise tuples for scanId (and segment), as indexed by indexnoises.
+    """
+
+    return expand_noises(get_noisedocs(indexprefix, scanId, segment=segment))
+
+
+def migrate_noises(indexprefix, scanId=None, delete=False):
+    """ Rewrite legacy noise docs (one per integration) as compact docs
+    per segment. Optionally for one scanId. Scans are migrated one at a
+    time. Legacy noises are merged into an existing compact doc.
+    delete removes legacy docs after their compact doc is pushed.
+    Returns number of compact docs pushed.
+    """
+
+    index = indexprefix+'noises'
+    doc_type = index.rstrip('s')
+
+    if scanId is None:
+        query = {"query": {"match_all": {}}, "_source": ["scanId", "nint"]}
+        scanIds = sorted(set(hit['_source']['scanId']
+                             for hit in get_backend().scan(index=index, doc_type=doc_type,
+                                                           query=query)
+                             if 'nint' not in hit['_source']))
+    else:
+        scanIds = [scanId]
+
+    count = 0
+    for scanId in scanIds:
+        query = {"query": {"bool": {"filter": [{"term": {"scanId.keyword": scanId}}]}}}
+        legacy = {}  # segment: [(Id, source)]
+        compact = {}  # segment: source
+        for hit in get_backend().scan(index=index, doc_type=doc_type, query=query):
+            if isinstance(hit['_source']['noiseperbl'], list):
+                compact[hit['_source']['segment']] = hit['_source']
+            else:
+                legacy.setdefault(hit['_source']['segment'], []).append((hit['_id'],
+                                                                         hit['_source']))
+
+        for segment, hits in sorted(iteritems(legacy)):
+            noisedict = compact_noisedocs([source for (Id, source) in hits])[0]
+            if segment in compact:
+                # existing compact doc wins for integrations in both
+                noises = dict((noise[3], noise) for noise in expand_noises([noisedict]))
+                noises.update((noise[3], noise) for noise in expand_noises([compact[segment]]))
+                noisedict = noisedoc(scanId, segment, listvalues(noises))
+                op_type = 'index'
+            else:
+                op_type = 'create'
+
+            report = bulkreport([noisedict], index=index, Ids=[noiseid(scanId, segment)],
+                                op_type=op_type)
+            if listvalues(report) == ['pushed']:
+                count += 1
+                if delete:
+                    actions = ({'_op_type': 'delete', '_index': index,
+                                '_type': doc_type, '_id': Id} for (Id, source) in hits)
+                    _ = get_backend().bulk(actions, raise_on_error=False)
+            else:
+                logger.warn("Compact noise doc for {0}.{1} {2}. Keeping legacy docs."
+                            .format(scanId, segment, listvalues(report)[0]))
+
+        logger.info("Migrated {0} legacy noise docs of {1} in {2} segments"
+                    .format(sum([len(hits) for hits in itervalues(legacy)]), scanId,
+                            len(legacy)))
+
+    logger.info("Migrated {0} segments to compact noise docs".format(count))
+    return count
+
+
 ###
 # Managing elasticsearch documents
 ###
@@ -323,13 +573,13 @@ def pushdata(datadict, index, Id=None, command='index', force=False):
     try:
         if command == 'index':
             if force:
-                res = es.index(index=index, doc_type=doc_type, id=Id,
-                               body=datadict)
+                res = get_backend().index(index=index, doc_type=doc_type, id=Id,
+                                          body=datadict)
             else:
-                if not es.exists(index=index, doc_type=doc_type, id=Id):
+                if not get_backend().exists(index=index, doc_type=doc_type, id=Id):
                     try:
-                        res = es.index(index=index, doc_type=doc_type,
-                                       id=Id, body=datadict)
+                        res = get_backend().index(index=index, doc_type=doc_type,
+                                                  id=Id, body=datadict)
                     except RequestError:
                         logger.warn("Id {0} and data {1} not indexed due to request error."
                                     .format(Id, datadict))
@@ -338,8 +588,8 @@ def pushdata(datadict, index, Id=None, command='index', force=False):
                                 .format(Id, index))
 
         elif command == 'delete':
-            if es.exists(index=index, doc_type=doc_type, id=Id):
-                res = es.delete(index=index, doc_type=doc_type, id=Id)
+            if get_backend().exists(index=index, doc_type=doc_type, id=Id):
+                res = get_backend().delete(index=index, doc_type=doc_type, id=Id)
             else:
                 logger.warn('Id={0} not in index'.format(Id))
 
@@ -348,10 +598,278 @@ def pushdata(datadict, index, Id=None, command='index', force=False):
         else:
             return res
     except ConnectionError:
-        logger.warn("ConnectionError during push to index. Elasticsearch down?")
+        logger.warn("ConnectionError during push to index. Elasticsearch down? Spooling.")
+        if command == 'index':
+            action = {'_op_type': 'index' if force else 'create', '_source': datadict}
+        else:
+            action = {'_op_type': 'delete'}
+        action.update({'_index': index, '_type': doc_type, '_id': Id})
+        get_spool().extend([action])
         return None
 
 
+def bulkpush(datadicts, index, Ids, op_type='create'):
+    """ Pushes list of dicts to index in bulk requests.
+    op_type 'create' indexes only Ids not in index, without checking
+    existence first. op_type 'index' replaces existing docs.
+    Returns (number pushed, number of conflicts with existing Ids).
+    """
+
+    statuses = listvalues(bulkreport(datadicts, index, Ids, op_type=op_type))
+    return statuses.count('pushed'), statuses.count('conflict')
+
+
+def bulkreport(datadicts, index, Ids, op_type='create'):
+    """ Pushes list of dicts to index in bulk requests (as bulkpush).
+    Returns OrderedDict of status per Id: 'pushed', 'conflict' (Id exists),
+    'failed', or 'spooled' (elasticsearch unreachable).
+    """
+
+    doc_type = index.rstrip('s')
+    actions = [{'_op_type': op_type, '_index': index, '_type': doc_type,
+                '_id': Id, '_source': datadict}
+               for datadict, Id in zip(datadicts, Ids)]
+
+    logger.debug('Pushing {0} docs to index {1}'.format(len(Ids), index))
+    try:
+        res, errors = get_backend().bulk(actions, raise_on_error=False)
+    except ConnectionError:
+        logger.warn("ConnectionError during bulk push to index. Elasticsearch down? Spooling.")
+        get_spool().extend(actions)
+        return OrderedDict((Id, 'spooled') for Id in Ids)
+
+    report = OrderedDict((Id, 'pushed') for Id in Ids)
+    failed = []
+    for error in errors:
+        error = listvalues(error)[0]
+        if error.get('status') == 409:
+            report[error['_id']] = 'conflict'
+        else:
+            report[error['_id']] = 'failed'
+            failed.append(error)
+    if failed:
+        logger.warn("{0} docs not pushed to {1}. First error: {2}"
+                    .format(len(failed), index, failed[0]))
+
+    return report
+
+
+class IndexSpool(object):
+    """ Write-ahead spool of index operations made while elasticsearch is
+    unreachable. Operations are appended as bulk actions, one JSON object per
+    line, to a file per host. Each batch is written at once and fsync'd if
+    fsync is set. The file is shared by processes on the host, so writes and
+    drains hold file locks. A drainer thread replays spooled actions in bulk
+    every period (s) once elasticsearch answers a ping.
+    """
+
+    def __init__(self, path=None, fsync=True, period=30.):
+        if path is None:
+            path = os.path.join(_spool_dir,
+                                'index_spool_{0}.jsonl'.format(socket.gethostname()))
+        self.path = path
+        self.fsync = fsync
+        self.period = period
+        self._thread = None
+
+    def extend(self, actions):
+        """ Append list of bulk actions to spool and start drainer.
+        """
+
+        if not actions:
+            return
+
+        self._append(actions)
+        logger.info("Spooled {0} index actions to {1}".format(len(actions), self.path))
+        self.start()
+
+    def _append(self, actions):
+        lines = ''.join([json.dumps(action, default=_tojson) + '\n'
+                         for action in actions])
+        with self._locked('.lock'):
+            with open(self.path, 'a') as fp:
+                fp.write(lines)
+                fp.flush()
+                if self.fsync:
+                    os.fsync(fp.fileno())
+
+    @contextmanager
+    def _locked(self, suffix):
+        """ Hold exclusive lock on file self.path+suffix (across processes).
+        """
+
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:  # made by other process
+                pass
+        with open(self.path + suffix, 'a') as fp:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+    def __len__(self):
+        """ Number of spooled actions.
+        """
+
+        count = 0
+        with self._locked('.lock'):
+            for path in [self.path + '.draining', self.path]:
+                if os.path.exists(path):
+                    with open(path, 'r') as fp:
+                        count += len([line for line in fp if line.strip()])
+        return count
+
+    def drain(self, chunk_size=500):
+        """ Replay spooled actions in bulk. Returns number replayed.
+        Actions that fail to connect or whose doc is not (yet) in index stay
+        in spool. Conflicts with existing docs (e.g., replayed twice) and
+        deletes of missing docs count as replayed. Lines that cannot be
+        parsed (e.g., cut by a crash) are dropped.
+        """
+
+        draining = self.path + '.draining'
+        with self._locked('.drainlock'):
+            with self._locked('.lock'):
+                if not os.path.exists(draining):
+                    if not os.path.exists(self.path):
+                        return 0
+                    os.rename(self.path, draining)  # new actions go to new file
+
+            actions = []
+            bad = 0
+            with open(draining, 'r') as fp:
+                for line in fp:
+                    if line.strip():
+                        try:
+                            actions.append(json.loads(line))
+                        except ValueError:
+                            bad += 1
+            if bad:
+                logger.warn("Skipped {0} unreadable lines in {1}".format(bad, draining))
+
+            try:
+                res, errors = get_backend().bulk(actions, chunk_size=chunk_size,
+                                                 raise_on_error=False)
+            except ConnectionError:
+                logger.warn("ConnectionError while draining {0}. Keeping {1} actions."
+                            .format(self.path, len(actions)))
+                return 0
+
+            missing = set()
+            failed = []
+            for error in errors:
+                op_type, error = listitems(error)[0]
+                if error.get('status') == 404 and op_type != 'delete':
+                    missing.add((op_type, error.get('_index'), error.get('_id')))
+                elif error.get('status') not in [404, 409]:
+                    failed.append(error)
+            if failed:
+                logger.warn("{0} spooled actions failed and were dropped. First error: {1}"
+                            .format(len(failed), failed[0]))
+
+            kept = [action for action in actions
+                    if (action.get('_op_type', 'index'), action.get('_index'),
+                        action.get('_id')) in missing]
+            if kept:
+                logger.info("Keeping {0} spooled actions for docs not in index"
+                            .format(len(kept)))
+                self._append(kept)
+
+            os.remove(draining)
+
+        replayed = len(actions) - len(failed) - len(kept)
+        logger.info("Replayed {0} of {1} spooled index actions from {2}"
+                    .format(replayed, len(actions), self.path))
+        return replayed
+
+    def start(self):
+        """ Start drainer thread.
+        """
+
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self.run, name='index_spool')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def run(self):
+        while True:
+            sleep(self.period)
+            if not (os.path.exists(self.path) or os.path.exists(self.path + '.draining')):
+                continue
+            try:
+                if get_backend().ping():
+                    self.drain()
+            except Exception as exc:
+                logger.exception("Draining index spool failed: {0}".format(exc))
+
+
+def _tojson(obj):
+    """ Cast numpy types for json.
+    """
+
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    else:
+        return str(obj)
+
+
+def get_spool():
+    """ Spool of index actions for this process, created on first use.
+    """
+
+    global _spool
+
+    if _spool is None:
+        _spool = IndexSpool()
+    return _spool
+
+
+def drain_spools(spooldir=None):
+    """ Replay spooled index actions of all hosts in spooldir.
+    """
+
+    if spooldir is None:
+        spooldir = _spool_dir
+
+    count = 0
+    paths = set(path.replace('.draining', '')
+                for suffix in ['.jsonl', '.jsonl.draining']
+                for path in glob.glob(os.path.join(spooldir, 'index_spool_*' + suffix)))
+    for path in sorted(paths):
+        count += IndexSpool(path=path).drain()
+
+    return count
+
+
+def bulkupdate(index, Ids, docs, retry_on_conflict=3):
+    """ Partial update of fields in docs (dicts) for Ids in one bulk request.
+    Returns (number updated, list of Ids that failed). Ids not (yet) in
+    index count as failed, so they can be retried.
+    """
+
+    doc_type = index.rstrip('s')
+    actions = ({'_op_type': 'update', '_index': index, '_type': doc_type,
+                '_id': Id, 'doc': doc, '_retry_on_conflict': retry_on_conflict}
+               for Id, doc in zip(Ids, docs))
+
+    try:
+        res, errors = get_backend().bulk(actions, raise_on_error=False)
+    except ConnectionError:
+        logger.warn("ConnectionError during bulk update. Elasticsearch down?")
+        return 0, list(Ids)
+
+    failed = [listvalues(error)[0]['_id'] for error in errors]
+    missing = [error for error in errors if listvalues(error)[0].get('status') == 404]
+    if missing:
+        logger.debug("{0} Ids not found in {1}".format(len(missing), index))
+
+    return res, failed
+
+
 def candid(datadict=None, cc=None):
     """ Returns id string for given data dict
     Assumes scanId is defined as:
@@ -392,11 +910,11 @@ def update_field(index, field, value, Id=None, **kwargs):
 
         query["query"] = searchquery
 
-        resp = es.update_by_query(body=query, doc_type=doc_type, index=index,
-                                  conflicts="proceed")
+        resp = get_backend().update_by_query(body=query, doc_type=doc_type, index=index,
+                                             conflicts="proceed")
     else:
         query = {"doc": {field: value}}
-        resp = es.update(id=Id, body=query, doc_type=doc_type, index=index)
+        resp = get_backend().update(id=Id, body=query, doc_type=doc_type, index=index)
 
     return resp['_shards']['successful']
 
@@ -407,9 +925,9 @@ def update_fields(index, fieldlist, valuelist, Id):
     """
 
     doc_type = index.rstrip('s')
-    doc = es.get(index, doc_type, Id) 
+    doc = get_backend().get(index, doc_type, Id) 
     doc['_source'].update(dict(zip(fieldlist, valuelist))) 
-    res = es.index(index, doc_type, body=doc['_source'], id=Id) 
+    res = get_backend().index(index, doc_type, body=doc['_source'], id=Id) 
     return res['_shards']['successful']
 
 
@@ -427,8 +945,8 @@ def remove_tags(prefix, **kwargs):
         if len(tagnames):
             print("Removing tags {0} for Id {1}".format(tagnames, Id))
             for tagname in tagnames:
-                resp = es.update(prefix+"cands", prefix+"cand", Id, {"script": 'ctx._source.remove("' + tagname + '")'})
-            resp = es.update(prefix+"cands", prefix+"cand", Id, {"script": 'ctx._source.tagcount = 0'})
+                resp = get_backend().update(prefix+"cands", prefix+"cand", Id, {"script": 'ctx._source.remove("' + tagname + '")'})
+            resp = get_backend().update(prefix+"cands", prefix+"cand", Id, {"script": 'ctx._source.tagcount = 0'})
 
 
 def add_tag(prefix, candId, user, tag):
@@ -437,10 +955,10 @@ def add_tag(prefix, candId, user, tag):
     """
 
     try:
-        _ = es.update(prefix+"cands", prefix+"cand",
-                      candId, {"script": 'ctx._source.tagcount += 1'})
-        _ = es.update(prefix+"cands", prefix+"cand",
-                      candId, {"doc": {user+"_tags": tag}})
+        _ = get_backend().update(prefix+"cands", prefix+"cand",
+                                 candId, {"script": 'ctx._source.tagcount += 1'})
+        _ = get_backend().update(prefix+"cands", prefix+"cand",
+                                 candId, {"doc": {user+"_tags": tag}})
     except NotFoundError:
         logger.warn('Not found:', candId)
         return False
@@ -506,7 +1024,7 @@ def get_ids(index, *args, **kwargs):
         query = {"query": {"match_all": {}}, "_source": field}
 
     try:
-        res = helpers.scan(es, index=index, doc_type=doc_type, query=query)
+        res = get_backend().scan(index=index, doc_type=doc_type, query=query)
     except ConnectionError:
         logger.warn("ConnectionError during scan. Elasticsearch down?")
         return []
@@ -523,7 +1041,7 @@ def get_doc(index, Id):
 
     doc_type = index.rstrip('s')
     try:
-        doc = es.get(index=index, doc_type=doc_type, id=Id)
+        doc = get_backend().get(index=index, doc_type=doc_type, id=Id)
     except ConnectionError:
         logger.warn("ConnectionError during get. Elasticsearch down?")
         return None
@@ -796,7 +1314,7 @@ def find_docids(indexprefix, candId=None, scanId=None):
         try:
             index = indexprefix + 'scans'
             docids[index] = [scanId]
-            prefsname = es.get(index=index, doc_type=index.rstrip('s'), id=scanId)['_source']['prefsname']
+            prefsname = get_backend().get(index=index, doc_type=index.rstrip('s'), id=scanId)['_source']['prefsname']
             index = indexprefix + 'preferences'
             docids[index] = [prefsname]
         except NotFoundError:
@@ -1103,7 +1621,7 @@ def gettags(indexprefix, Id, ignore=' '):
     index = indexprefix+'cands'
     doc_type = index.rstrip('s')
 
-    doc = es.get(index=index, doc_type=doc_type, id=Id)
+    doc = get_backend().get(index=index, doc_type=doc_type, id=Id)
     tagsdict = dict(((k, v) for (k, v) in doc['_source'].items() if ('_tags' in k) and (ignore not in k)))
     return tagsdict
 
@@ -1120,13 +1638,13 @@ def copy_doc(index1, index2, Id, deleteorig=False, force=False):
     doc_type1 = index1.rstrip('s')
     doc_type2 = index2.rstrip('s')
 
-    doc = es.get(index=index1, doc_type=doc_type1, id=Id)
-    res = es.index(index=index2, doc_type=doc_type2, id=Id,
-                   body=doc['_source'])
+    doc = get_backend().get(index=index1, doc_type=doc_type1, id=Id)
+    res = get_backend().index(index=index2, doc_type=doc_type2, id=Id,
+                              body=doc['_source'])
 
     if res['_shards']['successful']:
         if deleteorig:
-            res = es.delete(index=index1, doc_type=doc_type1, id=Id)
+            res = get_backend().delete(index=index1, doc_type=doc_type1, id=Id)
     else:
         logger.warn("Move of {0} from index {1} to {2} failed".format(Id,
                                                                       index1,
@@ -1156,6 +1674,15 @@ def create_indices(indexprefix):
                 },
             }
 
+    # compact noise arrays are stored, but only summaries are searchable
+    body_noises = body.copy()
+    body_noises['mappings'] = {indexprefix+"noise": {
+                                 "properties": dict((field, {"type": "float", "index": False})
+                                                    for field in ['deltamjd', 'noiseperbl',
+                                                                  'zerofrac', 'imstd'])
+                                 }
+                               }
+
     body_preferences = body.copy()
     body_preferences['mappings'] = {indexprefix+"preference": {
                                      "properties": {
@@ -1168,14 +1695,16 @@ def create_indices(indexprefix):
     indices = ['scans', 'cands', 'preferences', 'mocks', 'noises']
     for index in indices:
         fullindex = indexprefix+index
-        if es.indices.exists(index=fullindex):
+        if get_backend().indices.exists(index=fullindex):
             confirm = input("Index {0} exists. Delete?".format(fullindex))
             if confirm.lower() in ['y', 'yes']:
-                es.indices.delete(index=fullindex)
-        if index != 'preferences':
-            es.indices.create(index=fullindex, body=body)
+                get_backend().indices.delete(index=fullindex)
+        if index == 'preferences':
+            get_backend().indices.create(index=fullindex, body=body_preferences)
+        elif index == 'noises':
+            get_backend().indices.create(index=fullindex, body=body_noises)
         else:
-            es.indices.create(index=fullindex, body=body_preferences)
+            get_backend().indices.create(index=fullindex, body=body)
 
 
 def reset_indices(indexprefix, deleteindices=False):
@@ -1195,7 +1724,7 @@ def reset_indices(indexprefix, deleteindices=False):
                   indexprefix+'preferences']:
         res = remove_ids(index)
         if deleteindices:
-            es.indices.delete(index)
+            get_backend().indices.delete(index)
             logger.info("Removed {0} index".format(index))
 
 
@@ -5,31 +5,214 @@ from io import open
 
 import os.path
 import sys
+import threading
+from time import time
 import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(20)
 
-def reader_memory_available(cl):
+
+class ClusterView(object):
+    """ Cached snapshot of the scheduler state for a distributed client.
+    Serves scheduler_info, who_has, and processing from memory, so it can be
+    passed to heuristics in place of the client.
+    Snapshot is refreshed after ttl seconds or when invalidated. Workers
+    joining or leaving (seen in scheduler_info) invalidate other snapshots.
+    """
+
+    def __init__(self, cl, ttl=1.):
+        self.client = cl
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshots = {}  # name: (time, value)
+        self._addresses = None  # worker addresses of last scheduler_info
+
+    def invalidate(self):
+        """ Force refresh of all snapshots on next access.
+        """
+
+        with self._lock:
+            self._snapshots.clear()
+
+    def _get(self, name, fetch):
+        with self._lock:
+            if name in self._snapshots:
+                t0, value = self._snapshots[name]
+                if time() - t0 < self.ttl:
+                    return value
+
+        value = fetch()  # scheduler query made without lock
+        with self._lock:
+            if name == 'scheduler_info':
+                addresses = set(value['workers'])
+                if self._addresses is not None and addresses != self._addresses:
+                    logger.debug("Workers changed. Invalidating cluster snapshots.")
+                    self._snapshots.clear()
+                self._addresses = addresses
+            self._snapshots[name] = (time(), value)
+
+        return value
+
+    def scheduler_info(self):
+        return self._get('scheduler_info', self.client.scheduler_info)
+
+    def who_has(self, futures=None):
+        """ Dict of key to worker addresses. Optionally select for futures.
+        """
+
+        who_has = self._get('who_has', self.client.who_has)
+        if futures is None:
+            return who_has
+        if not isinstance(futures, (list, tuple, set)):
+            futures = [futures]
+        return dict((fut.key, who_has.get(fut.key, ())) for fut in futures)
+
+    def processing(self):
+        return self._get('processing', self.client.processing)
+
+    @property
+    def workers(self):
+        return self.scheduler_info()['workers']
+
+    @property
+    def workernames(self):
+        """ Dict of worker address to worker name.
+        """
+
+        return dict((k, v['id']) for k, v in iteritems(self.workers))
+
+    def with_resource(self, resource):
+        """ List of worker addresses that define resource (e.g., 'READER')
+        """
+
+        return [k for k, v in iteritems(self.workers)
+                if resource in v['resources']]
+
+    @property
+    def readers(self):
+        return self.with_resource('READER')
+
+    @property
+    def gpus(self):
+        return self.with_resource('GPU')
+
+    @property
+    def fetchworkers(self):
+        """ Names of workers set up to run the fetch classifier.
+        """
+
+        return [name for name in itervalues(self.workernames)
+                if 'fetch' in name]
+
+    @staticmethod
+    def host(address):
+        """ Host part of worker address (e.g., 'tcp://10.0.0.1:1234')
+        """
+
+        return address.split('://')[-1].rsplit(':', 1)[0]
+
+    def by_host(self, resource):
+        """ Dict of host to list of worker addresses that define resource.
+        """
+
+        hosts = {}
+        for address in self.with_resource(resource):
+            hosts.setdefault(self.host(address), []).append(address)
+
+        return hosts
+
+    @property
+    def reader_memory_total(self):
+        """ Sum of MEMORY resource over READERs.
+        """
+
+        return sum([self.workers[k]['resources']['MEMORY']
+                    for k in self.readers])
+
+
+def colocated_workers(cl, memory_required=0, segment=0, prefer=None, shm=None):
+    """ Select a READER and the idle GPU workers on the same host.
+    Readers need memory_required bytes free. Reader prefer (an address) is
+    used if it has the memory and is idle (e.g., to reuse data of previous
+    segment).
+    Otherwise, hosts with most idle GPU workers are preferred and ties are
+    split round robin by segment.
+    cl must be a ClusterView.
+    shm is dict of READER address: bytes in shared memory buffers.
+    Returns (reader address, list of GPU addresses). reader is None if no
+    READER has the memory and GPU list is empty if no GPU on host is idle.
+    """
+
+    shm = shm or {}
+    workers = cl.workers
+    processing = cl.processing()
+    gpus = cl.by_host('GPU')
+
+    candidates = []
+    for address in sorted(cl.readers):
+        vals = workers[address]
+        memory = (vals['resources'].get('MEMORY', 0) - vals['metrics']['memory']
+                  - shm.get(address, 0))
+        if memory >= memory_required:
+            idle = [gpu for gpu in gpus.get(cl.host(address), [])
+                    if not processing.get(gpu)]
+            candidates.append((address, idle))
+
+    if not candidates:
+        return None, []
+
+    # previous reader is used only if idle, so read does not queue behind it
+    for cand in candidates:
+        if cand[0] == prefer and not processing.get(prefer):
+            return cand
+
+    nidle = max([len(idle) for (address, idle) in candidates])
+    candidates = [cand for cand in candidates if len(cand[1]) == nidle]
+    return candidates[segment % len(candidates)]
+
+
+def bytes_moved(stages):
+    """ Bytes of segment data sent between hosts from read to search.
+    stages is dict of stage statistics of a segment (see
+    pipeline.StageTimer), as measured by the read and data_prep tasks.
+    """
+
+    read = stages.get('read_segment', {})
+    prep = stages.get('data_prep', {})
+    if 'host' not in read or 'host' not in prep or read['host'] == prep['host']:
+        return 0
+
+    return prep['bytes_in']
+
+
+def reader_memory_available(cl, shm=None):
     """ Calc memory in use by READERs
+    cl can be a distributed client or a ClusterView.
+    shm is dict of READER address: bytes of segment buffers it wrote to
+    shared memory, which do not count in its worker memory.
     """
 
+    shm = shm or {}
     memories = []
-    for vals in itervalues(cl.scheduler_info()['workers']):
+    for address, vals in iteritems(cl.scheduler_info()['workers']):
         if 'READER' in vals['resources']:
             if vals['resources']['MEMORY'] > 0:
-                memories.append(vals['resources']['MEMORY']-vals['metrics']['memory'])
+                memories.append(vals['resources']['MEMORY']-vals['metrics']['memory']
+                                - shm.get(address, 0))
             else:
                 memories.append(0)
 
     return memories
 
 
-def reader_memory_used(cl):
+def reader_memory_used(cl, shm=None):
     """ Calc memory in use by READERs
+    shm is dict of READER address: bytes in shared memory buffers.
     """
 
-    return [vals['metrics']['memory']
-            for vals in itervalues(cl.scheduler_info()['workers'])
+    shm = shm or {}
+    return [vals['metrics']['memory'] + shm.get(address, 0)
+            for address, vals in iteritems(cl.scheduler_info()['workers'])
             if 'READER' in vals['resources']]
 
 
@@ -51,12 +234,13 @@ def spilled_memory(daskdir='.'):
     return spilled
 
 
-def reader_memory_ok(cl, memory_required):
+def reader_memory_ok(cl, memory_required, shm=None):
     """ Does any READER worker have enough memory?
     memory_required is the size of the read in bytes
+    shm is dict of READER address: bytes in shared memory buffers.
     """
 
-    for worker_memory in reader_memory_available(cl):
+    for worker_memory in reader_memory_available(cl, shm=shm):
         if worker_memory and (worker_memory > memory_required):
             return True
 
@@ -66,13 +250,14 @@ def reader_memory_ok(cl, memory_required):
     return False
 
 
-def readertotal_memory_ok(cl, memory_limit):
+def readertotal_memory_ok(cl, memory_limit, shm=None):
     """ Is total READER memory usage too high?
     memory_limit is total memory used in bytes
+    shm is dict of READER address: bytes in shared memory buffers.
     """
 
     if memory_limit is not None:
-        total = sum(reader_memory_used(cl))
+        total = sum(reader_memory_used(cl, shm=shm))
 
         if total > memory_limit:
             logger.debug("Total of {0} GB in use. Exceeds limit of {1} GB."
@@ -83,6 +268,27 @@ def readertotal_memory_ok(cl, memory_limit):
         return True
 
 
+def gpu_ok(cl, nsearch, gpu_per_search=2, depth=2):
+    """ Are there GPUs free to take another search?
+    nsearch is number of segment searches in flight.
+    Allows depth searches queued per set of gpu_per_search GPUs.
+    cl can be a distributed client or a ClusterView.
+    """
+
+    ngpu = sum([vals['resources']['GPU']
+                for vals in itervalues(cl.scheduler_info()['workers'])
+                if 'GPU' in vals['resources']])
+    if not ngpu:
+        return True
+
+    limit = depth*max(1, ngpu//gpu_per_search)
+    if nsearch >= limit:
+        logger.debug("{0} searches in flight. At limit of {1} for {2} GPUs."
+                     .format(nsearch, limit, ngpu))
+
+    return nsearch < limit
+
+
 def spilled_memory_ok(limit=1.0, daskdir='.'):
     """ Calculate total memory spilled (in GB) by dask distributed.
     """
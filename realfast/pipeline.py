@@ -7,8 +7,19 @@ import distributed
 from dask import array
 from dask.base import tokenize
 import numpy as np
-from time import sleep
-from realfast import util
+import os
+import resource
+import socket
+import copy
+import threading
+import concurrent.futures
+from uuid import uuid4
+from collections import OrderedDict
+from operator import getitem
+from functools import partial
+from contextlib import contextmanager
+from time import time, thread_time
+from realfast import util, heuristics
 
 import logging
 logger = logging.getLogger(__name__)
@@ -16,15 +27,36 @@ logger.setLevel(20)
 
 vys_timeout_default = 10
 
+# overlap of read segments with next segment, kept in reader worker process
+_overlap_cache = OrderedDict()  # (scanId, start, stop integration): data
+_overlap_lock = threading.Lock()
+_overlap_max = 4  # entries in cache
+_overlap_maxbytes = 4e9  # bytes in cache, oldest entries are evicted first
+
 
 def pipeline_scan(st, segments=None, cl=None, host=None, cfile=None,
                   vys_timeout=vys_timeout_default, mem_read=0., mem_search=0.,
-                  throttle=False, mockseg=None):
+                  throttle=False, mockseg=None, backend=None, max_workers=None,
+                  memory_timeout=60.):
     """ Given rfpipe state and dask distributed client, run search pipline.
+    backend can be 'sync', 'thread', or 'process' to run with a
+    LocalExecutor (max_workers) instead of distributed. That executor is
+    shut down when all segments are done, so returned futures are done.
+    throttle is fraction of realtime to pace submission at first. Pacing
+    relaxes as segments complete (see scheduling.AdaptiveThrottle), and
+    segments in flight are limited by an AIMD window that grows as
+    segments complete and shrinks when no reader has mem_read free.
+    Throttled submission fails if no reader has mem_read free for
+    memory_timeout (s) while no segment is in flight.
     """
 
+    from realfast import scheduling
+
+    executor = None  # LocalExecutor owned by this call
     if cl is None:
-        if host is None:
+        if backend is not None:
+            cl = executor = LocalExecutor(backend, max_workers=max_workers)
+        elif host is None:
             cl = distributed.Client(n_workers=1, threads_per_worker=16,
                                     resources={"READER": 1, "MEMORY": 16e9},
                                     local_dir="/lustre/evla/test/realfast/scratch")
@@ -34,103 +66,607 @@ def pipeline_scan(st, segments=None, cl=None, host=None, cfile=None,
     if not isinstance(segments, list):
         segments = list(range(st.nsegment))
 
+    cluster = heuristics.ClusterView(cl)
+    sthandle = scatter_state(cl, st)
     futures = []
-    sleeptime = throttle*0.8*st.nints*st.inttime/st.nsegment  # bit shorter than scan
-    for segment in segments:
-        futures.append(pipeline_seg(st, segment, cl=cl, cfile=cfile,
-                                    vys_timeout=vys_timeout, mem_read=mem_read,
-                                    mem_search=mem_search, mockseg=mockseg))
-        if throttle:
-            sleep(sleeptime)
+    limit = scheduling.AdaptiveThrottle()
+    inflight = lambda: len([acc for (seg, data, cc, acc) in futures
+                            if acc.status == 'pending'])
+    interval = throttle*st.metadata.inttime*st.metadata.nints/st.nsegment if throttle else 0.
+    try:
+        for segment in segments:
+            if throttle:
+                while not limit.wait(inflight, timeout=1., interval=interval):
+                    pass
+                t0 = time()
+                while (mem_read and cluster.readers and
+                       not heuristics.reader_memory_ok(cluster, mem_read)):
+                    if inflight():
+                        t0 = time()  # completion may free memory
+                    elif time() - t0 > memory_timeout:
+                        raise RuntimeError("No reader with {0:.1f} GB free for {1:.0f}s "
+                                           "and no segment in flight"
+                                           .format(mem_read/1e9, memory_timeout))
+                    limit.congested()
+                    cluster.invalidate()
+                    limit.wait(lambda: inflight() + 1, timeout=1.)  # next completion
+
+            futures.append(pipeline_seg(st, segment, cl=cl, cluster=cluster,
+                                        cfile=cfile,
+                                        vys_timeout=vys_timeout, mem_read=mem_read,
+                                        mem_search=mem_search, mockseg=mockseg,
+                                        sthandle=sthandle))
+            limit.submitted()
+            futures[-1][3].add_done_callback(limit.completed)
+
+        # owned executor finishes segments before it is shut down
+        if executor is not None:
+            for (seg, data, cc, acc) in futures:
+                acc.exception()
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
     return futures  # list of tuples of futures (seg, data, cc, acc)
 
 
 def pipeline_seg(st, segment, cl, cfile=None,
                  vys_timeout=vys_timeout_default, mem_read=0., mem_search=0.,
-                 mockseg=None):
+                 mockseg=None, cluster=None, placement=None, shmdir=None,
+                 overlap=False, sthandle=None):
     """ Submit pipeline processing of a single segment to scheduler.
-    Can use distributed client or compute locally.
+    Can use distributed client or compute locally (cl is a LocalExecutor).
 
     Uses distributed resources parameter to control scheduling of GPUs.
     memreq is required memory in bytes.
+    cluster is an optional heuristics.ClusterView to avoid scheduler queries.
+    Read is placed on a reader node with an idle GPU, where search is
+    preferred. Other workers are allowed, so data moves only if needed.
+    placement is (reader, gpus) as from heuristics.colocated_workers.
+    If shmdir is set and placement has a reader and gpus, data is returned
+    as a util.SharedSegment handle in shmdir on reader host and search must
+    run on that host.
+    If overlap, the read reuses integrations of previous segment kept on
+    the reader (see read_segment_overlap).
+    sthandle is st published with scatter_state, so tasks do not carry
+    the State. Per-segment settings go to workers as a small override.
     """
 
     from rfpipe import source
 
-    # set up worker node round robin based on segment
-    workers = [w['id'] for w in itervalues(cl.scheduler_info()['workers'])]
-#    nodes = list(set([w.split('g')[0] for w in workers if 'g' in w]))
-#    workerspernode = list(set([int(w.split('g')[1]) for w in workers if 'g' in w]))
-#    allowed = ['{0}g{1}'.format(node, 2*(segment % len(workerspernode)))
-#               for node in nodes]  # assumes 2 gpus per worker
-
-    logger.info('Submitted read for observation {0}, scan {1}, segment {2} to {3} workers.'
+    if cluster is None:
+        cluster = heuristics.ClusterView(cl)
+
+    workers = cluster.workers
+    if placement is None:
+        placement = heuristics.colocated_workers(cluster, mem_read, segment)
+    reader, gpus = placement
+    shared = shares_segment(placement, shmdir)
+    readkwargs = {}
+    searchkwargs = {}
+    if shared:
+        # buffer can be used by any worker on reader host (e.g., after restart)
+        host = cluster.host(reader)
+        readkwargs = {'workers': [host], 'allow_other_workers': False}
+        searchkwargs = {'workers': [host], 'allow_other_workers': False}
+    elif reader is not None:
+        readkwargs = {'workers': [reader], 'allow_other_workers': True}
+        if gpus:
+            searchkwargs = {'workers': gpus, 'allow_other_workers': True}
+
+    logger.info('Submitted read for observation {0}, scan {1}, segment {2} to {3} workers{4}.'
                 .format(st.metadata.datasetId, st.metadata.scan, segment,
-                        len(workers)))
-
-    data = cl.submit(source.read_segment, st, segment, timeout=vys_timeout,
-                     cfile=cfile, resources={'READER': 1, 'MEMORY': mem_read},
-                     retries=0)
-
-    if segment == mockseg:
-        st.prefs.simulated_transient = 1
+                        len(workers),
+                        ' (preferring {0} with {1} idle GPU workers)'
+                        .format(workers[reader]['id'], len(gpus))
+                        if reader is not None else ''))
+
+    if shared:
+        read = partial(read_segment_shared, shmdir=shmdir, overlap=overlap)
+    elif overlap:
+        read = read_segment_overlap
     else:
-        st.prefs.simulated_transient = None
-
-    candcollection = cl.submit(prep_and_search, st, segment, data,
+        read = source.read_segment
+
+    if sthandle is None:
+        sthandle = st
+
+    # read returns (data, stages); data is split off on reader without copy
+    timedread = cl.submit(timed_read, read, sthandle, segment, timeout=vys_timeout,
+                          cfile=cfile, resources={'READER': 1, 'MEMORY': mem_read},
+                          retries=0, **readkwargs)
+    # getitems stay with the read, so the (data, stages) tuple does not move
+    splitkwargs = readkwargs or {'resources': {'READER': 1}}
+    data = cl.submit(getitem, timedread, 0, key='segment_data-' + tokenize(timedread.key),
+                     **splitkwargs)
+    readstages = cl.submit(getitem, timedread, 1,
+                           key='segment_stages-' + tokenize(timedread.key),
+                           **splitkwargs)
+
+    override = {'simulated_transient': 1 if segment == mockseg else None}
+
+    candcollection = cl.submit(prep_and_search, sthandle, segment, data,
+                               override=override,
                                resources={'MEMORY': mem_search, 'GPU': 2},
 #                               resources={'MEMORY': mem_search, 'READER': 1},
-                               retries=1)
+                               retries=1, **searchkwargs)
 
-    acc = cl.submit(analyze_cc, candcollection, retries=1)
+    acc = cl.submit(analyze_cc, candcollection, readstages, retries=1)
 
     return (segment, data, candcollection, acc)
 
 
-### helper functions
+### local execution
 
-def prep_and_search(st, segment, data, indexprefix='new', returnsoltime=False):
-    """ Reproduces rfpipe.search.prep_and_search but calculates and
-    indexes noises.
+class LocalFuture(object):
+    """ Future of LocalExecutor task with interface of distributed.Future
+    (key, status, result, exception, add_done_callback).
     """
 
-    from rfpipe import source, search, reproduce, candidates
+    def __init__(self, key):
+        self.key = key
+        self._future = concurrent.futures.Future()
+
+    @property
+    def status(self):
+        if not self._future.done():
+            return 'pending'
+        elif self._future.cancelled():
+            return 'cancelled'
+        elif self._future.exception() is not None:
+            return 'error'
+        else:
+            return 'finished'
+
+    def done(self):
+        return self._future.done()
+
+    def result(self, timeout=None):
+        return self._future.result(timeout)
+
+    def exception(self, timeout=None):
+        return self._future.exception(timeout)
+
+    def cancel(self):
+        return self._future.cancel()
+
+    def add_done_callback(self, fn):
+        self._future.add_done_callback(lambda fut: fn(self))
+
+    def __repr__(self):
+        return '<LocalFuture: {0}, key: {1}>'.format(self.status, self.key)
+
+
+class LocalExecutor(object):
+    """ Runs pipeline tasks without a scheduler, with the submit interface
+    of a distributed client used by pipeline_seg.
+    mode is 'sync' (in calling thread), 'thread', or 'process' (pool of
+    max_workers). Tasks start when the futures in their arguments (also
+    inside lists, tuples, and dicts) finish. Trivial selectors (e.g.,
+    getitem) run in the calling thread, so their input is not sent to a
+    pool process.
+    Scheduler options (resources, workers, retries, etc.) are ignored.
+    """
+
+    inline = (getitem, getattr)
+
+    def __init__(self, mode='thread', max_workers=None):
+        assert mode in ['sync', 'thread', 'process'], "mode must be 'sync', 'thread', or 'process'"
+        self.mode = mode
+        if mode == 'thread':
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers)
+        elif mode == 'process':
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers)
+        else:
+            self.pool = None
+
+    def submit(self, fn, *args, **kwargs):
+        for key in ['resources', 'retries', 'workers', 'allow_other_workers',
+                    'pure', 'priority', 'key']:
+            _ = kwargs.pop(key, None)
+
+        name = getattr(fn, '__name__', getattr(getattr(fn, 'func', None), '__name__', 'task'))
+        future = LocalFuture('{0}-{1}'.format(name, uuid4().hex))
+        deps = _local_futures([args, kwargs])
+
+        lock = threading.Lock()
+        remaining = [len(deps)]
+
+        def depdone(dep):
+            with lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                self._run(future, fn, args, kwargs, deps)
+
+        if deps:
+            for dep in deps:
+                dep.add_done_callback(depdone)
+        else:
+            self._run(future, fn, args, kwargs, deps)
+
+        return future
+
+    def _run(self, future, fn, args, kwargs, deps):
+        for dep in deps:
+            if dep.status != 'finished':
+                future._future.set_exception(dep.exception() or
+                                             concurrent.futures.CancelledError())
+                return
+
+        args = _resolve(list(args))
+        kwargs = _resolve(kwargs)
+
+        if self.pool is None or fn in self.inline:
+            try:
+                future._future.set_result(fn(*args, **kwargs))
+            except Exception as exc:
+                future._future.set_exception(exc)
+        else:
+            try:
+                inner = self.pool.submit(fn, *args, **kwargs)
+            except RuntimeError as exc:  # pool was shut down
+                future._future.set_exception(exc)
+                return
+
+            def copy(inner):
+                if inner.exception() is not None:
+                    future._future.set_exception(inner.exception())
+                else:
+                    future._future.set_result(inner.result())
+
+            inner.add_done_callback(copy)
+
+    def gather(self, futures):
+        return [fut.result() for fut in futures]
+
+    def scatter(self, data, **kwargs):
+        future = LocalFuture('data-{0}'.format(uuid4().hex))
+        future._future.set_result(data)
+        return future
+
+    # no scheduler, so cluster queries are empty
+    def scheduler_info(self):
+        return {'workers': {}}
+
+    def who_has(self, futures=None):
+        return {}
+
+    def processing(self):
+        return {}
+
+    def shutdown(self, wait=True):
+        if self.pool is not None:
+            self.pool.shutdown(wait=wait)
+
 
-    ret = source.data_prep(st, segment, data, returnsoltime=returnsoltime)
-    if returnsoltime:
-        data, soltime = ret
+def _local_futures(obj):
+    """ List of LocalFutures in obj and lists, tuples, and dicts in it.
+    """
+
+    if isinstance(obj, LocalFuture):
+        return [obj]
+    elif isinstance(obj, (list, tuple)):
+        return [fut for val in obj for fut in _local_futures(val)]
+    elif isinstance(obj, dict):
+        return [fut for val in itervalues(obj) for fut in _local_futures(val)]
     else:
-        data = ret
-        soltime = None
+        return []
 
-    util.calc_and_indexnoises(st, segment, data, indexprefix=indexprefix)
 
-    if st.prefs.fftmode == "cuda":
-        candcollection = search.dedisperse_search_cuda(st, segment, data)
-    elif st.prefs.fftmode == "fftw":
-        candcollection = search.dedisperse_search_fftw(st, segment, data)
+def _resolve(obj):
+    """ Copy of obj with LocalFutures replaced by their results.
+    """
+
+    if isinstance(obj, LocalFuture):
+        return obj.result()
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)([_resolve(val) for val in obj])
+    elif isinstance(obj, dict):
+        return dict((key, _resolve(val)) for key, val in iteritems(obj))
     else:
-        logger.warning("fftmode {0} not recognized (cuda, fftw allowed)"
-                       .format(st.prefs.fftmode))
+        return obj
+
+
+### helper functions
+
+class StageTimer(object):
+    """ Records wall time, cpu time, bytes in/out, memory, and host per stage.
+    Cpu time is for the thread running the stage.
+    maxrss is the peak resident memory (bytes) of the whole worker process
+    at end of stage, which includes other tasks and earlier stages.
+    maxrss_delta is the increase of that peak during the stage.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def stage(self, name, data_in=None):
+        """ Time block as stage name. Yields dict for stage to set 'bytes_out'.
+        """
+
+        stats = {'bytes_in': nbytes(data_in), 'bytes_out': 0}
+        t0 = time()
+        c0 = thread_time()
+        maxrss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+        try:
+            yield stats
+        finally:
+            stats['wall'] = time() - t0
+            stats['cpu'] = thread_time() - c0
+            stats['maxrss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+            stats['maxrss_delta'] = stats['maxrss'] - maxrss0
+            stats['host'] = socket.gethostname()
+            self.stages[name] = stats
+
+
+def nbytes(obj):
+    """ Size in bytes of arrays, segment handles, and candcollections.
+    """
+
+    if obj is None:
+        return 0
+    elif isinstance(obj, util.SharedSegment):
+        return int(np.prod(obj.shape))*np.dtype(obj.dtype).itemsize
+    elif hasattr(obj, 'nbytes'):
+        return int(obj.nbytes)
+    elif hasattr(obj, 'array'):
+        return int(obj.array.nbytes)
+    else:
+        return 0
+
+
+def scatter_state(cl, st):
+    """ Publish st to cluster once and return its future.
+    Segment tasks of a scan share the handle, so the State is serialized
+    and hashed once per scan rather than once per task.
+    """
+
+    return cl.scatter(st, hash=False)
+
+
+def apply_override(st, override):
+    """ Returns st with preferences set from override dict.
+    Shared State (and its prefs) is copied, since workers reuse it across
+    tasks and rfpipe modifies prefs (e.g., simulated_transient) in place.
+    """
+
+    if not override:
+        return st
+
+    st = copy.copy(st)
+    st.prefs = copy.copy(st.prefs)
+    for key, value in iteritems(override):
+        setattr(st.prefs, key, value)
+
+    return st
+
+
+def timed_read(read, st, segment, **kwargs):
+    """ Run read(st, segment, **kwargs) and return (data, stages).
+    """
+
+    timer = StageTimer()
+    with timer.stage('read_segment') as stats:
+        data = read(st, segment, **kwargs)
+        stats['bytes_out'] = nbytes(data)
+
+    return data, timer.stages
+
+
+def subsegment_state(st, nsub):
+    """ State with each segment of st split into nsub shorter segments.
+    This is sub-segmentation, not streaming: each subsegment is read and
+    searched as a segment of its own. Subsegments overlap by st.t_overlap,
+    so dispersion sweeps that cross a boundary are searched in the next
+    subsegment, and those integrations are read twice. Subsegment k of
+    segment i is segment i*nsub+k of new state. Reads and searches per
+    subsegment need about 1/nsub of the memory and candidates arrive
+    sooner.
+    Returns st if segments are too short to split (overlap is most of
+    segment).
+    """
+
+    overlap = st.t_overlap/(24*3600.)
+    steps = [(t1 - t0 - overlap)/nsub for (t0, t1) in st.segmenttimes]
+    if nsub <= 1 or min(steps) <= 0:
+        logger.warning("Segments of {0} s with overlap of {1} s cannot be split "
+                       "in {2}. Using original segments."
+                       .format(24*3600*min([t1 - t0 for (t0, t1) in st.segmenttimes]),
+                               st.t_overlap, nsub))
+        return st
+
+    from rfpipe import state
+
+    segmenttimes = []
+    for (t0, t1), step in zip(st.segmenttimes, steps):
+        segmenttimes += [[t0 + k*step, t0 + (k+1)*step + overlap]
+                         for k in range(nsub)]
+
+    inprefs = dict(st.prefs.ordered)
+    inprefs['segmenttimes'] = segmenttimes
+    return state.State(inmeta=st.metadata, inprefs=inprefs, showsummary=False,
+                       validate=False)
+
+
+def shares_segment(placement, shmdir):
+    """ Will pipeline_seg pass data in shared memory for this placement?
+    """
+
+    reader, gpus = placement
+    return shmdir is not None and reader is not None and len(gpus) > 0
+
+
+def prep_and_search(st, segment, data, indexprefix='new', returnsoltime=False,
+                    override=None):
+    """ Reproduces rfpipe.search.prep_and_search but calculates and
+    indexes noises.
+    override is dict of preferences for this segment (see apply_override).
+    Stage statistics (see StageTimer) are attached to candcollection.stages.
+    """
+
+    from rfpipe import source, search, reproduce, candidates
 
-    candcollection = reproduce.reproduce_candcollection(candcollection, data)
+    st = apply_override(st, override)
+    timer = StageTimer()
+    data = util.resolve_segment(data)
+    with timer.stage('data_prep', data) as stats:
+        ret = source.data_prep(st, segment, data, returnsoltime=returnsoltime)
+        if returnsoltime:
+            data, soltime = ret
+        else:
+            data = ret
+            soltime = None
+        stats['bytes_out'] = nbytes(data)
+
+    with timer.stage('calc_and_indexnoises', data):
+        util.calc_and_indexnoises(st, segment, data, indexprefix=indexprefix)
+
+    with timer.stage('search', data) as stats:
+        if st.prefs.fftmode == "cuda":
+            candcollection = search.dedisperse_search_cuda(st, segment, data)
+        elif st.prefs.fftmode == "fftw":
+            candcollection = search.dedisperse_search_fftw(st, segment, data)
+        else:
+            logger.warning("fftmode {0} not recognized (cuda, fftw allowed)"
+                           .format(st.prefs.fftmode))
+        stats['bytes_out'] = nbytes(candcollection)
+
+    with timer.stage('reproduce_candcollection', candcollection) as stats:
+        candcollection = reproduce.reproduce_candcollection(candcollection, data)
+        stats['bytes_out'] = nbytes(candcollection)
 
     candcollection.soltime = soltime
 
-    candidates.save_cands(st, candcollection)
+    with timer.stage('save_cands', candcollection):
+        candidates.save_cands(st, candcollection)
+
+    candcollection.stages = timer.stages
 
     return candcollection
 
 
-def analyze_cc(cc):
+def analyze_cc(cc, readstages=None):
     """ Submittable function to get results of cc in memory
+    Returns (ncands, simulated_transient, stages), where stages is dict of
+    stage name to statistics from read and prep_and_search.
     """
     if isinstance(cc.prefs.simulated_transient, list):
         simulated_transient = cc.prefs.simulated_transient
     else:
         simulated_transient = None
-    return len(cc), simulated_transient
+
+    stages = OrderedDict()
+    if readstages is not None:
+        stages.update(readstages)
+    stages.update(getattr(cc, 'stages', {}))
+
+    return len(cc), simulated_transient, stages
+
+
+def read_segment_shared(st, segment, timeout=vys_timeout_default, cfile=None,
+                        shmdir=util._shmdir, overlap=False):
+    """ Read segment into a memory-mapped buffer in shmdir.
+    Returns util.SharedSegment handle, so only the handle is serialized.
+    """
+
+    from rfpipe import source
+
+    if overlap:
+        data = read_segment_overlap(st, segment, timeout=timeout, cfile=cfile)
+    else:
+        data = source.read_segment(st, segment, timeout=timeout, cfile=cfile)
+    name = '{0}_seg{1}_{2}'.format(st.metadata.scanId, segment,
+                                   tokenize(st.metadata.scanId, segment, os.getpid(), time()))
+    return util.SharedSegment.from_array(data, name, shmdir=shmdir)
+
+
+def segment_integrations(st, segment):
+    """ Range (start, stop) of integrations in segment counted from scan start.
+    """
+
+    start = int(round((st.segmenttimes[segment][0] - st.metadata.starttime_mjd)
+                      * 24*3600/st.metadata.inttime))
+    return start, start + st.readints
+
+
+def take_overlap(scanId, start, stop):
+    """ Remove and return cached integrations of scanId that start at
+    integration start and end before stop, or None.
+    """
+
+    with _overlap_lock:
+        for key in list(_overlap_cache):
+            if key[0] == scanId and key[1] == start and start < key[2] < stop:
+                return _overlap_cache.pop(key)
+
+
+def keep_overlap(scanId, start, data):
+    """ Cache integrations of scanId from integration start for read of next
+    segment. Cache is limited to _overlap_max entries and _overlap_maxbytes.
+    """
+
+    with _overlap_lock:
+        _overlap_cache[(scanId, start, start+len(data))] = data
+        while (len(_overlap_cache) > _overlap_max or
+               sum([val.nbytes for val in itervalues(_overlap_cache)]) > _overlap_maxbytes):
+            _ = _overlap_cache.popitem(last=False)
+
+
+def clear_overlap(scanId=None):
+    """ Remove cached integrations of scanId (or all). Returns bytes freed.
+    Can be run on workers when scan is done (e.g., with client.run).
+    """
+
+    with _overlap_lock:
+        keys = [key for key in _overlap_cache if scanId is None or key[0] == scanId]
+        return sum([_overlap_cache.pop(key).nbytes for key in keys])
+
+
+def read_segment_overlap(st, segment, timeout=vys_timeout_default, cfile=None):
+    """ Read segment, reusing integrations that overlap previous segment.
+    Overlap is taken from cache in worker process, if previous segment of
+    scan was read on this worker. Only the rest of the segment is read.
+    If the rest does not have the expected integrations, the whole segment
+    is read. Overlap with next segment is cached for its read.
+    """
+
+    from rfpipe import source, state
+
+    scanId = st.metadata.scanId
+    start, stop = segment_integrations(st, segment)
+
+    head = take_overlap(scanId, start, stop)
+    if head is not None:
+        # read integrations after overlap with substate of one segment
+        t0 = st.segmenttimes[segment][0] + len(head)*st.metadata.inttime/(24*3600.)
+        inprefs = dict(st.prefs.ordered)
+        inprefs['segmenttimes'] = [[t0, st.segmenttimes[segment][1]]]
+        st_tail = state.State(inmeta=st.metadata, inprefs=inprefs,
+                              showsummary=False, validate=False)
+        tail = source.read_segment(st_tail, 0, timeout=timeout, cfile=cfile)
+        if (tail is not None and len(head) + len(tail) == stop - start and
+                tail.shape[1:] == head.shape[1:]):
+            data = np.concatenate([head, tail])
+            logger.info("Reused {0} of {1} integrations for scanId {2}, segment {3}"
+                        .format(len(head), len(data), scanId, segment))
+        else:
+            logger.warning("Read {0} integrations after {1} reused for scanId {2}, "
+                           "segment {3}, but expected {4}. Reading whole segment."
+                           .format(len(tail) if tail is not None else 0, len(head),
+                                   scanId, segment, stop - start - len(head)))
+            head = None
+
+    if head is None:
+        data = source.read_segment(st, segment, timeout=timeout, cfile=cfile)
+
+    if segment+1 < st.nsegment:
+        nextstart, nextstop = segment_integrations(st, segment+1)
+        if start < nextstart < start+len(data):
+            keep_overlap(scanId, nextstart, data[nextstart-start:].copy())
+
+    return data
 
 
 def read_segment(st, segment, cfile, vys_timeout):
@@ -156,26 +692,163 @@ def read_segment(st, segment, cfile, vys_timeout):
 
 def mergelists(futlists):
     """ Take list of lists and return single list
-    ** TODO: could put logic here to find islands, peaks, etc?
+    (see merge_candidates to merge candidates across segments).
     """
 
     return [fut for futlist in futlists for fut in futlist]
 
 
+def boundary_duplicates(cc, neighbours, dmtol=0.1, lmtol=np.radians(1/60.)):
+    """ Boolean array of candidates in cc that duplicate a stronger
+    candidate of neighbouring segments (candcollections).
+    Duplicates overlap in time (within the larger width or one integration),
+    DM (fractional dmtol), and l, m (lmtol in radians). Ties are kept by
+    the earlier segment.
+    """
+
+    dup = np.zeros(len(cc), dtype=bool)
+    if not len(cc):
+        return dup
+
+    inttime = cc.metadata.inttime
+    for ncc in neighbours:
+        if not len(ncc):
+            continue
+
+        dt = np.abs(cc.candmjd[:, None] - ncc.candmjd[None, :])*24*3600
+        width = np.maximum(np.maximum(cc.canddt[:, None], ncc.canddt[None, :]),
+                           inttime)
+        dm = np.maximum(np.maximum(cc.canddm[:, None], ncc.canddm[None, :]), 1.)
+        match = ((dt <= width) &
+                 (np.abs(cc.canddm[:, None] - ncc.canddm[None, :]) <= dmtol*dm) &
+                 (np.abs(cc.candl[:, None] - ncc.candl[None, :]) <= lmtol) &
+                 (np.abs(cc.candm[:, None] - ncc.candm[None, :]) <= lmtol))
+
+        if ncc.segment < cc.segment:
+            stronger = ncc.snrtot[None, :] >= cc.snrtot[:, None]
+        else:
+            stronger = ncc.snrtot[None, :] > cc.snrtot[:, None]
+        dup |= (match & stronger).any(axis=1)
+
+    return dup
+
+
+def merge_candidates(cc, *neighbours, **kwargs):
+    """ Submittable function that removes candidates of cc that are
+    duplicates of candidates in neighbouring segments.
+    Each event found in overlapping segments is kept once, at its peak.
+    kwargs are passed to boundary_duplicates.
+    """
+
+    if isinstance(cc, distributed.Future):
+        cc = cc.result()
+
+    dup = boundary_duplicates(cc, neighbours, **kwargs)
+    if not dup.any():
+        return cc
+
+    logger.info("Merged {0} of {1} candidates of scanId {2}, segment {3} into neighbouring segments"
+                .format(dup.sum(), len(cc), cc.metadata.scanId, cc.segment))
+
+    merged = copy.copy(cc)
+    merged.array = cc.array[~dup]
+    if len(getattr(cc, 'canddata', [])):
+        locs = set(tuple(loc) for loc in merged.locs)
+        merged.canddata = [cd for cd in cc.canddata if tuple(cd.loc) in locs]
+
+    return merged
+
+
 def lazy_read_segment(st, segment, cfile=None,
-                      timeout=vys_timeout_default):
+                      timeout=vys_timeout_default, intchunk=None,
+                      chanchunks=None):
     """ rfpipe read_segment as a dask array.
     equivalent to making delayed version of function and then:
-    arr = dask.array.from_delayed(dd, st.datashape, np.complex64).
+    arr = dask.array.from_delayed(dd, st.datashape_orig, np.complex64).
+    If intchunk is set, each block of intchunk integrations is a chunk
+    read independently (see read_integrations), so reductions over chunks
+    can run in parallel as integrations arrive.
+    chanchunks is optional tuple of channels per chunk (e.g., per spw).
+    Channel chunks are slices of their integration block, so each block
+    is read once.
     """
 
-    from rfpipe import source
+    shape = st.datashape_orig
+    if intchunk is None:
+        intchunks = (shape[0],)
+    else:
+        intchunks = (intchunk,)*(shape[0]//intchunk)
+        if shape[0] % intchunk:
+            intchunks += (shape[0] % intchunk,)
+    if chanchunks is None:
+        chanchunks = (shape[2],)
+    else:
+        chanchunks = tuple(chanchunks)
+        assert sum(chanchunks) == shape[2], "chanchunks must sum to {0} channels".format(shape[2])
+    chunks = (intchunks, (shape[1],), chanchunks, (shape[3],))
+
+    if len(intchunks) == 1 and len(chanchunks) == 1:
+        from rfpipe import source
+
+        name = 'read_segment-' + tokenize([st, segment])
+        dask = {(name, 0, 0, 0, 0): (source.read_segment, st, segment,
+                                     cfile, timeout)}
+        return array.Array(dask=dask, name=name, chunks=chunks,
+                           dtype=np.complex64)
+
+    name = 'read_segment-' + tokenize([st, segment, intchunks, chanchunks])
+    readname = 'read_integrations-' + tokenize([st, segment, intchunks])
+    dask = {}
+    start = 0
+    for i, nint in enumerate(intchunks):
+        read = (read_integrations, st, segment, start, start+nint, cfile,
+                timeout)
+        if len(chanchunks) == 1:
+            dask[(name, i, 0, 0, 0)] = read
+        else:
+            dask[(readname, i)] = read
+            chan0 = 0
+            for j, nchan in enumerate(chanchunks):
+                dask[(name, i, 0, j, 0)] = (getitem, (readname, i),
+                                            (slice(None), slice(None),
+                                             slice(chan0, chan0+nchan)))
+                chan0 += nchan
+        start += nint
 
-    shape = st.datashape
-    chunks = ((shape[0],), (shape[1],), (shape[2],), (shape[3],))
+    return array.Array(dask=dask, name=name, chunks=chunks, dtype=np.complex64)
 
-    name = 'read_segment-' + tokenize([st, segment])
-    dask = {(name, 0, 0, 0, 0): (source.read_segment, st, segment,
-                                 cfile, timeout)}
 
-    return array.Array(dask=dask, name=name, chunks=chunks, dtype=np.complex64)
+def read_integrations(st, segment, start, stop, cfile=None,
+                      timeout=vys_timeout_default):
+    """ Read integrations start to stop (counted from segment start) of segment.
+    Reads with a State of one segment covering only those integrations.
+    """
+
+    from rfpipe import source, state
+
+    if start == 0 and stop >= st.readints:
+        data = source.read_segment(st, segment, cfile=cfile, timeout=timeout)
+    else:
+        t0 = st.segmenttimes[segment][0] + start*st.metadata.inttime/(24*3600.)
+        t1 = st.segmenttimes[segment][0] + stop*st.metadata.inttime/(24*3600.)
+        inprefs = dict(st.prefs.ordered)
+        inprefs['segmenttimes'] = [[t0, t1]]
+        st_block = state.State(inmeta=st.metadata, inprefs=inprefs,
+                               showsummary=False, validate=False)
+        data = source.read_segment(st_block, 0, cfile=cfile, timeout=timeout)
+
+    check_integrations(st, data, min(stop, st.readints) - start)
+
+    return data
+
+
+def check_integrations(st, data, nint):
+    """ Assert that data read has nint integrations of shape of
+    st.datashape_orig (as returned by read_segment).
+    """
+
+    shape = (nint,) + tuple(st.datashape_orig[1:])
+    assert data is not None and data.shape == shape, ("Read data with shape {0}, "
+                                                      "but expected {1}"
+                                                      .format(getattr(data, 'shape', None),
+                                                              shape))
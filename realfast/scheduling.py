@@ -0,0 +1,632 @@
+from __future__ import print_function, division, absolute_import#, unicode_literals # not casa compatible
+from builtins import bytes, dict, object, range, map, input#, str # not casa compatible
+from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
+from io import open
+
+import threading
+from time import time
+from collections import OrderedDict
+from functools import partial
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(20)
+
+statuses = ('pending', 'finished', 'error', 'lost')
+
+
+class SegmentRecord(object):
+    """ Futures for one submitted segment of a scan.
+    """
+
+    __slots__ = ('scanId', 'segment', 'data', 'cc', 'acc', 'status')
+
+    def __init__(self, scanId, segment, data, cc, acc):
+        self.scanId = scanId
+        self.segment = segment
+        self.data = data
+        self.cc = cc
+        self.acc = acc
+        self.status = 'pending'
+
+    @property
+    def key(self):
+        return (self.scanId, self.segment)
+
+    @property
+    def futures(self):
+        """ Tuple (seg, data, cc, acc) as returned by pipeline_seg
+        """
+
+        return (self.segment, self.data, self.cc, self.acc)
+
+    def future_status(self):
+        """ Calculate segment status from status of its futures.
+        """
+
+        futstatuses = [fut.status for fut in (self.data, self.cc, self.acc)]
+        if 'error' in futstatuses or 'cancelled' in futstatuses:
+            return 'error'
+        elif 'lost' in futstatuses:
+            return 'lost'
+        elif self.acc.status == 'finished':
+            return 'finished'
+        else:
+            return 'pending'
+
+    def __repr__(self):
+        return ('{0}, {1}: {2}'.format(self.scanId, self.segment, self.status))
+
+
+class SegmentRegistry(object):
+    """ Segment futures keyed by (scanId, segment).
+    Records are kept in status buckets ('pending', 'finished', 'error', 'lost')
+    per scanId. Buckets are updated by done callbacks on the futures, so
+    status queries cost only the size of the result.
+    Iterates like a dict of scanId keys.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._records = {}
+        self._scans = OrderedDict()  # scanId: {status: OrderedDict of records}
+
+    @classmethod
+    def from_dict(cls, futures):
+        """ Build registry from dict of scanId: list of (seg, data, cc, acc)
+        """
+
+        registry = cls()
+        for scanId, futurelist in iteritems(futures):
+            registry.add_scan(scanId)
+            for futures in futurelist:
+                registry.add(scanId, futures)
+
+        return registry
+
+    def to_dict(self):
+        """ Dict of scanId: list of (seg, data, cc, acc), as used to publish.
+        """
+
+        with self._lock:
+            return dict((scanId, [rec.futures for rec in self.records(scanId)])
+                        for scanId in self._scans)
+
+    def add_scan(self, scanId):
+        with self._lock:
+            if scanId not in self._scans:
+                self._scans[scanId] = dict((status, OrderedDict())
+                                           for status in statuses)
+
+    def add(self, scanId, futures):
+        """ Add tuple (seg, data, cc, acc) for scanId. Returns record.
+        """
+
+        segment, data, cc, acc = futures
+        record = SegmentRecord(scanId, segment, data, cc, acc)
+        with self._lock:
+            self.add_scan(scanId)
+            if record.key in self._records:
+                logger.warn("Replacing futures for scanId {0}, segment {1}"
+                            .format(scanId, segment))
+                self.remove(scanId, segment)
+            self._records[record.key] = record
+            self._scans[scanId]['pending'][record.key] = record
+
+        for fut in (data, cc, acc):
+            fut.add_done_callback(partial(self._update, record))
+
+        return record
+
+    def _update(self, record, fut=None):
+        """ Move record to bucket for its current status.
+        """
+
+        with self._lock:
+            if self._records.get(record.key) is not record:
+                return  # removed already
+
+            status = record.future_status()
+            if status != record.status:
+                buckets = self._scans[record.scanId]
+                buckets[record.status].pop(record.key)
+                buckets[status][record.key] = record
+                record.status = status
+
+    def refresh(self, scanId=None):
+        """ Check pending records for status changes that have no callback
+        (e.g., 'lost').
+        """
+
+        for record in self.bucket('pending', scanId=scanId):
+            self._update(record)
+
+    def remove(self, scanId, segment):
+        """ Remove and return record for segment.
+        """
+
+        with self._lock:
+            record = self._records.pop((scanId, segment))
+            self._scans[scanId][record.status].pop(record.key)
+
+        return record
+
+    def remove_scan(self, scanId):
+        """ Remove scanId and all of its records.
+        """
+
+        with self._lock:
+            for record in self.records(scanId):
+                self._records.pop(record.key)
+            self._scans.pop(scanId)
+
+    def records(self, scanId=None):
+        """ List of records, optionally for one scanId.
+        """
+
+        with self._lock:
+            if scanId is None:
+                return list(itervalues(self._records))
+            else:
+                return sorted([rec for status in statuses
+                               for rec in itervalues(self._scans[scanId][status])],
+                              key=lambda rec: rec.segment)
+
+    def bucket(self, status, scanId=None):
+        """ List of records with status, optionally for one scanId.
+        """
+
+        with self._lock:
+            scanIds = [scanId] if scanId is not None else list(self._scans)
+            return [rec for scanId in scanIds
+                    for rec in itervalues(self._scans[scanId][status])]
+
+    def count(self, status=None, scanId=None):
+        """ Number of records with status, optionally for one scanId.
+        """
+
+        with self._lock:
+            scanIds = [scanId] if scanId is not None else list(self._scans)
+            selected = [status] if status is not None else statuses
+            return sum([len(self._scans[scanId][status])
+                        for scanId in scanIds for status in selected])
+
+    def __getitem__(self, scanId):
+        return [rec.futures for rec in self.records(scanId)]
+
+    def __contains__(self, scanId):
+        return scanId in self._scans
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._scans))
+
+    def __len__(self):
+        return len(self._scans)
+
+    def __repr__(self):
+        return ('SegmentRegistry with {0} segments in {1} scans'
+                .format(len(self._records), len(self._scans)))
+
+
+class AdmissionController(object):
+    """ Grants segment submissions to scans submitting concurrently.
+    Pending segments of all active scans are queued with a read deadline
+    (unix time or None). Waiting submissions are admitted earliest deadline
+    first when the cluster is ready. Ties (and segments without deadline)
+    go to the scan with lowest load (e.g., segments in flight).
+    Admission rate under backlog is used to predict deadline misses.
+    """
+
+    def __init__(self, load=None):
+        self.load = load if load is not None else (lambda scanId: 0)
+        self._cond = threading.Condition()
+        self._waiting = OrderedDict()  # (scanId, segment): number of waiting requests
+        self._queued = {}  # (scanId, segment): deadline
+        self._interval = None  # mean time (s) between admissions under backlog
+        self._lastadmit = None
+        self._misses = set()  # (scanId, segment) already reported as likely miss
+        self._generation = 0  # counts notifications, so none is missed by admit
+
+    @property
+    def waiting(self):
+        return list(self._waiting)
+
+    @property
+    def queued(self):
+        """ List of queued (deadline, scanId, segment) in admission order.
+        """
+
+        with self._cond:
+            return sorted([(deadline, scanId, segment)
+                           for (scanId, segment), deadline in iteritems(self._queued)],
+                          key=lambda x: self._priority(x[1], x[2]))
+
+    def _priority(self, scanId, segment):
+        deadline = self._queued.get((scanId, segment))
+        return (deadline is None, deadline or 0, self.load(scanId))
+
+    def enqueue(self, scanId, deadlines):
+        """ Queue segments of scanId with dict of segment: deadline.
+        """
+
+        with self._cond:
+            for segment, deadline in iteritems(deadlines):
+                self._queued[(scanId, segment)] = deadline
+            self._notify()
+
+    def dequeue(self, scanId, segments):
+        """ Remove segments of scanId from queue (e.g., submitted or skipped).
+        """
+
+        with self._cond:
+            for segment in segments:
+                _ = self._queued.pop((scanId, segment), None)
+                self._misses.discard((scanId, segment))
+            self._notify()
+
+    def next_scan(self):
+        """ (scanId, segment) that gets next turn.
+        """
+
+        with self._cond:
+            if not self._waiting:
+                return None
+            # min keeps first (earliest waiting) of equal priority
+            return min(self._waiting, key=lambda key: self._priority(*key))
+
+    def admit(self, scanId, segment=None, ready=None, timeout=None):
+        """ Wait for turn of scanId segment while ready() returns True.
+        Returns True if admitted or False if timeout (in s) elapses.
+        Admitted segment is removed from queue.
+        ready() may query the scheduler, so it is called without the lock.
+        """
+
+        key = (scanId, segment)
+        t0 = time()
+        waited = False
+        with self._cond:
+            self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            while True:
+                with self._cond:
+                    generation = self._generation
+                    turn = self.next_scan() == key
+
+                if turn and (ready is None or ready()):
+                    with self._cond:
+                        if self.next_scan() == key:
+                            self._admitted(key, backlog=waited or len(self._waiting) > 1)
+                            return True
+                    continue  # other scan took turn while checking ready
+
+                remaining = None if timeout is None else timeout - (time() - t0)
+                if remaining is not None and remaining <= 0:
+                    return False
+                with self._cond:
+                    if generation == self._generation:  # no notify since check
+                        self._cond.wait(remaining)
+                waited = True
+        finally:
+            with self._cond:
+                self._waiting[key] -= 1
+                if not self._waiting[key]:
+                    self._waiting.pop(key)
+                self._notify()
+
+    def _admitted(self, key, backlog):
+        """ Update admission rate. Only intervals under backlog measure capacity.
+        """
+
+        now = time()
+        if backlog and self._lastadmit is not None:
+            interval = now - self._lastadmit
+            if self._interval is None:
+                self._interval = interval
+            else:
+                self._interval = 0.8*self._interval + 0.2*interval
+        self._lastadmit = now
+        _ = self._queued.pop(key, None)
+        self._misses.discard(key)
+
+    def expected_misses(self, now=None):
+        """ List of (scanId, segment) expected to miss deadline at current
+        admission rate.
+        """
+
+        if now is None:
+            now = time()
+
+        if self._interval is None:
+            return []
+
+        misses = []
+        for i, (deadline, scanId, segment) in enumerate(self.queued):
+            if deadline is None:
+                break
+            if now + (i+1)*self._interval > deadline:
+                misses.append((scanId, segment))
+
+        return misses
+
+    def report_misses(self):
+        """ Log a warning for segments newly expected to miss deadline.
+        Returns number of expected misses.
+        """
+
+        misses = self.expected_misses()
+        with self._cond:
+            new = [miss for miss in misses if miss not in self._misses]
+            self._misses.update(new)
+
+        if new:
+            logger.warn("{0} segments expected to miss read deadline at {1:.1f} s "
+                        "per admission: {2}"
+                        .format(len(new), self._interval,
+                                ', '.join(['{0}:{1}'.format(scanId, segment)
+                                           for scanId, segment in new])))
+
+        return len(misses)
+
+    def notify(self):
+        """ Wake waiting scans to check readiness (e.g., capacity freed).
+        """
+
+        with self._cond:
+            self._notify()
+
+    def _notify(self):
+        """ Wake waiting scans. Call with lock held.
+        """
+
+        self._generation += 1
+        self._cond.notify_all()
+
+
+class ReleaseTracker(object):
+    """ Reference counts for shared segment buffers keyed by (scanId, segment).
+    Each future that uses a buffer holds a reference until it is done.
+    release is called once, after the owner drops the buffer (e.g., the
+    segment is removed from registry) and all uses are done.
+    Buffers are held at a location (e.g., reader address) with size nbytes,
+    so memory heuristics can count them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # key: [releases, number of uses, dropped, location, nbytes]
+
+    def hold(self, key, release, location=None, nbytes=0):
+        """ Hold buffer of key until dropped. Holding a key again (e.g., a
+        resubmitted segment) keeps its uses and adds release.
+        """
+
+        with self._lock:
+            if key in self._entries:
+                entry = self._entries[key]
+                entry[0].append(release)
+                entry[2] = False
+                entry[4] += nbytes
+            else:
+                self._entries[key] = [[release], 0, False, location, nbytes]
+
+    def use(self, key, future):
+        """ Reference buffer of key until future is done.
+        """
+
+        with self._lock:
+            if key not in self._entries:
+                return
+            self._entries[key][1] += 1
+        future.add_done_callback(partial(self._done, key))
+
+    def _done(self, key, fut=None):
+        with self._lock:
+            if key not in self._entries:
+                return
+            self._entries[key][1] -= 1
+        self._release(key)
+
+    def drop(self, key):
+        """ Owner no longer needs buffer of key.
+        """
+
+        with self._lock:
+            if key not in self._entries:
+                return
+            self._entries[key][2] = True
+        self._release(key)
+
+    def _release(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return
+            releases, nuse, dropped, location, nbytes = self._entries[key]
+            if nuse > 0 or not dropped:
+                return
+            _ = self._entries.pop(key)
+        for release in releases:
+            release()
+
+    def location(self, key):
+        """ Location of buffer of key or None.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[3] if entry is not None else None
+
+    def nbytes(self):
+        """ Dict of location: bytes held there.
+        """
+
+        with self._lock:
+            held = {}
+            for (releases, nuse, dropped, location, nbytes) in itervalues(self._entries):
+                held[location] = held.get(location, 0) + nbytes
+            return held
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class AdaptiveThrottle(object):
+    """ AIMD limit on segments in flight.
+    Window grows by increase per window of completed segments and shrinks
+    by factor decrease on congestion (e.g., reader memory short or segment
+    error). Congestion signals within holdtime (s) of the last decrease
+    count once. Submission waits while segments in flight fill the window
+    and, optionally, until pace times an interval passed since the last
+    submission. pace starts at 1, shrinks by factor speedup per completed
+    segment and grows back (up to 1) by 1/decrease on congestion, so
+    pacing vanishes while the cluster keeps up.
+    """
+
+    def __init__(self, window=2., minwindow=1., maxwindow=None, increase=1.,
+                 decrease=0.5, holdtime=1., speedup=0.5):
+        self.window = window
+        self.minwindow = minwindow
+        self.maxwindow = maxwindow
+        self.increase = increase
+        self.decrease = decrease
+        self.holdtime = holdtime
+        self.speedup = speedup
+        self.pace = 1.
+        self._cond = threading.Condition()
+        self._lastdecrease = 0.
+        self._lastsubmit = 0.
+        self.ncompleted = 0
+
+    def completed(self, fut=None):
+        """ Segment completed. Can be used as done callback.
+        Failed segments count as congestion.
+        """
+
+        if fut is not None and fut.status != 'finished':
+            self.congested()
+
+        with self._cond:
+            self.ncompleted += 1
+            if fut is None or fut.status == 'finished':
+                self.window += self.increase/self.window
+                self.pace *= self.speedup
+            if self.maxwindow is not None:
+                self.window = min(self.window, self.maxwindow)
+            self._cond.notify_all()
+
+    def congested(self):
+        """ Cluster can not absorb more segments.
+        """
+
+        with self._cond:
+            now = time()
+            if now - self._lastdecrease > self.holdtime:
+                self.window = max(self.minwindow, self.window*self.decrease)
+                self.pace = min(1., max(self.pace, 1e-3)/self.decrease)
+                self._lastdecrease = now
+                logger.debug("Throttle window reduced to {0:.1f} (pace {1:.2f})"
+                             .format(self.window, self.pace))
+
+    def submitted(self):
+        """ Segment submitted. Starts the interval for the next wait.
+        """
+
+        with self._cond:
+            self._lastsubmit = time()
+
+    def wait(self, inflight, timeout=None, interval=0.):
+        """ Wait until inflight() (number of segments in flight) is below
+        window and pace*interval (in s) passed since last submission (see
+        submitted). Returns False if timeout (in s) elapses first.
+        """
+
+        t0 = time()
+        with self._cond:
+            while True:
+                now = time()
+                paced = self._lastsubmit + self.pace*interval - now
+                if inflight() < int(self.window) and paced <= 0:
+                    return True
+
+                remaining = None if timeout is None else timeout - (now - t0)
+                if remaining is not None and remaining <= 0:
+                    return False
+                if paced > 0:
+                    remaining = paced if remaining is None else min(remaining, paced)
+                self._cond.wait(remaining)
+
+    def notify(self):
+        with self._cond:
+            self._cond.notify_all()
+
+
+class SegmentMerger(object):
+    """ Holds candidates of finished segments until neighbouring segments
+    are done, so candidates at segment boundaries can be merged before
+    indexing. Only the cc future of a segment is held, so its data can be
+    released when the segment finishes. A neighbour is waited on while it
+    is pending or may still be submitted. cc of a finished segment is kept
+    until both neighbours are released.
+    Only called from cleanup thread.
+    """
+
+    def __init__(self):
+        self._finished = {}  # scanId: {segment: cc}
+        self._released = {}  # scanId: set of released segments
+
+    def add(self, scanId, segment, cc):
+        self._finished.setdefault(scanId, {})[segment] = cc
+
+    def release(self, scanId, pending, nsegment=None, final=False):
+        """ Returns list of (segment, cc, neighbours) for finished segments
+        of scanId whose neighbours are done. neighbours is list of cc
+        futures of finished neighbouring segments. A neighbour that is
+        neither pending nor finished is waited for unless final is set
+        (i.e., submission for scanId has ended) or it is out of range.
+        """
+
+        finished = self._finished.get(scanId, {})
+        released = self._released.setdefault(scanId, set())
+        pending = set(pending)
+
+        def waiting(seg):
+            if seg in pending:
+                return True
+            elif seg in finished or seg in released or final:
+                return False
+            else:
+                return seg >= 0 and (nsegment is None or seg < nsegment)
+
+        readylist = []
+        for segment in sorted(finished):
+            if segment in released or waiting(segment-1) or waiting(segment+1):
+                continue
+            neighbours = [finished[seg] for seg in (segment-1, segment+1)
+                          if seg in finished]
+            readylist.append((segment, finished[segment], neighbours))
+            released.add(segment)
+
+        # neighbours of segment will not ask for it again
+        for segment in list(finished):
+            if segment in released and not any((seg in finished and seg not in released) or
+                                               waiting(seg)
+                                               for seg in (segment-1, segment+1)):
+                _ = finished.pop(segment)
+
+        return readylist
+
+    def held(self, scanId=None):
+        """ Number of finished segments not yet released.
+        """
+
+        scanIds = [scanId] if scanId is not None else list(self._finished)
+        return sum(len([seg for seg in self._finished.get(sc, {})
+                        if seg not in self._released.get(sc, set())])
+                   for sc in scanIds)
+
+    def remove_scan(self, scanId):
+        _ = self._finished.pop(scanId, None)
+        _ = self._released.pop(scanId, None)
@@ -0,0 +1,170 @@
+from __future__ import print_function, division, absolute_import#, unicode_literals # not casa compatible
+from builtins import bytes, dict, object, range, map, input#, str # not casa compatible
+from future.utils import itervalues, viewitems, iteritems, listvalues, listitems
+from io import open
+
+import os.path
+import threading
+from datetime import timezone, datetime
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(20)
+
+_telcal_dir = '/home/mchammer/evladata/telcal'
+
+
+def telcalfile(datasetId, directory=_telcal_dir, today=None):
+    """ Path of telcal gain file for datasetId in this month's directory.
+    """
+
+    if today is None:
+        today = datetime.now(timezone.utc)
+    return os.path.join(directory, '{0}'.format(today.year),
+                        '{0:02}'.format(today.month),
+                        '{0}.GN'.format(datasetId))
+
+
+def sols_ok(sols):
+    """ Are there any unflagged solutions?
+    """
+
+    return bool(len(sols)) and not all(sols['flagged'])
+
+
+class TelcalWatcher(object):
+    """ Polls telcal gain files of watched scans in one thread.
+    Each file is parsed once per modification (mtime) and scan.
+    Solutions are cached by (path, mtime, scanId), so readiness is a
+    dictionary lookup. onready is called when a scan gets good solutions.
+    """
+
+    def __init__(self, period=2., directory=_telcal_dir, onready=None,
+                 getsols=None):
+        self.period = period
+        self.directory = directory
+        self.onready = onready
+        self._getsols = getsols
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._states = {}  # scanId: state
+        self._sols = {}  # (path, mtime, scanId): sols
+        self._current = {}  # scanId: (path, mtime) of last parse
+        self._ready = {}  # scanId: threading.Event
+        self._thread = None
+
+    def getsols(self, st):
+        if self._getsols is None:
+            from rfpipe.calibration import getsols
+            self._getsols = getsols
+        return self._getsols(st)
+
+    def start(self):
+        """ Start polling thread.
+        """
+
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self.run, name='telcal')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def run(self):
+        while True:
+            self._wake.wait(self.period)
+            self._wake.clear()
+            try:
+                self.poll()
+            except Exception as exc:
+                logger.exception("Telcal poll failed: {0}".format(exc))
+
+    def watch(self, scanId, st):
+        """ Start watching gain file for scanId. Wakes polling thread.
+        A new state for scanId replaces the watched one. It gets the gain
+        file found so far and is not ready until its solutions are parsed.
+        """
+
+        with self._lock:
+            if scanId not in self._states:
+                self._ready[scanId] = threading.Event()
+            elif self._states[scanId] is not st:
+                if scanId in self._current and st.gainfile is None:
+                    st.prefs.gainfile = self._current[scanId][0]
+                _ = self._current.pop(scanId, None)
+                self._ready[scanId].clear()
+            self._states[scanId] = st
+        self._wake.set()
+
+    def unwatch(self, scanId):
+        with self._lock:
+            _ = self._states.pop(scanId, None)
+            _ = self._ready.pop(scanId, None)
+            _ = self._current.pop(scanId, None)
+            for key in [key for key in self._sols if key[2] == scanId]:
+                _ = self._sols.pop(key)
+
+    def poll(self):
+        """ Parse gain files that are new or modified since last poll.
+        """
+
+        with self._lock:
+            states = list(iteritems(self._states))
+
+        for scanId, st in states:
+            if st.gainfile is None:
+                path = telcalfile(st.metadata.datasetId, directory=self.directory)
+            else:
+                path = st.gainfile
+
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+
+            if self._current.get(scanId) == (path, mtime):
+                continue
+
+            if st.gainfile is None:
+                logger.debug("Found telcalfile {0} for scanId {1}."
+                             .format(path, scanId))
+                st.prefs.gainfile = path
+
+            sols = self.getsols(st)
+            with self._lock:
+                if self._states.get(scanId) is not st:
+                    continue  # unwatched or replaced while parsing
+                for key in [key for key in self._sols if key[2] == scanId]:
+                    _ = self._sols.pop(key)
+                self._sols[(path, mtime, scanId)] = sols
+                self._current[scanId] = (path, mtime)
+                ready = self._ready[scanId]
+
+            if sols_ok(sols) and not ready.is_set():
+                logger.info("Good telcal solutions for scanId {0}".format(scanId))
+                ready.set()
+                if self.onready is not None:
+                    self.onready()
+
+    def sols(self, scanId):
+        """ Cached solutions for scanId, or None if not parsed yet.
+        """
+
+        with self._lock:
+            if scanId in self._current:
+                path, mtime = self._current[scanId]
+                return self._sols[(path, mtime, scanId)]
+
+    def ready(self, scanId):
+        """ Does scanId have good solutions? Does not block.
+        """
+
+        event = self._ready.get(scanId)
+        return event is not None and event.is_set()
+
+    def wait(self, scanId, timeout=None):
+        """ Block until scanId has good solutions or timeout (in s) elapses.
+        """
+
+        event = self._ready.get(scanId)
+        if event is None:
+            return False
+        return event.wait(timeout)
@@ -13,6 +13,7 @@ from astropy import time
 from time import sleep
 from realfast import elastic, mcaf_servers
 import distributed
+import distributed.diagnostics.plugin
 from elasticsearch import NotFoundError, ConnectionError
 
 import logging
@@ -21,6 +22,7 @@ logger.setLevel(20)
 
 _candplot_dir = 'claw@nmpost-master:/lustre/aoc/projects/fasttransients/realfast/plots'
 _candplot_url_prefix = 'http://realfast.nrao.edu/plots'
+_shmdir = '/dev/shm'
 
 
 def indexcands_and_plots(cc, scanId, tags, indexprefix, workdir, nvss_radius=5, atnf_radius=5, max_cc=None):
@@ -41,9 +43,10 @@ def indexcands_and_plots(cc, scanId, tags, indexprefix, workdir, nvss_radius=5,
                 return cc
 
         logger.info("Indexing candidates")
-        nc = elastic.indexcands(cc, scanId, tags=tags,
-                                url_prefix=_candplot_url_prefix,
-                                indexprefix=indexprefix)
+        report = elastic.indexcands(cc, scanId, tags=tags,
+                                    url_prefix=_candplot_url_prefix,
+                                    indexprefix=indexprefix)
+        nc = listvalues(report).count('pushed')
 
         assoc = find_associations(cc, mode='nvss', nvss_radius=nvss_radius)  # find false positives
         if assoc is not None:
@@ -460,6 +463,7 @@ def createproducts(candcollection, data, indexprefix=None, nvss_radius=None,
     if isinstance(data, distributed.Future):
         logger.info("Calling data in...")
         data = data.result()
+    data = resolve_segment(data)
 
     assert isinstance(data, np.ndarray) and data.dtype == 'complex64'
 
@@ -592,13 +596,11 @@ def cc_to_annotation(cc0, run_QA_query=True, indexprefix='new', timeout=60):
     vnoise = None
     inoise = None
     if run_QA_query:
-        Ids = [Id for Id in elastic.get_ids(indexprefix+'noises', scanId=scanid)
-               if '{0}.{1}'.format(scanid, segment) in Id]
-        if len(Ids):
-            source = elastic.get_doc(indexprefix+'noises', Ids[0])['_source']
-            zf = source['zerofrac']
-            vnoise = source['noiseperbl']
-            inoise = source['imstd']
+        noisedocs = elastic.get_noisedocs(indexprefix, scanid, segment=segment)
+        if len(noisedocs):
+            zf = noisedocs[0]['zerofrac_median']
+            vnoise = noisedocs[0]['noiseperbl_median']
+            inoise = noisedocs[0]['imstd_median']
         else:
             logger.warn("No noises found for {0}.{1}".format(scanid, segment))
 
@@ -912,6 +914,7 @@ def data_logger(st, segment, data):
 
     from rfpipe import fileLock
 
+    data = resolve_segment(data)
     filename = os.path.join(st.prefs.workdir,
                             "data_" + st.fileroot + ".txt")
 
@@ -968,6 +971,97 @@ def gencandranges(candcollection):
     return [(st.segmenttimes[segment][0], st.segmenttimes[segment][1])]
 
 
+class SharedSegment(object):
+    """ Handle to segment visibilities in a memory-mapped file on one host
+    (e.g., in /dev/shm). Pickles as path, shape, dtype, and host only.
+    Arrays map the file copy-on-write, so in-place changes (e.g., data_prep)
+    stay private to the task and the buffer is not copied.
+    """
+
+    def __init__(self, path, shape, dtype, host):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.host = host
+
+    @classmethod
+    def from_array(cls, data, name, shmdir=_shmdir):
+        """ Write data to a new file in shmdir and return handle.
+        """
+
+        import socket
+
+        path = os.path.join(shmdir, 'realfast_{0}.dat'.format(name))
+        try:
+            buf = np.memmap(path, dtype=data.dtype, mode='w+', shape=data.shape)
+            buf[:] = data
+            buf.flush()
+            del buf
+        except Exception:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+        return cls(path, data.shape, data.dtype.str, socket.gethostname())
+
+    def array(self):
+        import socket
+
+        assert self.host == socket.gethostname(), ("Segment buffer is on {0}"
+                                                   .format(self.host))
+        return np.memmap(self.path, dtype=self.dtype, mode='c', shape=self.shape)
+
+    def release(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+            logger.debug("Released segment buffer {0}".format(self.path))
+
+    def __repr__(self):
+        return 'SharedSegment {0} on {1}'.format(self.path, self.host)
+
+
+def resolve_segment(data):
+    """ Get segment array from data or SharedSegment handle.
+    """
+
+    if isinstance(data, SharedSegment):
+        return data.array()
+    else:
+        return data
+
+
+def release_segment(data):
+    """ Remove segment buffer, if data is a SharedSegment handle.
+    """
+
+    if isinstance(data, SharedSegment):
+        data.release()
+
+
+def sweep_segments(shmdir=_shmdir, maxage=3600.):
+    """ Remove segment buffers in shmdir older than maxage (in s).
+    Returns list of removed paths.
+    """
+
+    import glob
+    from time import time
+
+    removed = []
+    for path in glob.glob(os.path.join(shmdir, 'realfast_*.dat')):
+        try:
+            if time() - os.path.getmtime(path) > maxage:
+                os.remove(path)
+                removed.append(path)
+        except OSError:
+            pass  # removed by other worker
+
+    if removed:
+        logger.info("Removed {0} stale segment buffers from {1}"
+                    .format(len(removed), shmdir))
+
+    return removed
+
+
 def initialize_worker():
     """ Function called to initialize python on workers
     """
@@ -979,6 +1073,108 @@ def initialize_worker():
     return st
 
 
+def wisdom_shapes(rfpipeprefs):
+    """ Sorted list of image shapes (npixx, npixy) for FFTW wisdom, given
+    npix_max of sections of rfpipe prefs (e.g., as parsed from 'rfpipe' in
+    realfast.yml).
+    """
+
+    shapes = set([(512, 512)])
+    for section in itervalues(rfpipeprefs):
+        if 'npix_max' in section:
+            npix = int(section['npix_max'])
+            shapes.add((npix, npix))
+
+    return sorted(shapes)
+
+
+class WarmupPlugin(distributed.diagnostics.plugin.WorkerPlugin):
+    """ Worker plugin that warms up rfpipe at worker start.
+    As in initialize_worker, it imports rfpipe and builds a mock State.
+    FFTW wisdom is set for 2d image shapes and that of the mock State.
+    Wisdom is loaded from and saved to wisdomdir (one file per host), so only
+    the first start on a host plans the FFTs for each shape.
+    Registering the plugin returns once setup ran on current workers.
+    """
+
+    name = 'realfast-warmup'
+
+    def __init__(self, shapes=((512, 512),), wisdomdir=None):
+        self.shapes = sorted(set([tuple(shape) for shape in shapes]))
+        self.wisdomdir = wisdomdir
+
+    def wisdomfile(self):
+        import socket
+
+        return os.path.join(self.wisdomdir,
+                            'fftw_wisdom_{0}.pkl'.format(socket.gethostname()))
+
+    def load(self):
+        """ Returns (shapes, wisdom) saved in wisdomfile or ([], None).
+        """
+
+        import pickle
+
+        if self.wisdomdir is None or not os.path.exists(self.wisdomfile()):
+            return [], None
+
+        try:
+            with open(self.wisdomfile(), 'rb') as fp:
+                shapes, wisdom = pickle.load(fp)
+            return [tuple(shape) for shape in shapes], wisdom
+        except Exception as exc:
+            logger.warn("Could not load wisdom from {0}: {1}"
+                        .format(self.wisdomfile(), exc))
+            return [], None
+
+    def save(self, shapes, wisdom):
+        """ Save wisdom for shapes to wisdomfile.
+        """
+
+        import pickle
+
+        if self.wisdomdir is None:
+            return
+
+        # write and rename so concurrent workers on host never see partial file
+        wisdomfile = self.wisdomfile()
+        tmpfile = '{0}.{1}'.format(wisdomfile, os.getpid())
+        try:
+            with open(tmpfile, 'wb') as fp:
+                pickle.dump((sorted(set(shapes)), wisdom), fp)
+            os.rename(tmpfile, wisdomfile)
+        except (IOError, OSError) as exc:
+            logger.warn("Could not save wisdom to {0}: {1}"
+                        .format(wisdomfile, exc))
+
+    def setup(self, worker):
+        from rfpipe import search, state, metadata, candidates, reproduce, source, util
+
+        t0 = time.Time.now()
+        st = state.State(inmeta=metadata.mock_metadata(t0.mjd, t0.mjd+0.001, 27, 16, 16*32, 4, 5e4, datasource='sim'))
+        shapes = sorted(set(self.shapes + [(st.npixx, st.npixy)]))
+
+        try:
+            import pyfftw
+        except ImportError:
+            logger.info("pyfftw not available. Not setting wisdom.")
+            return
+
+        done, wisdom = self.load()
+        if wisdom is not None:
+            pyfftw.import_wisdom(wisdom)
+
+        todo = [shape for shape in shapes if shape not in done]
+        for npixx, npixy in todo:
+            search.set_wisdom(npixx, npixy)
+
+        if todo:
+            self.save(done + todo, pyfftw.export_wisdom())
+
+        logger.info("Worker {0} warmed up in {1:.1f}s (set wisdom for shapes {2})"
+                    .format(worker.name, time.Time.now().unix-t0.unix, todo))
+
+
 def rsync(original, new):
     """ Uses subprocess.call to rsync from 'filename' to 'new'
     If new is directory, copies original in.
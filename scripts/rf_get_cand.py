@@ -5,7 +5,7 @@ import json
 import astropy.coordinates
 import astropy.units as u
 import sdmpy
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, NotFoundError
 
 # This script takes a realfast portal candidate ID, and 
 # assembles the SDM, BDF and PNG files into the current
@@ -31,18 +31,25 @@ try:
     cand = r['hits']['hits'][0]['_source']
 except IndexError:
     raise(RuntimeError,"No matching candId")
-noiseid= '%s.%d.*' % (cand['scanId'], cand['segment'])
+noiseid = '%s.%d' % (cand['scanId'], cand['segment'])
 #print(cand)
 
 # Get the noise values from portal
-q = {'query':{
-        'wildcard':{'_id':noiseid}
-    }}
-rn = es.search(index=rfidx+'noises',body=q,size=1)
+# compact doc per segment has medians. legacy docs are per integration.
 try:
-    noise = rn['hits']['hits'][0]['_source']
-except IndexError:
-    raise(RuntimeError,"No noise entry found")
+    noise = es.get(index=rfidx+'noises', doc_type=rfidx+'noise', id=noiseid)['_source']
+    noise = {'zerofrac': noise['zerofrac_median'],
+             'noiseperbl': noise['noiseperbl_median'],
+             'imstd': noise['imstd_median']}
+except NotFoundError:
+    q = {'query':{
+            'wildcard':{'_id':noiseid+'.*'}
+        }}
+    rn = es.search(index=rfidx+'noises',body=q,size=1)
+    try:
+        noise = rn['hits']['hits'][0]['_source']
+    except IndexError:
+        raise(RuntimeError,"No noise entry found")
 #print(noise)
 
 print('SDM: %s' % (cand['sdmname']))
@@ -75,3 +75,42 @@ def test_sim(config, inprefs):
     segment = 0
     data = rfpipe.source.read_segment(st, segment)
     assert data.shape == st.datashape_orig
+
+
+def test_statecache(config):
+    from realfast import controllers
+
+    sc = controllers.StateCache(preffile=os.path.join(_install_dir,
+                                                      'data/realfast.yml'))
+    assert sc.validates(config, inmeta={'datasource': 'vys'})
+    st = sc.state(config.scanId, config=config, inmeta={'datasource': 'vys'})
+    assert st is sc.state(config.scanId, config=config,
+                          inmeta={'datasource': 'vys'})
+
+    sc.evict(config.scanId)
+    assert st is not sc.state(config.scanId, config=config,
+                              inmeta={'datasource': 'vys'})
+
+
+def test_subsegment_state(config):
+    from realfast import pipeline
+
+    st = rfpipe.state.State(config=config, inprefs={'maxdm': 100}, preffile=None)
+    st2 = pipeline.subsegment_state(st, 2)
+
+    assert st2.nsegment == 2*st.nsegment
+    assert st2.segmenttimes[0][0] == st.segmenttimes[0][0]
+    assert st2.segmenttimes[1][1] == pytest.approx(st.segmenttimes[0][1])
+    assert pipeline.subsegment_state(st, 1) is st
+
+
+def test_statecache_subsegments(config):
+    from realfast import controllers
+
+    sc = controllers.StateCache(preffile=os.path.join(_install_dir,
+                                                      'data/realfast.yml'),
+                                subsegments=2)
+    st = sc.state(config.scanId, config=config, inmeta={'datasource': 'vys'})
+    assert st.prefs.segmenttimes is not None
+    assert st is sc.state(config.scanId, config=config,
+                          inmeta={'datasource': 'vys'})
@@ -33,3 +33,89 @@ def test_controller():
                    sdmscan=7)
 
     assert len(rfc.futures) > 0
+
+
+def test_otftracker():
+    class Subscan(object):
+        def __init__(self, startTime, stopTime):
+            self.startTime = startTime
+            self.stopTime = stopTime
+            self.ra_deg = 0.
+            self.dec_deg = 0.
+
+    subscans = [Subscan(0., 1.), Subscan(1., None)]
+    tracker = controllers.OTFTracker('scan1')
+    assert tracker.update(subscans) == 1
+    assert tracker.new_segments(2) == [0, 1]
+
+    subscans[1].stopTime = 2.
+    subscans.append(Subscan(2., 3.))
+    assert tracker.update(subscans) == 2
+    assert tracker.endtime_mjd_ == 3.
+    assert len(tracker.inmeta['phasecenters']) == 3
+    assert tracker.new_segments(4) == [2, 3]
+    assert tracker.new_segments(4) == []
+
+    # extended state is new, original state is unchanged
+    class Meta(object):
+        phasecenters = []
+        endtime_mjd_ = 1.
+        nints_ = 10
+
+    class State(object):
+        prefs = Meta()
+
+        def __init__(self):
+            self.metadata = Meta()
+            self._nsegment = 1
+
+        @property
+        def nsegment(self):
+            if self._nsegment is None:
+                self._nsegment = int(self.metadata.endtime_mjd_) + 1
+            return self._nsegment
+
+    st = State()
+    st2 = tracker.extend(st)
+    assert st2.nsegment == 4 and st.nsegment == 1
+    assert st.metadata.endtime_mjd_ == 1. and st.metadata.phasecenters == []
+    assert st2.metadata.phasecenters == tracker.phasecenters
+    assert st2.metadata.phasecenters is not tracker.phasecenters
+
+
+def test_statuswriter():
+    pushed = []
+
+    def update(index, Ids, docs):
+        pushed.append(dict(zip(Ids, docs)))
+        return len(Ids), [Id for Id in Ids if Id == 'scan2']
+
+    writer = controllers.ScanStatusWriter(update=update)
+    for pending in range(5):
+        writer.update('scan1', pending=pending, finished=0, nsegment=5)
+    writer.update('scan2', pending=1)
+    assert writer.flush() == 2
+    assert pushed[0]['scan1'] == {'pending': 4, 'finished': 0, 'nsegment': 5}
+
+    # failed scan2 is pushed again, unchanged scan1 is not
+    writer.remove('scan1')
+    writer.flush()
+    assert list(pushed[1]) == ['scan2']
+    assert 'scan1' not in writer
+
+    # removed scan that never updates is dropped after retries
+    writer.maxretries = 2
+    writer.remove('scan2')
+    writer.remove('scan3')  # no status (e.g., not indexing) is not kept
+    assert writer._removed == set(['scan2'])
+    writer.flush()
+    assert 'scan2' in writer
+    writer.flush()
+    assert 'scan2' not in writer and not writer._removed
+
+    # stopping flushes last changes
+    writer.update('scan4', pending=0)
+    writer.start()
+    writer.stop()
+    assert not writer._thread.is_alive()
+    assert pushed[-1] == {'scan4': {'pending': 0}}
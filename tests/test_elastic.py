@@ -0,0 +1,234 @@
+import pytest
+from future.utils import listvalues
+from elasticsearch import ConnectionError
+from realfast import elastic, backends
+
+
+class DownBackend(backends.MemoryBackend):
+    """ Memory index that refuses connections while down
+    """
+
+    down = True
+
+    def bulk(self, actions, **kwargs):
+        if self.down:
+            raise ConnectionError('N/A', 'down', None)
+        return super(DownBackend, self).bulk(actions, **kwargs)
+
+    def exists(self, index, doc_type, id, **kwargs):
+        if self.down:
+            raise ConnectionError('N/A', 'down', None)
+        return super(DownBackend, self).exists(index, doc_type, id, **kwargs)
+
+
+@pytest.fixture
+def backend():
+    backend = backends.MemoryBackend()
+    elastic.set_backend(backend)
+    yield backend
+    elastic.set_backend(None)
+
+
+@pytest.fixture
+def downbackend():
+    backend = DownBackend()
+    elastic.set_backend(backend)
+    yield backend
+    elastic.set_backend(None)
+
+
+def test_backend_lazy(monkeypatch):
+    monkeypatch.setattr(elastic, '_backend', None)
+    backend = elastic.get_backend()
+    assert isinstance(backend, backends.ElasticsearchBackend)
+    assert backend._client is None  # not connected until used
+
+    with pytest.raises(TypeError):
+        backends.IndexBackend()
+
+
+def test_cli_backend(monkeypatch):
+    from click.testing import CliRunner
+    from realfast import cli
+
+    monkeypatch.setattr(elastic, '_backend', None)
+    result = CliRunner().invoke(cli.cli2, ['--backend', 'memory', 'get-ids', 'testcands'])
+    assert result.exit_code == 0 and result.output.strip() == '[]'
+    assert isinstance(elastic.get_backend(), backends.MemoryBackend)
+
+
+def test_memory_queries(backend):
+    for i, (scanId, tagcount) in enumerate([('test.1.1', 3), ('test.1.1', 1),
+                                            ('other.2.1', 3)]):
+        assert elastic.pushdata({'scanId': scanId, 'tagcount': tagcount,
+                                 'user1_tags': 'rfi', 'user2_tags': 'rfi,delete',
+                                 'user3_tags': 'rfi'},
+                                index='testcands', Id='{0}_seg{1}'.format(scanId, i)) == 1
+    assert elastic.pushdata({'scanId': 'test.1.1', 'prefsname': 'p1'}, index='testscans',
+                            Id='test.1.1') == 1
+    assert elastic.pushdata({}, index='testscans', Id='test.1.1') == 0  # exists
+
+    assert elastic.get_ids('testcands', scanId='test.1.1') == ['test.1.1_seg0', 'test.1.1_seg1']
+    assert elastic.get_ids('testcands', 'other*') == ['other.2.1_seg2']
+    assert elastic.get_ids('testcands', query_string='scanId:test* AND tagcount:3') == ['test.1.1_seg0']
+    assert elastic.get_ids('testcands', tagcount=3, field='scanId') == \
+        [('test.1.1_seg0', 'test.1.1'), ('other.2.1_seg2', 'other.2.1')]
+
+    docids = elastic.find_docids('test', scanId='test.1.1')
+    assert docids['testcands'] == ['test.1.1_seg0', 'test.1.1_seg1']
+    assert docids['testpreferences'] == ['p1']
+
+    consensus = elastic.get_consensus(indexprefix='test', nop=3)
+    assert consensus['test.1.1_seg0']['tags'] == 'rfi'
+    assert elastic.add_tag('test', 'test.1.1_seg1', 'user4', 'delete')
+    assert elastic.get_doc('testcands', 'test.1.1_seg1')['_source']['tagcount'] == 2
+
+
+def test_memory_bulk(backend):
+    assert elastic.bulkpush([{'a': 1}, {'a': 2}], 'testnoises', ['1', '2']) == (2, 0)
+    assert elastic.bulkpush([{'a': 3}], 'testnoises', ['1']) == (0, 1)
+    assert elastic.bulkupdate('testnoises', ['1', '3'], [{'b': 1}, {'b': 1}]) == (1, ['3'])
+    assert elastic.get_doc('testnoises', '1')['_source'] == {'a': 1, 'b': 1}
+
+    # unsupported actions are errors, not exceptions
+    actions = [{'_op_type': 'upsert', '_index': 'testnoises', '_id': '1'},
+               {'_op_type': 'update', '_index': 'testnoises', '_id': '1',
+                'script': 'ctx._source.a *= 2'},
+               {'_op_type': 'delete', '_index': 'testnoises', '_id': '2'}]
+    res, errors = backend.bulk(actions, raise_on_error=False)
+    assert res == 1 and [listvalues(error)[0]['status'] for error in errors] == [400, 400]
+
+
+def test_memory_analysis(backend):
+    backend.indices.create('wscans', body={'settings': {'analysis': {
+        'analyzer': {'default': {'tokenizer': 'whitespace'}}}}})
+    for index in ['testscans', 'wscans']:
+        for scanId in ['test.1.1', 'test.2.1', 'Other.1.1']:
+            backend.index(index, index.rstrip('s'), {'scanId': scanId}, id=scanId)
+
+    # standard analyzer splits words, like elasticsearch
+    assert elastic.get_ids('testscans', scanId='test.1.1') == ['test.1.1', 'test.2.1', 'Other.1.1']
+    assert elastic.get_ids('testscans', query_string='scanId:other') == ['Other.1.1']
+    assert elastic.get_ids('wscans', scanId='test.1.1') == ['test.1.1']
+    assert elastic.get_ids('wscans', query_string='scanId:other*') == []
+    query = {'query': {'term': {'scanId.keyword': 'test.1.1'}}}
+    assert [hit['_id'] for hit in backend.scan(index='testscans', query=query)] == ['test.1.1']
+
+
+def noises(segment, integrations, imstd=1.):
+    return [(55000.+i, 0.1, segment, i, 2., 0.1, imstd) for i in integrations]
+
+
+def test_noisedoc():
+    doc = elastic.noisedoc('test.1.1', 2, noises(2, [3, 1, 2], imstd=4.))
+    assert doc['segment'] == 2 and doc['nint'] == 3
+    assert doc['integration'] == [1, 2, 3]
+    assert doc['startmjd_min'] == 55001. and doc['imstd_median'] == 4.
+    assert elastic.expand_noises([doc]) == sorted(noises(2, [1, 2, 3], imstd=4.))
+
+
+def test_get_noisedocs(backend):
+    elastic.indexnoises('test.1.1', noises=noises(0, [0, 1]) + noises(1, [0]),
+                        indexprefix='test')
+    elastic.indexnoises('test.1.1 other.1.1', noises=noises(1, [0], imstd=9.),
+                        indexprefix='test')
+    for i in [1, 2]:  # legacy doc
+        elastic.pushdata(dict(zip(['startmjd', 'deltamjd', 'segment', 'integration',
+                                   'noiseperbl', 'zerofrac', 'imstd'], noises(2, [i])[0]),
+                              scanId='test.1.1'),
+                         'testnoises', Id=elastic.noiseid('test.1.1', 2, i))
+
+    docs = elastic.get_noisedocs('test', 'test.1.1')
+    assert [(doc['segment'], doc['nint']) for doc in docs] == [(0, 2), (1, 1), (2, 2)]
+    docs = elastic.get_noisedocs('test', 'test.1.1', segment=1)
+    assert len(docs) == 1 and docs[0]['imstd_median'] == 1.
+    assert elastic.get_noisedocs('test', 'other.1.1') == []
+
+
+def test_migrate_noises(backend):
+    elastic.indexnoises('test.1.1', noises=noises(0, [0, 1]), indexprefix='test',
+                        compact=False)
+    elastic.indexnoises('test.1.1', noises=noises(1, [0]), indexprefix='test',
+                        compact=False)
+    elastic.indexnoises('test.1.1', noises=noises(1, [1]), indexprefix='test')
+    elastic.indexnoises('test.2.1', noises=noises(0, [0]), indexprefix='test',
+                        compact=False)
+    assert len(elastic.get_ids('testnoises')) == 5
+
+    assert elastic.migrate_noises('test', scanId='test.1.1') == 2
+    assert len(elastic.get_ids('testnoises')) == 6  # legacy docs kept
+    assert elastic.get_doc('testnoises', 'test.1.1.1')['_source']['integration'] == [0, 1]
+
+    assert elastic.migrate_noises('test', delete=True) == 3
+    assert sorted(elastic.get_ids('testnoises')) == ['test.1.1.0', 'test.1.1.1', 'test.2.1.0']
+    assert elastic.get_noises('test', 'test.1.1') == noises(0, [0, 1]) + noises(1, [0, 1])
+
+
+def test_indexcands_report(backend, monkeypatch):
+    canddicts = [{'candId': 'test.1.1_seg0-i{0}'.format(i), 'scanId': 'test.1.1'}
+                 for i in range(3)]
+    monkeypatch.setattr(elastic, 'canddocs', lambda *args: canddicts[:2])
+    report = elastic.indexcands(None, 'test.1.1', indexprefix='test')
+    assert list(report.items()) == [('test.1.1_seg0-i0', 'pushed'), ('test.1.1_seg0-i1', 'pushed')]
+
+    monkeypatch.setattr(elastic, 'canddocs', lambda *args: canddicts)
+    for bulk in [True, False]:
+        report = elastic.indexcands(None, 'test.1.1', indexprefix='test', bulk=bulk)
+        assert listvalues(report) == ['conflict', 'conflict', 'pushed' if bulk else 'conflict']
+
+
+def test_indexcands_down(downbackend, tmpdir, monkeypatch):
+    spool = elastic.IndexSpool(path=str(tmpdir.join('index_spool_host.jsonl')))
+    monkeypatch.setattr(spool, 'start', lambda: None)
+    monkeypatch.setattr(elastic, 'get_spool', lambda: spool)
+    monkeypatch.setattr(elastic, 'canddocs',
+                        lambda *args: [{'candId': 'test.1.1_seg0-i0', 'scanId': 'test.1.1'}])
+    for bulk in [True, False]:  # spooled, not TypeError on None
+        report = elastic.indexcands(None, 'test.1.1', indexprefix='test', bulk=bulk)
+        assert listvalues(report) == ['spooled']
+    assert len(spool) == 2
+
+
+def test_spool(downbackend, tmpdir, monkeypatch):
+    backend = downbackend
+    spool = elastic.IndexSpool(path=str(tmpdir.join('spool', 'index_spool_host.jsonl')))
+    monkeypatch.setattr(spool, 'start', lambda: None)
+    monkeypatch.setattr(elastic, 'get_spool', lambda: spool)
+
+    assert elastic.bulkpush([{'a': 1}, {'a': 2}], 'testnoises', ['1', '2']) == (0, 0)
+    assert len(spool) == 2
+    assert spool.drain() == 0
+    assert len(spool) == 2  # kept for next drain
+
+    backend.down = False
+    backend.index('testnoises', 'testnoise', {'a': 1}, id='1')
+    assert spool.drain() == 2  # conflict on existing doc is replayed
+    assert spool.drain() == 0 and len(spool) == 0
+    assert elastic.get_doc('testnoises', '2')['_source'] == {'a': 2}
+
+
+def test_spool_missing(downbackend, tmpdir, monkeypatch):
+    backend = downbackend
+    spool = elastic.IndexSpool(path=str(tmpdir.join('index_spool_host.jsonl')))
+    monkeypatch.setattr(spool, 'start', lambda: None)
+    spool.extend([{'_op_type': 'update', '_index': 'testscans', '_type': 'testscan',
+                   '_id': 'test.1.1', 'doc': {'pending': 0}},
+                  {'_op_type': 'delete', '_index': 'testscans', '_type': 'testscan',
+                   '_id': 'test.2.1'}])
+    with open(spool.path, 'a') as fp:
+        fp.write('{"_op_type": "cre\n')  # cut by crash
+
+    backend.down = False
+    assert spool.drain() == 1  # delete of missing doc is done
+    assert len(spool) == 1  # update waits for doc
+
+    backend.index('testscans', 'testscan', {'pending': 1}, id='test.1.1')
+    assert spool.drain() == 1 and len(spool) == 0
+    assert elastic.get_doc('testscans', 'test.1.1')['_source'] == {'pending': 0}
+
+    # spool of another process on host shares file, not lock files
+    other = elastic.IndexSpool(path=spool.path)
+    monkeypatch.setattr(other, 'start', lambda: None)
+    other.extend([{'_op_type': 'create', '_index': 'testscans', '_type': 'testscan',
+                   '_id': 'test.3.1', '_source': {}}])
+    assert elastic.drain_spools(str(tmpdir)) == 1
@@ -0,0 +1,115 @@
+import pytest
+from time import sleep
+from realfast import heuristics
+
+
+class FakeClient(object):
+    """ Counts scheduler queries made by heuristics
+    """
+
+    def __init__(self):
+        self.ncalls = 0
+        self.busy = {}
+        self.info = {'workers': {'tcp://10.0.0.1:1': {'id': 'rfnode001r',
+                                                      'resources': {'READER': 1, 'MEMORY': 20e9},
+                                                      'metrics': {'memory': 5e9}},
+                                 'tcp://10.0.0.1:2': {'id': 'rfnode001g0',
+                                                      'resources': {'GPU': 1, 'MEMORY': 20e9},
+                                                      'metrics': {'memory': 1e9}},
+                                 'tcp://10.0.0.2:1': {'id': 'rfnode002fetch',
+                                                      'resources': {'GPU': 1},
+                                                      'metrics': {'memory': 1e9}}}}
+
+    def scheduler_info(self):
+        self.ncalls += 1
+        return self.info
+
+    def who_has(self):
+        self.ncalls += 1
+        return {'read-abc': ('tcp://10.0.0.1:1',)}
+
+    def processing(self):
+        self.ncalls += 1
+        return self.busy
+
+
+@pytest.fixture
+def view():
+    return heuristics.ClusterView(FakeClient(), ttl=60)
+
+
+def test_clusterview_cached(view):
+    assert heuristics.reader_memory_ok(view, 10e9)
+    assert not heuristics.reader_memory_ok(view, 16e9)
+    assert heuristics.readertotal_memory_ok(view, 6e9)
+    assert view.workernames['tcp://10.0.0.1:2'] == 'rfnode001g0'
+    assert view.client.ncalls == 1
+
+    view.invalidate()
+    assert view.reader_memory_total == 20e9
+    assert view.client.ncalls == 2
+
+
+def test_clusterview_index(view):
+    assert view.readers == ['tcp://10.0.0.1:1']
+    assert sorted(view.gpus) == ['tcp://10.0.0.1:2', 'tcp://10.0.0.2:1']
+    assert view.fetchworkers == ['rfnode002fetch']
+
+
+def test_clusterview_who_has(view):
+    class Fut(object):
+        key = 'read-abc'
+
+    assert view.who_has(Fut()) == {'read-abc': ('tcp://10.0.0.1:1',)}
+    assert view.who_has()['read-abc'] == ('tcp://10.0.0.1:1',)
+
+
+def test_colocated_workers(view):
+    reader, gpus = heuristics.colocated_workers(view, 10e9)
+    assert reader == 'tcp://10.0.0.1:1'
+    assert gpus == ['tcp://10.0.0.1:2']
+    assert heuristics.colocated_workers(view, 16e9) == (None, [])
+
+    # previous reader is preferred only while idle
+    client = FakeClient()
+    client.info['workers']['tcp://10.0.0.2:3'] = {'id': 'rfnode002r',
+                                                  'resources': {'READER': 1, 'MEMORY': 20e9},
+                                                  'metrics': {'memory': 0}}
+    assert heuristics.colocated_workers(heuristics.ClusterView(client), 10e9,
+                                        prefer='tcp://10.0.0.2:3')[0] == 'tcp://10.0.0.2:3'
+    client.busy = {'tcp://10.0.0.2:3': ['read-abc']}
+    assert heuristics.colocated_workers(heuristics.ClusterView(client), 10e9,
+                                        prefer='tcp://10.0.0.2:3')[0] == 'tcp://10.0.0.1:1'
+
+    # segment buffers in shared memory count against reader memory
+    shm = {'tcp://10.0.0.1:1': 6e9}
+    assert heuristics.colocated_workers(view, 10e9, shm=shm) == (None, [])
+    assert not heuristics.reader_memory_ok(view, 10e9, shm=shm)
+    assert not heuristics.readertotal_memory_ok(view, 10e9, shm=shm)
+
+
+def test_bytes_moved():
+    stages = {'read_segment': {'host': 'rfnode001', 'bytes_out': 10},
+              'data_prep': {'host': 'rfnode002', 'bytes_in': 10}}
+    assert heuristics.bytes_moved(stages) == 10
+    stages['data_prep']['host'] = 'rfnode001'
+    assert heuristics.bytes_moved(stages) == 0
+    assert heuristics.bytes_moved({}) == 0
+
+
+def test_clusterview_workers_changed():
+    view = heuristics.ClusterView(FakeClient(), ttl=0.5)
+    view.scheduler_info()
+    sleep(0.3)
+    view.processing()
+    sleep(0.3)  # scheduler_info expired, processing not
+    view.processing()
+    assert view.client.ncalls == 2
+
+    # new worker invalidates other snapshots on scheduler_info refresh
+    view.client.info = {'workers': dict(view.client.info['workers'],
+                                        **{'tcp://10.0.0.3:1': {'id': 'new', 'resources': {},
+                                                                'metrics': {'memory': 0}}})}
+    view.scheduler_info()
+    view.processing()
+    assert view.client.ncalls == 4
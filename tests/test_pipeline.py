@@ -0,0 +1,148 @@
+import pytest
+import numpy as np
+from operator import getitem
+from realfast import pipeline
+
+
+def test_timed_read():
+    def read(st, segment, timeout=None):
+        return np.zeros(10, dtype='complex64')
+
+    data, stages = pipeline.timed_read(read, None, 0, timeout=1)
+    assert list(stages) == ['read_segment']
+    assert stages['read_segment']['bytes_out'] == data.nbytes
+    assert stages['read_segment']['wall'] >= 0
+    assert stages['read_segment']['maxrss'] > 0
+    assert 0 <= stages['read_segment']['maxrss_delta'] <= stages['read_segment']['maxrss']
+    assert 0 <= stages['read_segment']['cpu']
+
+
+def test_analyze_cc():
+    class Prefs(object):
+        simulated_transient = None
+
+    class CandCollection(list):
+        prefs = Prefs()
+        stages = {'search': {'wall': 1.}}
+
+    ncands, mocks, stages = pipeline.analyze_cc(CandCollection([1, 2]),
+                                                {'read_segment': {'wall': 2.}})
+    assert ncands == 2 and mocks is None
+    assert list(stages) == ['read_segment', 'search']
+
+
+def read_ones(n, segment):
+    return np.ones(n)
+
+
+@pytest.mark.parametrize('mode', ['sync', 'thread', 'process'])
+def test_localexecutor(mode):
+    cl = pipeline.LocalExecutor(mode, max_workers=2)
+    timedread = cl.submit(pipeline.timed_read, read_ones, 4, 0,
+                          resources={'READER': 1})
+    data = cl.submit(getitem, timedread, 0)
+    total = cl.submit(np.sum, data, retries=1)
+    assert total.result(timeout=10) == 4
+    assert data.status == 'finished'
+
+    bad = cl.submit(getitem, data, 10)
+    after = cl.submit(np.sum, bad)
+    with pytest.raises(IndexError):
+        after.result(timeout=10)
+    assert after.status == 'error'
+
+    # nested futures are resolved and selectors run inline (lambda is not sent)
+    items = cl.scatter([lambda: 1, 2])
+    two = cl.submit(getitem, items, 1)
+    assert cl.submit(sum, [two, total]).result(timeout=10) == 6
+    cl.shutdown()
+
+
+def test_apply_override():
+    class Prefs(object):
+        simulated_transient = None
+
+    class State(object):
+        prefs = Prefs()
+
+    st = State()
+    st2 = pipeline.apply_override(st, {'simulated_transient': 1})
+    assert st2.prefs.simulated_transient == 1
+    assert st.prefs.simulated_transient is None
+    assert pipeline.apply_override(st, None) is st
+
+    cl = pipeline.LocalExecutor('sync')
+    sthandle = pipeline.scatter_state(cl, st)
+    assert cl.submit(getattr, sthandle, 'prefs').result() is st.prefs
+
+
+def test_lazy_read_chunks(monkeypatch):
+    class State(object):
+        datashape_orig = (10, 3, 8, 2)
+
+    def read_integrations(st, segment, start, stop, cfile=None, timeout=None):
+        data = np.zeros((stop-start,) + st.datashape_orig[1:], dtype=np.complex64)
+        data[:] = np.arange(start, stop)[:, None, None, None]
+        return data
+
+    monkeypatch.setattr(pipeline, 'read_integrations', read_integrations)
+    arr = pipeline.lazy_read_segment(State(), 0, intchunk=4, chanchunks=(5, 3))
+    assert arr.chunks == ((4, 4, 2), (3,), (5, 3), (2,))
+    assert arr.mean(axis=(1, 2, 3)).compute().real.tolist() == list(range(10))
+
+    # short or misshaped reads fail
+    pipeline.check_integrations(State(), np.zeros((4, 3, 8, 2)), 4)
+    for data in [np.zeros((3, 3, 8, 2)), np.zeros((4, 3, 8, 1)), None]:
+        with pytest.raises(AssertionError):
+            pipeline.check_integrations(State(), data, 4)
+
+
+def test_boundary_duplicates():
+    class Metadata(object):
+        inttime = 0.005
+
+    class CandCollection(object):
+        metadata = Metadata()
+
+        def __init__(self, segment, mjd, snr):
+            self.segment = segment
+            self.candmjd = np.array(mjd)
+            self.snrtot = np.array(snr)
+            self.canddt = np.full(len(mjd), 0.005)
+            self.canddm = np.full(len(mjd), 100.)
+            self.candl = np.zeros(len(mjd))
+            self.candm = np.zeros(len(mjd))
+
+        def __len__(self):
+            return len(self.candmjd)
+
+    t0 = 58000.
+    cc0 = CandCollection(0, [t0, t0 + 1/(24*3600.)], [8., 9.])
+    cc1 = CandCollection(1, [t0 + 1/(24*3600.)], [10.])
+    assert pipeline.boundary_duplicates(cc0, [cc1]).tolist() == [False, True]
+    assert pipeline.boundary_duplicates(cc1, [cc0]).tolist() == [False]
+
+
+def test_subsegment_state_short():
+    class State(object):
+        t_overlap = 10.
+        segmenttimes = [[0., 5/(24*3600.)]]
+
+    st = State()
+    assert pipeline.subsegment_state(st, 2) is st
+
+
+def test_overlap_cache(monkeypatch):
+    monkeypatch.setattr(pipeline, '_overlap_maxbytes', 100)
+    pipeline.clear_overlap()
+
+    pipeline.keep_overlap('scan1', 10, np.zeros(5, dtype='complex64'))
+    assert pipeline.take_overlap('scan1', 10, 12) is None  # longer than segment
+    assert len(pipeline.take_overlap('scan1', 10, 20)) == 5
+    assert pipeline.take_overlap('scan1', 10, 20) is None
+
+    # oldest entries are evicted beyond byte limit
+    pipeline.keep_overlap('scan1', 10, np.zeros(5, dtype='complex64'))
+    pipeline.keep_overlap('scan2', 10, np.zeros(10, dtype='complex64'))
+    assert pipeline.take_overlap('scan1', 10, 20) is None
+    assert pipeline.clear_overlap('scan2') == 80
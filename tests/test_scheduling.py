@@ -0,0 +1,230 @@
+import pytest
+import threading
+from time import sleep
+from realfast import scheduling
+
+
+class FakeFuture(object):
+    """ Minimal stand-in for distributed.Future
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.status = 'pending'
+        self.callbacks = []
+
+    def add_done_callback(self, fn):
+        self.callbacks.append(fn)
+
+    def finish(self, status='finished'):
+        self.status = status
+        for fn in self.callbacks:
+            fn(self)
+
+
+def segfutures(segment):
+    return (segment, FakeFuture('read-{0}'.format(segment)),
+            FakeFuture('prep-{0}'.format(segment)),
+            FakeFuture('analyze-{0}'.format(segment)))
+
+
+@pytest.fixture
+def registry():
+    registry = scheduling.SegmentRegistry()
+    for segment in range(4):
+        registry.add('scan1', segfutures(segment))
+    registry.add('scan2', segfutures(0))
+    return registry
+
+
+def test_registry_buckets(registry):
+    assert len(registry) == 2
+    assert registry.count() == 5
+    assert registry.count('pending', scanId='scan1') == 4
+
+    seg, data, cc, acc = registry['scan1'][1]
+    data.finish()
+    cc.finish()
+    assert registry.count('finished') == 0
+    acc.finish()
+    assert [rec.segment for rec in registry.bucket('finished')] == [1]
+
+    seg, data, cc, acc = registry['scan1'][2]
+    data.finish('error')
+    assert registry.count('error', scanId='scan1') == 1
+    assert registry.count('pending', scanId='scan1') == 2
+
+
+def test_registry_lost(registry):
+    seg, data, cc, acc = registry['scan2'][0]
+    data.status = 'lost'  # no callback for lost keys
+    assert registry.count('lost') == 0
+    registry.refresh()
+    assert registry.count('lost', scanId='scan2') == 1
+
+
+def test_registry_remove(registry):
+    seg, data, cc, acc = registry['scan1'][0]
+    record = registry.remove('scan1', 0)
+    assert record.segment == 0
+    acc.finish()  # callback after removal is ignored
+    assert registry.count('finished') == 0
+
+    registry.remove_scan('scan2')
+    assert 'scan2' not in registry
+    assert list(registry.to_dict()) == ['scan1']
+    assert len(registry.to_dict()['scan1']) == 3
+
+
+def test_registry_from_dict(registry):
+    registry2 = scheduling.SegmentRegistry.from_dict(registry.to_dict())
+    assert registry2.count() == registry.count()
+    assert registry2['scan1'] == registry['scan1']
+
+
+def waiting(admission, scanId, segment=None, timeout=0.5):
+    """ Start thread with scanId segment waiting for a cluster that is not ready.
+    """
+
+    thread = threading.Thread(target=admission.admit,
+                              args=(scanId, segment, lambda: False, timeout))
+    thread.start()
+    while (scanId, segment) not in admission.waiting:
+        sleep(0.01)
+    return thread
+
+
+def test_admission_fair():
+    load = {'scan1': 3, 'scan2': 0}
+    admission = scheduling.AdmissionController(load=load.get)
+
+    # scan1 alone is admitted, even with high load
+    assert admission.admit('scan1', timeout=0.1)
+    assert not admission.admit('scan1', ready=lambda: False, timeout=0.1)
+
+    # scan2 has lower load, so it takes turn while both wait
+    thread = waiting(admission, 'scan2')
+    assert admission.next_scan() == ('scan2', None)
+    assert not admission.admit('scan1', timeout=0.1)
+    thread.join()
+    assert admission.waiting == []
+
+
+def test_admission_edf():
+    admission = scheduling.AdmissionController()
+    admission.enqueue('scan1', {0: 100., 1: 110.})
+    admission.enqueue('scan2', {0: 105., 1: None})
+    assert [(scanId, seg) for _, scanId, seg in admission.queued] == \
+        [('scan1', 0), ('scan2', 0), ('scan1', 1), ('scan2', 1)]
+
+    # earlier deadline of other scan takes turn
+    thread = waiting(admission, 'scan2', 0)
+    assert not admission.admit('scan1', 1, timeout=0.1)
+    thread.join()
+    assert admission.admit('scan1', 1, timeout=0.1)
+    assert ('scan1', 1) not in [(scanId, seg) for _, scanId, seg in admission.queued]
+
+    # at 8 s per admission, second deadline in queue is missed
+    admission._interval = 8.
+    assert admission.expected_misses(now=92.) == [('scan2', 0)]
+    admission.dequeue('scan2', [0, 1])
+    assert admission.expected_misses(now=92.) == []
+
+
+def test_release_tracker():
+    released = []
+    tracker = scheduling.ReleaseTracker()
+    tracker.hold(('scan1', 0), lambda: released.append(0))
+    search, products = FakeFuture('search'), FakeFuture('products')
+    tracker.use(('scan1', 0), search)
+    tracker.use(('scan1', 0), products)
+
+    search.finish()
+    tracker.drop(('scan1', 0))
+    assert not released
+    products.finish('error')
+    assert released == [0]
+    assert ('scan1', 0) not in tracker
+
+    # holding again keeps uses and counts bytes at location
+    tracker.hold(('scan1', 1), lambda: released.append(1), location='reader1', nbytes=10)
+    search = FakeFuture('search')
+    tracker.use(('scan1', 1), search)
+    tracker.hold(('scan1', 1), lambda: released.append(2), location='reader1', nbytes=10)
+    assert tracker.nbytes() == {'reader1': 20}
+    assert tracker.location(('scan1', 1)) == 'reader1'
+    tracker.drop(('scan1', 1))
+    assert released == [0]
+    search.finish()
+    assert released == [0, 1, 2]
+    assert tracker.nbytes() == {}
+
+
+def test_adaptive_throttle():
+    throttle = scheduling.AdaptiveThrottle(window=2., holdtime=10.)
+    assert throttle.wait(lambda: 1, timeout=0.1)
+    assert not throttle.wait(lambda: 2, timeout=0.1)
+
+    for i in range(4):
+        throttle.completed()
+    assert throttle.window > 3
+
+    window = throttle.window
+    throttle.congested()
+    throttle.congested()  # within holdtime
+    assert throttle.window == window/2
+
+    fut = FakeFuture('acc')
+    fut.status = 'error'
+    throttle.completed(fut)
+    assert throttle.window == window/2
+
+    # submissions are paced by interval, charged only on submission
+    throttle = scheduling.AdaptiveThrottle(holdtime=0.)
+    assert throttle.wait(lambda: 0, timeout=0.1, interval=0.5)
+    assert throttle.wait(lambda: 0, timeout=0.1, interval=0.5)
+    throttle.submitted()
+    assert not throttle.wait(lambda: 0, timeout=0.1, interval=0.5)
+    assert throttle.wait(lambda: 0, timeout=1., interval=0.5)
+
+    # pacing relaxes as segments complete and returns on congestion
+    for i in range(10):
+        throttle.completed()
+    throttle.submitted()
+    pace = throttle.pace
+    assert pace < 1e-2
+    assert throttle.wait(lambda: 0, timeout=0.05, interval=0.5)
+    throttle.congested()
+    assert throttle.pace > pace
+    for i in range(10):
+        throttle.congested()
+    assert throttle.pace == 1.
+    throttle.submitted()
+    assert not throttle.wait(lambda: 0, timeout=0.1, interval=0.5)
+
+
+def test_segment_merger():
+    merger = scheduling.SegmentMerger()
+    merger.add('scan1', 1, FakeFuture('prep-1'))
+
+    # segment 1 waits for pending neighbour 2 and unsubmitted neighbour 0
+    assert merger.release('scan1', pending=[2], nsegment=3) == []
+    assert merger.release('scan1', pending=[], nsegment=3) == []
+    assert merger.held('scan1') == 1
+
+    merger.add('scan1', 2, FakeFuture('prep-2'))
+    merger.add('scan1', 0, FakeFuture('prep-0'))
+    readylist = merger.release('scan1', pending=[], nsegment=3)
+    assert [(segment, cc.key, [nb.key for nb in neighbours])
+            for (segment, cc, neighbours) in readylist] == \
+        [(0, 'prep-0', ['prep-1']), (1, 'prep-1', ['prep-0', 'prep-2']),
+         (2, 'prep-2', ['prep-1'])]
+    assert merger.held() == 0
+    assert merger._finished['scan1'] == {}
+
+    # neighbour that was never submitted is not waited on after submission
+    merger.add('scan2', 1, FakeFuture('prep-1'))
+    assert merger.release('scan2', pending=[], nsegment=3) == []
+    readylist = merger.release('scan2', pending=[], nsegment=3, final=True)
+    assert [(segment, neighbours) for (segment, cc, neighbours) in readylist] == [(1, [])]
+    assert merger._finished['scan2'] == {}
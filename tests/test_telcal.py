@@ -0,0 +1,69 @@
+import os
+import numpy as np
+from realfast import telcal
+
+
+class Prefs(object):
+    gainfile = None
+
+
+class Metadata(object):
+    datasetId = 'test'
+
+
+class State(object):
+    def __init__(self):
+        self.prefs = Prefs()
+        self.metadata = Metadata()
+
+    @property
+    def gainfile(self):
+        return self.prefs.gainfile
+
+
+def test_watcher(tmpdir):
+    nparse = []
+
+    def getsols(st):
+        nparse.append(st.gainfile)
+        return {'flagged': np.array([False])}
+
+    readied = []
+    watcher = telcal.TelcalWatcher(directory=str(tmpdir), getsols=getsols,
+                                   onready=lambda: readied.append(1))
+    st = State()
+    watcher.watch('scan1', st)
+    watcher.poll()
+    assert not watcher.ready('scan1')
+
+    path = telcal.telcalfile('test', directory=str(tmpdir))
+    os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+    watcher.poll()
+    watcher.poll()  # unchanged file is not parsed again
+    assert watcher.ready('scan1') and watcher.wait('scan1', timeout=0)
+    assert st.gainfile == path
+    assert len(nparse) == 1 and len(readied) == 1
+
+    watcher.unwatch('scan1')
+    assert watcher.sols('scan1') is None
+
+
+def test_watcher_new_state(tmpdir):
+    watcher = telcal.TelcalWatcher(directory=str(tmpdir),
+                                   getsols=lambda st: {'flagged': np.array([False])})
+    path = telcal.telcalfile('test', directory=str(tmpdir))
+    os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+
+    watcher.watch('scan1', State())
+    watcher.poll()
+    assert watcher.ready('scan1')
+
+    # replaced state gets gain file and its own solutions
+    st = State()
+    watcher.watch('scan1', st)
+    assert st.gainfile == path
+    assert not watcher.ready('scan1')
+    watcher.poll()
+    assert watcher.ready('scan1')
@@ -0,0 +1,39 @@
+import os
+import pickle
+from realfast import util
+
+
+def test_wisdom_shapes():
+    prefs = {'default': {'npix_max': 2048}, 'VLASS': {'npix_max': 1024.},
+             'other': {'dmarr': [0]}}
+    assert util.wisdom_shapes(prefs) == [(512, 512), (1024, 1024), (2048, 2048)]
+    assert util.wisdom_shapes({}) == [(512, 512)]
+
+
+def test_warmup_wisdomfile(tmpdir):
+    plugin = util.WarmupPlugin(shapes=[[1024, 512], (512, 512)],
+                               wisdomdir=str(tmpdir))
+    assert plugin.shapes == [(512, 512), (1024, 512)]
+    assert plugin.load() == ([], None)
+
+    # plugin is sent to workers
+    plugin = pickle.loads(pickle.dumps(plugin))
+    plugin.save([(512, 512), (1024, 512), (512, 512)], (b'wisdom',))
+    assert plugin.load() == ([(512, 512), (1024, 512)], (b'wisdom',))
+
+    with open(plugin.wisdomfile(), 'wb') as fp:
+        fp.write(b'corrupt')
+    assert plugin.load() == ([], None)
+
+
+def test_sweep_segments(tmpdir):
+    old = tmpdir.join('realfast_scan_seg0.dat')
+    new = tmpdir.join('realfast_scan_seg1.dat')
+    other = tmpdir.join('other.dat')
+    for path in [old, new, other]:
+        path.write('')
+    os.utime(str(old), (0, 0))
+    os.utime(str(other), (0, 0))
+
+    assert util.sweep_segments(str(tmpdir), maxage=60) == [str(old)]
+    assert new.exists() and other.exists()